@@ -1,14 +1,100 @@
 from PIL import Image
 import os
 import os.path
+import math
+import random
+import time
+import queue
+import itertools
+import threading
 import torch.utils.data
 import torchvision.transforms as transforms
 import numpy as np
 import torch
+from torch.utils.data.dataloader import default_collate
 
 def default_image_loader(path):
     return Image.open(path).convert('RGB')
 
+def lazy_image_loader(path):
+    """Opens the file without decoding it, so that a Draft* transform can still pick the JPEG
+    scale. The pixels are decoded by the first transform that needs them."""
+    return Image.open(path)
+
+def _resized_size(width, height, size):
+    # output size of transforms.Resize(size) for an int size
+    if width <= height:
+        return size, int(size * height / width)
+    return int(size * width / height), size
+
+def _draft(img, width, height):
+    # JPEG DCT-domain downscaling: PIL picks the largest of 1/2, 1/4, 1/8 that keeps the image at
+    # least width x height. Images that are not JPEG, or already decoded, are left as they are.
+    img.draft('RGB', (max(int(width), 1), max(int(height), 1)))
+    return img.convert('RGB')
+
+class DraftResize(object):
+    """transforms.Resize(size) for a lazily opened image, decoding the JPEG at the smallest
+    scale that still covers `size` on the shorter side."""
+
+    def __init__(self, size, interpolation=Image.BILINEAR):
+        self.size = size
+        self.resize = transforms.Resize(size, interpolation)
+
+    def __call__(self, img):
+        return self.resize(_draft(img, self.size, self.size))
+
+class DraftRandomResizedCrop(object):
+    """Resize(resize) followed by RandomResizedCrop(size), for a lazily opened image.
+
+    The crop box is sampled on the resized geometry exactly as RandomResizedCrop does, then
+    mapped back to the file. The JPEG is decoded at the smallest DCT scale at which the box still
+    has min(box, size) pixels, i.e. at least the detail the two-step pipeline keeps, and the box
+    is resampled straight to size x size. PIL cannot decode part of a JPEG, so the gain comes
+    from the scale: large boxes decode at 1/2 to 1/8 of the full resolution.
+    """
+
+    def __init__(self, resize, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), interpolation=Image.BILINEAR):
+        self.resize = resize
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.interpolation = interpolation
+
+    def get_params(self, width, height):
+        """(x0, y0, w, h) of a RandomResizedCrop box in a width x height image."""
+        area = width * height
+        for _ in range(10):
+            target_area = random.uniform(*self.scale) * area
+            aspect = math.exp(random.uniform(math.log(self.ratio[0]), math.log(self.ratio[1])))
+            w = int(round(math.sqrt(target_area * aspect)))
+            h = int(round(math.sqrt(target_area / aspect)))
+            if 0 < w <= width and 0 < h <= height:
+                return random.randint(0, width - w), random.randint(0, height - h), w, h
+        # fallback to the central crop, as torchvision does
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(self.ratio):
+            w, h = width, int(round(width / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            w, h = int(round(height * max(self.ratio))), height
+        else:
+            w, h = width, height
+        return (width - w) // 2, (height - h) // 2, w, h
+
+    def __call__(self, img):
+        width, height = img.size
+        rw, rh = _resized_size(width, height, self.resize)
+        x0, y0, w, h = self.get_params(rw, rh)
+        fx, fy = float(width) / rw, float(height) / rh
+
+        # largest reduction at which the box keeps min(box, size) pixels on both sides
+        reduction = max(1.0, min(w * fx / min(w, self.size), h * fy / min(h, self.size)))
+        img = _draft(img, math.ceil(width / reduction), math.ceil(height / reduction))
+
+        sx, sy = float(img.size[0]) / width, float(img.size[1]) / height
+        box = (x0 * fx * sx, y0 * fy * sy, (x0 + w) * fx * sx, (y0 + h) * fy * sy)
+        return img.resize((self.size, self.size), self.interpolation, box=box)
+
 class TransformTwice:
     def __init__(self, transform):
         self.transform = transform
@@ -27,8 +113,332 @@ class TransformFourth:
         out4 = self.transform(inp)
         return out1, out2, out3, out4
 
+class StringTable(object):
+    """Read-only list of strings packed into one bytes buffer plus an offsets array.
+
+    Indexing a Python list of str updates the refcount of every item it touches, which makes
+    forked DataLoader workers copy the pages holding the list bit by bit. Two numpy buffers
+    are only two objects, so their pages stay shared for the whole run.
+    """
+
+    def __init__(self, strings):
+        encoded = [str(s).encode('utf-8') for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+class DatasetManifest(object):
+    """Columnar view of a meta file: instance ids, labels, file names and whether each file exists."""
+
+    def __init__(self, ids, labels, filenames, exists):
+        self.ids = ids
+        self.labels = labels
+        self.filenames = filenames
+        self.exists = exists
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def compile(cls, meta_file, impath, cache_file=None):
+        if cache_file is not None and os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(meta_file):
+            return cls.load(cache_file)
+
+        ids = []
+        labels = []
+        filenames = []
+        with open(meta_file, 'r') as rf:
+            for i, line in enumerate(rf):
+                if i == 0 or line.strip() == '':
+                    continue
+                instance_id, label, file_name = line.strip().split()
+                ids.append(int(instance_id))
+                labels.append(int(label))
+                filenames.append(file_name)
+
+        filenames = np.array(filenames, dtype=np.str_)
+        # one directory listing instead of an os.path.exists call per file
+        listing = np.array(os.listdir(impath), dtype=np.str_) if os.path.isdir(impath) else np.array([], dtype=np.str_)
+        manifest = cls(np.array(ids, dtype=np.int64), np.array(labels, dtype=np.int64), filenames, np.isin(filenames, listing))
+        if cache_file is not None:
+            manifest.save(cache_file)
+        return manifest
+
+    def save(self, path):
+        with open(path, 'wb') as wf:
+            np.savez(wf, ids=self.ids, labels=self.labels, filenames=self.filenames, exists=self.exists)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['ids'], data['labels'], data['filenames'], data['exists'])
+
+    def select(self, split, ids=None):
+        """Boolean mask of the existing entries that belong to `split` and, if given, to `ids`."""
+        if split == 'unlabel' or split == 'test':
+            mask = self.labels == -1
+        else:
+            mask = self.labels != -1
+        if ids is not None:
+            mask &= np.isin(self.ids, np.asarray(ids).astype(np.int64))
+        return mask & self.exists
+
+class InfiniteSampler(torch.utils.data.Sampler):
+    """Shuffled indices of data_source, one fresh permutation after another, forever.
+
+    A DataLoader over this sampler never runs out, so its iterator (and the worker processes
+    behind it) is created once for the whole run instead of once per pass. len() is one pass.
+
+    skip, if given, is called at the start of every pass and may return a boolean tensor over the
+    dataset; those indices are left out of that pass (see pseudo_label.PseudoLabelCache).
+    """
+
+    def __init__(self, data_source, shuffle=True, skip=None):
+        self.num_samples = len(data_source)
+        self.shuffle = shuffle
+        self.skip = skip
+
+    def __iter__(self):
+        while True:
+            order = torch.randperm(self.num_samples) if self.shuffle else torch.arange(self.num_samples)
+            skip = self.skip() if self.skip is not None else None
+            if skip is not None:
+                kept = order[~skip[order]]
+                if kept.numel() != 0:
+                    order = kept
+            for index in order.tolist():
+                yield index
+
+    def __len__(self):
+        return self.num_samples
+
+class AcceptanceScheduler(object):
+    """Unlabeled batch size that lets about `target` samples per step through pseudo-label selection.
+
+    update(accepted, drawn) folds the acceptance rate of a step into a running estimate (an
+    exponential average with `momentum`), and size becomes target / rate, clamped to
+    [min_size, max_size]. Every change of size is appended to `decisions` as (step, rate, size).
+    """
+
+    def __init__(self, target, min_size, max_size, momentum=0.9):
+        self.target = target
+        self.min_size = min_size
+        self.max_size = max_size
+        self.momentum = momentum
+        self.size = max_size
+        self.rate = None
+        self.steps = 0
+        self.decisions = []
+
+    def update(self, accepted, drawn):
+        self.steps += 1
+        rate = accepted / float(drawn) if drawn else 0.0
+        self.rate = rate if self.rate is None else self.momentum * self.rate + (1 - self.momentum) * rate
+        # a rate below target / max_size asks for more than max_size anyway
+        size = int(math.ceil(self.target / max(self.rate, float(self.target) / self.max_size)))
+        size = min(max(size, self.min_size), self.max_size)
+        if size != self.size:
+            self.size = size
+            self.decisions.append((self.steps, self.rate, size))
+        return size
+
+class DynamicBatchSampler(torch.utils.data.Sampler):
+    """Batches from an InfiniteSampler, each as large as scheduler.size when it is sampled.
+
+    The DataLoader samples a few batches ahead of the training loop (two per worker), so a new
+    size reaches the loop that many steps later.
+    """
+
+    def __init__(self, sampler, scheduler):
+        self.sampler = sampler
+        self.scheduler = scheduler
+
+    def __iter__(self):
+        indices = iter(self.sampler)
+        while True:
+            yield list(itertools.islice(indices, self.scheduler.size))
+
+    def __len__(self):
+        return int(math.ceil(len(self.sampler) / float(self.scheduler.size)))
+
+def _batch_len(batch):
+    # samples in a collated batch: the length of its first tensor
+    while not isinstance(batch, torch.Tensor):
+        batch = batch[0]
+    return batch.size(0)
+
+class PairedStreamLoader(object):
+    """Endless (labeled batch, unlabeled batch) pairs from two DataLoaders over InfiniteSamplers.
+
+    Both iterators are created once and kept for the whole run, so the workers are never torn
+    down and an exception raised while loading reaches the training loop. A training epoch is
+    len(labeled_loader) steps, see epoch(); the unlabeled stream runs through its own passes
+    independently. Callbacks registered with on_epoch_end are called as fn(stream, epoch) every
+    time the 'labeled' or the 'unlabeled' stream has gone through its dataset once more. Passes
+    are counted in samples, so batches of varying size are fine.
+    """
+
+    def __init__(self, labeled, unlabeled):
+        for loader in (labeled, unlabeled):
+            if not isinstance(getattr(loader.batch_sampler, 'sampler', None), InfiniteSampler):
+                raise ValueError('PairedStreamLoader needs DataLoaders built with sampler=InfiniteSampler(dataset)')
+        self.loaders = {'labeled': labeled, 'unlabeled': unlabeled}
+        self.batches = {'labeled': 0, 'unlabeled': 0}
+        self.samples = {'labeled': 0, 'unlabeled': 0}
+        self.epochs = {'labeled': 0, 'unlabeled': 0}
+        self.callbacks = []
+        self._iters = None
+
+    @property
+    def labeled(self):
+        return self.loaders['labeled']
+
+    @property
+    def unlabeled(self):
+        return self.loaders['unlabeled']
+
+    def __len__(self):
+        return len(self.labeled)
+
+    def on_epoch_end(self, fn):
+        self.callbacks.append(fn)
+
+    def _next(self, stream):
+        batch = next(self._iters[stream])
+        loader = self.loaders[stream]
+        self.batches[stream] += 1
+        self.samples[stream] += _batch_len(batch)
+        epoch = self.samples[stream] // len(loader.dataset)
+        while self.epochs[stream] < epoch:
+            self.epochs[stream] += 1
+            for fn in self.callbacks:
+                fn(stream, self.epochs[stream])
+        return batch
+
+    def __iter__(self):
+        if self._iters is None:
+            self._iters = {stream: iter(loader) for stream, loader in self.loaders.items()}
+        while True:
+            yield self._next('labeled'), self._next('unlabeled')
+
+    def epoch(self):
+        """The next len(self) pairs."""
+        return itertools.islice(iter(self), len(self))
+
+class DevicePrefetcher(object):
+    """Stages the next (labeled, unlabeled) pair of a PairedStreamLoader on the training device
+    while the current step computes.
+
+    Labeled batches come out as (inputs_x, targets, onehot_targets), with the one-hot matrix
+    built directly on the device; unlabeled batches keep their structure. On CUDA the copies are
+    issued from pinned memory on a side stream and the compute stream only waits for them when
+    the pair is handed out. Without CUDA a background thread keeps the next pairs loaded, so
+    collation and pinning in the loader overlap with the step instead of preceding it.
+
+    last_wait and total_wait are the seconds the training loop spent blocked on data.
+    """
+
+    def __init__(self, stream, num_classes, device, depth=2):
+        self.stream = stream
+        self.num_classes = num_classes
+        self.device = torch.device(device)
+        self.depth = depth
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+        self.steps = 0
+        self._pairs = None
+        self._cuda_stream = None
+        self._staged = None
+        self._queue = None
+
+    def __len__(self):
+        return len(self.stream)
+
+    def _to_device(self, obj):
+        if isinstance(obj, torch.Tensor):
+            return obj.to(self.device, non_blocking=True)
+        if isinstance(obj, (tuple, list)):
+            return type(obj)(self._to_device(o) for o in obj)
+        return obj
+
+    def _stage(self, pair):
+        (inputs_x, targets_x), data_u = pair
+        inputs_x, targets_x, data_u = self._to_device((inputs_x, targets_x, data_u))
+        onehot = torch.zeros(targets_x.size(0), self.num_classes, device=self.device)
+        onehot.scatter_(1, targets_x.view(-1, 1), 1)
+        return (inputs_x, targets_x, onehot), data_u
+
+    def _record(self, obj):
+        # the side-stream tensors are now used on the compute stream, keep the allocator in sync
+        if isinstance(obj, torch.Tensor):
+            obj.record_stream(torch.cuda.current_stream())
+        elif isinstance(obj, (tuple, list)):
+            for o in obj:
+                self._record(o)
+
+    def _stage_cuda(self):
+        pair = next(self._pairs)
+        with torch.cuda.stream(self._cuda_stream):
+            self._staged = self._stage(pair)
+
+    def _fill(self):
+        try:
+            for pair in self._pairs:
+                self._queue.put((True, self._stage(pair)))
+        except Exception as e:
+            self._queue.put((False, e))
+
+    def _start(self):
+        self._pairs = iter(self.stream)
+        if self.device.type == 'cuda':
+            self._cuda_stream = torch.cuda.Stream(self.device)
+            self._stage_cuda()
+        else:
+            self._queue = queue.Queue(maxsize=self.depth)
+            threading.Thread(target=self._fill, daemon=True).start()
+
+    def __iter__(self):
+        if self._pairs is None:
+            self._start()
+        while True:
+            start = time.time()
+            if self._cuda_stream is not None:
+                torch.cuda.current_stream().wait_stream(self._cuda_stream)
+                pair = self._staged
+                self._record(pair)
+                self._stage_cuda()
+            else:
+                ok, pair = self._queue.get()
+                if not ok:
+                    raise pair
+            self.last_wait = time.time() - start
+            self.total_wait += self.last_wait
+            self.steps += 1
+            yield pair
+
+    def epoch(self):
+        """The next len(self) pairs."""
+        return itertools.islice(iter(self), len(self))
+
+class IndexedCollate(object):
+    """Collates (sample, index) pairs of SimpleImageLoader(return_index=True) into
+    (collate_fn(samples), int64 tensor of the indices)."""
+
+    def __init__(self, collate_fn=default_collate):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        samples, indices = zip(*batch)
+        return self.collate_fn(list(samples)), torch.tensor(indices, dtype=torch.int64)
+
 class SimpleImageLoader(torch.utils.data.Dataset):
-    def __init__(self, rootdir, split, ids=None, transform=None, loader=default_image_loader):
+    def __init__(self, rootdir, split, ids=None, transform=None, loader=default_image_loader, store=None, manifest=None, views=2, return_index=False):
         if split == 'test':
             self.impath = os.path.join(rootdir, 'test_data')
             meta_file = os.path.join(self.impath, 'test_meta.txt')
@@ -36,35 +446,33 @@ class SimpleImageLoader(torch.utils.data.Dataset):
             self.impath = os.path.join(rootdir, 'train/train_data')
             meta_file = os.path.join(rootdir, 'train/train_label')
 
-        imnames = []
-        imclasses = []
-
-        with open(meta_file, 'r') as rf:
-            for i, line in enumerate(rf):
-                if i == 0:
-                    continue
-                instance_id, label, file_name = line.strip().split()
-                if int(label) == -1 and (split != 'unlabel' and split != 'test'):
-                    continue
-                if int(label) != -1 and (split == 'unlabel' or split == 'test'):
-                    continue
-                if (ids is None) or (int(instance_id) in ids):
-                    if os.path.exists(os.path.join(self.impath, file_name)):
-                        imnames.append(file_name)
-                        if split == 'train' or split == 'val':
-                            imclasses.append(int(label))
+        if manifest is None:
+            manifest = DatasetManifest.compile(meta_file, self.impath)
+        mask = manifest.select(split, ids)
+        # packed buffers instead of Python lists, see StringTable
+        imnames = StringTable(manifest.filenames[mask])
+        imclasses = np.zeros(0, dtype=np.int64)
+        if split == 'train' or split == 'val':
+            imclasses = manifest.labels[mask]
 
         self.transform = transform
         self.TransformTwice = TransformTwice(self.transform)
         self.TransformFourth = TransformFourth(self.transform)
         self.loader = loader
+        self.store = store
         self.split = split
+        self.views = views
+        self.return_index = return_index
         self.imnames = imnames
         self.imclasses = imclasses
 
     def __getitem__(self, index):
         filename = self.imnames[index]
-        img = self.loader(os.path.join(self.impath, filename))
+        if self.store is not None:
+            # pre-decoded and already resized to imResize, see ImageStore.py
+            img = self.store.load(filename)
+        else:
+            img = self.loader(os.path.join(self.impath, filename))
 
         if self.split == 'test':
             if self.transform is not None:
@@ -73,11 +481,17 @@ class SimpleImageLoader(torch.utils.data.Dataset):
         elif self.split != 'unlabel':
             if self.transform is not None:
                 img = self.transform(img)
-            label = self.imclasses[index]
+            label = int(self.imclasses[index])
             return img, label
+        elif self.views == 1:
+            # the views are produced later on the whole batch, see batch_transforms.BatchAugment
+            sample = self.transform(img)
         else:
-            img1, img2 = self.TransformTwice(img)
-            return img1, img2
+            sample = self.TransformTwice(img)
+        if self.return_index:
+            # unlabeled samples carry their index for the pseudo-label cache, see IndexedCollate
+            return sample, index
+        return sample
 
     def __len__(self):
         return len(self.imnames)
@@ -0,0 +1,135 @@
+"""
+Pre-decoded image store.
+
+Every image is decoded once, resized like transforms.Resize(imResize) and written as raw
+uint8 HWC pixels into a single flat file. A small index (sorted file names, byte offsets
+and image shapes) maps a file name to its record, so reading a sample is a slice of a
+memory-mapped array instead of a full JPEG decode.
+
+Layout of a store named <path>:
+    <path>.bin      raw uint8 pixels, records packed back to back
+    <path>.idx.npz  names (sorted, bytes), offsets (int64), shapes (int32, [h, w]), imResize
+"""
+
+import os
+import argparse
+
+import numpy as np
+from PIL import Image
+import torchvision.transforms as transforms
+from tqdm import tqdm
+
+from ImageDataLoader import default_image_loader, DatasetManifest
+
+
+class ImageStore(object):
+    """Read-only view over a store built by ImageStore.build."""
+
+    def __init__(self, path):
+        self.path = path
+        index = np.load(path + '.idx.npz')
+        self.names = index['names']
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.imResize = int(index['imResize'])
+        self._data = None
+
+    def __getstate__(self):
+        # the memory map is reopened lazily in every worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.path + '.bin', dtype=np.uint8, mode='r')
+        return self._data
+
+    def __len__(self):
+        return len(self.names)
+
+    def _find(self, filename):
+        key = os.path.basename(filename).encode()
+        pos = np.searchsorted(self.names, key)
+        if pos >= len(self.names) or self.names[pos] != key:
+            raise KeyError('{} is not in image store {}'.format(filename, self.path))
+        return pos
+
+    def __contains__(self, filename):
+        try:
+            self._find(filename)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, filename):
+        """Returns an HWC uint8 view of the stored image into the memory map (no copy)."""
+        pos = self._find(filename)
+        h, w = self.shapes[pos]
+        start = self.offsets[pos]
+        return self.data[start:start + h * w * 3].reshape(h, w, 3)
+
+    def load(self, filename):
+        """Drop-in replacement for default_image_loader. Pillow copies the RGB pixels out of the
+        memory map, so a sample costs one memcpy instead of a decode."""
+        return Image.fromarray(self.get(filename))
+
+    @staticmethod
+    def build(impath, filenames, path, imResize, loader=default_image_loader):
+        """Decodes and resizes every file once and writes the store to <path>."""
+        resize = transforms.Resize(imResize)
+        filenames = sorted(set(filenames))
+        offsets = np.zeros(len(filenames), dtype=np.int64)
+        shapes = np.zeros((len(filenames), 2), dtype=np.int32)
+
+        offset = 0
+        with open(path + '.bin', 'wb') as wf:
+            for i, file_name in enumerate(tqdm(filenames)):
+                img = np.asarray(resize(loader(os.path.join(impath, file_name))), dtype=np.uint8)
+                wf.write(np.ascontiguousarray(img).tobytes())
+                offsets[i] = offset
+                shapes[i] = img.shape[:2]
+                offset += img.size
+
+        np.savez(path + '.idx.npz', names=np.array([f.encode() for f in filenames], dtype=np.bytes_),
+                 offsets=offsets, shapes=shapes, imResize=np.int64(imResize))
+        return ImageStore(path)
+
+
+def open_image_store(store_dir, rootdir, split, imResize, manifest=None):
+    """Opens the store serving `split`, building it from the raw images if it does not exist yet."""
+    if split == 'test':
+        impath = os.path.join(rootdir, 'test_data')
+        meta_file = os.path.join(impath, 'test_meta.txt')
+        path = os.path.join(store_dir, 'test_data')
+    else:
+        impath = os.path.join(rootdir, 'train/train_data')
+        meta_file = os.path.join(rootdir, 'train/train_label')
+        path = os.path.join(store_dir, 'train_data')
+
+    if os.path.exists(path + '.idx.npz'):
+        store = ImageStore(path)
+    else:
+        os.makedirs(store_dir, exist_ok=True)
+        print('building image store {}'.format(path))
+        if manifest is None:
+            manifest = DatasetManifest.compile(meta_file, impath)
+        store = ImageStore.build(impath, manifest.filenames[manifest.exists].tolist(), path, imResize)
+
+    if store.imResize != imResize:
+        raise ValueError('image store {} was built with imResize={}, not {}'.format(path, store.imResize, imResize))
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the pre-decoded image store')
+    parser.add_argument('--root', default='fashion_demo', type=str, help='dataset root')
+    parser.add_argument('--out', default='image_store', type=str, help='output directory of the store')
+    parser.add_argument('--imResize', default=256, type=int, help='')
+    parser.add_argument('--splits', default='train,test', type=str, help='comma separated: train, test')
+    args = parser.parse_args()
+
+    for split in args.splits.split(','):
+        store = open_image_store(args.out, args.root, split, args.imResize)
+        print('{}: {} images, {:.1f} MB'.format(split, len(store), store.data.size / 2**20))
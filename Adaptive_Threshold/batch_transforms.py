@@ -0,0 +1,151 @@
+"""
+Batch-level image transforms.
+
+With the uint8 pipeline the DataLoader workers stop after cropping and hand over uint8 CHW
+tensors (a quarter of the bytes of float32 through shared memory, pinned memory and the
+host-to-device copy). Conversion, normalization and flips then run as a single batched op on
+whatever device the batch has been moved to.
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+
+class ToUint8Tensor(object):
+    """Converts a PIL image to a uint8 CHW tensor. Worker-side replacement for ToTensor + Normalize."""
+
+    def __call__(self, img):
+        return torch.from_numpy(np.array(img, dtype=np.uint8, copy=True)).permute(2, 0, 1).contiguous()
+
+
+def uint8_collate(batch):
+    """default_collate that refuses float images, so a stray ToTensor() in a worker
+    chain cannot silently bring back the float32 traffic."""
+    elem = batch[0]
+    if isinstance(elem, torch.Tensor) and elem.dim() == 3 and elem.dtype != torch.uint8:
+        raise TypeError('uint8_collate expects uint8 images, got {}'.format(elem.dtype))
+    if isinstance(elem, (tuple, list)):
+        return [uint8_collate(samples) for samples in zip(*batch)]
+    return default_collate(batch)
+
+
+class DeviceNormalize(object):
+    """uint8 NCHW batch -> normalized float batch, with optional per-sample random flips.
+
+    (x / 255 - mean) / std is folded into one multiply-add, and flips are applied with a
+    per-sample mask, so the whole batch is handled by a few kernels on its own device.
+    """
+
+    def __init__(self, mean, std, hflip=False, vflip=False):
+        self.scale = 1.0 / (255.0 * torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1))
+        self.shift = -torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1) / torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.hflip = hflip
+        self.vflip = vflip
+
+    def _flip(self, x, dim):
+        mask = torch.rand(x.size(0), device=x.device) < 0.5
+        return torch.where(mask.view(-1, 1, 1, 1), x.flip(dim), x)
+
+    def __call__(self, batch):
+        if self.scale.device != batch.device:
+            self.scale = self.scale.to(batch.device)
+            self.shift = self.shift.to(batch.device)
+        # flip while still uint8, then convert once
+        x = batch
+        if self.hflip:
+            x = self._flip(x, 3)
+        if self.vflip:
+            x = self._flip(x, 2)
+        return x.float().mul_(self.scale).add_(self.shift)
+
+
+def pad_collate(batch):
+    """Collates uint8 CHW images of different sizes into one zero-padded NCHW batch.
+
+    Returns the padded batch and an (N, 2) int64 tensor with the (height, width) of every image.
+    """
+    sizes = torch.tensor([img.shape[1:] for img in batch], dtype=torch.int64)
+    height, width = sizes.max(0)[0].tolist()
+    out = torch.zeros(len(batch), batch[0].size(0), height, width, dtype=torch.uint8)
+    for i, img in enumerate(batch):
+        out[i, :, :img.size(1), :img.size(2)] = img
+    return out, sizes
+
+
+class BatchAugment(object):
+    """K independently augmented views of a padded uint8 batch in one vectorized pass.
+
+    Every view gets its own RandomResizedCrop box (sampled like torchvision, ten attempts and
+    the same center-crop fallback) and random flips. The K*N crop boxes are turned into affine
+    sampling grids and stacked along the output height, so all views of the batch are produced
+    by a single grid_sample call; flips are masked selects and normalization one multiply-add
+    (see DeviceNormalize). On CPU tensors every op runs on torch's intra-op thread pool.
+
+    K is 2 for MixMatch (TransformTwice), 4 for TransformFourth and can be larger.
+    Unlike the PIL resize, the bilinear resample is not antialiased when a crop is shrunk.
+    """
+
+    def __init__(self, size, mean, std, views=2, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), hflip=True, vflip=True):
+        self.size = size
+        self.views = views
+        self.scale = scale
+        self.ratio = ratio
+        self.normalize = DeviceNormalize(mean, std, hflip=hflip, vflip=vflip)
+
+    def sample_boxes(self, sizes, views, attempts=10):
+        """Returns (x0, y0, w, h) float tensors of shape (N * views,), view-major per sample."""
+        device = sizes.device
+        height = sizes[:, 0].double().repeat_interleave(views)
+        width = sizes[:, 1].double().repeat_interleave(views)
+        area = height * width
+        m = area.size(0)
+
+        target_area = area.unsqueeze(1) * torch.empty(m, attempts, dtype=torch.float64, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(m, attempts, dtype=torch.float64, device=device).uniform_(np.log(self.ratio[0]), np.log(self.ratio[1]))
+        aspect = torch.exp(log_ratio)
+        w = torch.round(torch.sqrt(target_area * aspect))
+        h = torch.round(torch.sqrt(target_area / aspect))
+        ok = (w > 0) & (h > 0) & (w <= width.unsqueeze(1)) & (h <= height.unsqueeze(1))
+
+        # first valid attempt per sample
+        first = torch.argmax(ok.to(torch.uint8), dim=1, keepdim=True)
+        w = w.gather(1, first).squeeze(1)
+        h = h.gather(1, first).squeeze(1)
+        found = ok.any(1)
+
+        # fallback to the central crop, as torchvision does
+        in_ratio = width / height
+        fw = torch.where(in_ratio < self.ratio[0], width, torch.where(in_ratio > self.ratio[1], torch.round(height * self.ratio[1]), width))
+        fh = torch.where(in_ratio < self.ratio[0], torch.round(width / self.ratio[0]), height)
+        w = torch.where(found, w, fw)
+        h = torch.where(found, h, fh)
+
+        x0 = torch.where(found, torch.floor(torch.rand(m, dtype=torch.float64, device=device) * (width - w + 1)), torch.round((width - w) / 2))
+        y0 = torch.where(found, torch.floor(torch.rand(m, dtype=torch.float64, device=device) * (height - h + 1)), torch.round((height - h) / 2))
+        return x0, y0, w, h
+
+    def __call__(self, batch, sizes):
+        n, c, canvas_h, canvas_w = batch.size()
+        k = self.views
+        x0, y0, w, h = self.sample_boxes(sizes, k)
+
+        # pixel box -> affine map from the output square onto the padded canvas (align_corners=False)
+        theta = torch.zeros(n * k, 2, 3, dtype=torch.float32, device=batch.device)
+        theta[:, 0, 0] = (w / canvas_w).float()
+        theta[:, 0, 2] = ((2 * x0 + w) / canvas_w - 1).float()
+        theta[:, 1, 1] = (h / canvas_h).float()
+        theta[:, 1, 2] = ((2 * y0 + h) / canvas_h - 1).float()
+        grid = F.affine_grid(theta, [n * k, c, self.size, self.size], align_corners=False)
+        # keep the bilinear taps inside every image so the zero padding never bleeds into a crop
+        max_x = ((2 * sizes[:, 1].float() - 1) / canvas_w - 1).repeat_interleave(k).view(-1, 1, 1)
+        max_y = ((2 * sizes[:, 0].float() - 1) / canvas_h - 1).repeat_interleave(k).view(-1, 1, 1)
+        grid[..., 0] = torch.min(grid[..., 0], max_x)
+        grid[..., 1] = torch.min(grid[..., 1], max_y)
+        grid = grid.view(n, k * self.size, self.size, 2)
+
+        out = F.grid_sample(batch.float(), grid, mode='bilinear', padding_mode='border', align_corners=False)
+        out = out.view(n, c, k, self.size, self.size).transpose(1, 2).reshape(n * k, c, self.size, self.size)
+        out = self.normalize(out)
+        return out.view(n, k, c, self.size, self.size).unbind(1)
@@ -0,0 +1,802 @@
+"""
+Benchmarks for the data pipeline and the training step.
+They run on synthetic data, so neither nsml nor the fashion dataset is needed.
+
+    python benchmark.py memory --num_images 200000 --num_workers 4
+    python benchmark.py decode --image_dir fashion_demo/train/train_data
+    python benchmark.py select --batch_sizes 50,128,256,512
+    python benchmark.py forward --batchsize 32 --batchsize2 64
+    python benchmark.py loss --batchsize 32 --batchsize2 64
+    python benchmark.py mixup --batchsize 20 --batchsize2 50 --steps 500
+    python benchmark.py report --steps 500 --reports 3
+    python benchmark.py fuse --archs efficientnet-b0,efficientnet-b3 --batchsize 8
+    python benchmark.py padding --imsizes 224,256 --batchsize 16
+    python benchmark.py checkpoint --batchsize 20 --batchsize2 50 --segments 0,1,2,4,8
+    python benchmark.py backbone --archs efficientnet-b3,res18,res50,dense121 --batch_sizes 32,48
+    python benchmark.py precision --steps 300
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import json
+import math
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+import torch.utils.data
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+from ImageDataLoader import SimpleImageLoader, DatasetManifest
+from ImageDataLoader import default_image_loader, lazy_image_loader, DraftResize, DraftRandomResizedCrop
+from pseudo_label import PseudoLabelSelector
+from fused_forward import fused_forward
+from losses import autocast, guess_labels, mixup, soft_cross_entropy, softmax_mse, MixupBuffers
+from metrics import DeviceMeter
+from reporting import Session, LocalNSML
+
+
+def _proc_memory_mb():
+    """Returns (rss, private_dirty) of the current process in MB."""
+    values = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if key in ('Rss', 'Private_Dirty'):
+                values[key] = int(value.split()[0]) / 1024.
+    return values['Rss'], values['Private_Dirty']
+
+
+def _synthetic_manifest(num_images, num_classes=265):
+    ids = np.arange(num_images, dtype=np.int64)
+    labels = np.random.randint(num_classes, size=num_images).astype(np.int64)
+    # 32 hex digits like the md5 names of the real dataset
+    filenames = np.array(['{:032x}.jpg'.format(i * 2654435761) for i in range(num_images)], dtype=np.str_)
+    return DatasetManifest(ids, labels, filenames, np.ones(num_images, dtype=bool))
+
+
+class _MemoryProbe(torch.utils.data.Dataset):
+    """Touches the sample's name and label, then reports the worker's memory instead of the image."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        filename = self.dataset.imnames[index]
+        label = int(self.dataset.imclasses[index])
+        worker = torch.utils.data.get_worker_info()
+        rss, private = _proc_memory_mb()
+        return worker.id if worker is not None else -1, rss, private, label + len(filename)
+
+
+def bench_memory(args):
+    manifest = _synthetic_manifest(args.num_images)
+    dataset = SimpleImageLoader(tempfile.gettempdir(), 'train', manifest=manifest)
+
+    layouts = {'packed': (dataset.imnames, dataset.imclasses),
+               'list': ([dataset.imnames[i] for i in range(len(dataset))], dataset.imclasses.tolist())}
+    for layout in args.layouts.split(','):
+        dataset.imnames, dataset.imclasses = layouts[layout]
+        loader = torch.utils.data.DataLoader(_MemoryProbe(dataset), batch_size=args.batchsize, shuffle=True,
+                                             num_workers=args.num_workers)
+        first, last = {}, {}
+        for workers, rss, private, _ in loader:
+            for w, r, p in zip(workers.tolist(), rss.tolist(), private.tolist()):
+                first.setdefault(w, (r, p))
+                last[w] = (r, p)
+
+        print('[{}] {} images, {} workers'.format(layout, len(dataset), args.num_workers))
+        for w in sorted(first):
+            print('  worker {}: RSS {:8.1f} -> {:8.1f} MB   private dirty {:8.1f} -> {:8.1f} MB'.format(
+                w, first[w][0], last[w][0], first[w][1], last[w][1]))
+
+
+def _synthetic_jpegs(directory, num_images, width, height):
+    # smooth random images, closer to product photos than white noise
+    paths = []
+    for i in range(num_images):
+        low = torch.rand(1, 3, height // 32, width // 32) * 255
+        img = F.interpolate(low, size=(height, width), mode='bilinear', align_corners=False)
+        img = img[0].round().clamp(0, 255).to(torch.uint8).permute(1, 2, 0).numpy()
+        paths.append(os.path.join(directory, '{:05d}.jpg'.format(i)))
+        Image.fromarray(img).save(paths[-1], quality=90)
+    return paths
+
+
+def bench_decode(args):
+    if args.image_dir:
+        paths = sorted(os.path.join(args.image_dir, f) for f in os.listdir(args.image_dir)
+                       if f.lower().endswith(('.jpg', '.jpeg')))[:args.num_images]
+    else:
+        paths = _synthetic_jpegs(tempfile.mkdtemp(), args.num_images, args.width, args.height)
+    sizes = [Image.open(p).size for p in paths]
+    print('{} images, mean size {:.0f}x{:.0f}'.format(len(paths), np.mean([s[0] for s in sizes]), np.mean([s[1] for s in sizes])))
+
+    pipelines = [
+        ('full  Resize+RandomResizedCrop', default_image_loader,
+         transforms.Compose([transforms.Resize(args.imResize), transforms.RandomResizedCrop(args.imsize)])),
+        ('draft Resize+RandomResizedCrop', lazy_image_loader,
+         transforms.Compose([DraftResize(args.imResize), transforms.RandomResizedCrop(args.imsize)])),
+        ('crop  RandomResizedCrop', lazy_image_loader, DraftRandomResizedCrop(args.imResize, args.imsize)),
+        ('full  Resize+CenterCrop', default_image_loader,
+         transforms.Compose([transforms.Resize(args.imResize), transforms.CenterCrop(args.imsize)])),
+        ('draft Resize+CenterCrop', lazy_image_loader,
+         transforms.Compose([DraftResize(args.imResize), transforms.CenterCrop(args.imsize)])),
+    ]
+    baseline = {}
+    for name, loader, transform in pipelines:
+        start = time.time()
+        for _ in range(args.repeat):
+            for path in paths:
+                transform(loader(path))
+        rate = args.repeat * len(paths) / (time.time() - start)
+        kind = 'CenterCrop' in name
+        baseline.setdefault(kind, rate)
+        print('{:<34}{:8.1f} images/s ({:.2f}x)'.format(name, rate, rate / baseline[kind]))
+
+
+def _loop_select(pred_u_all, percentile, min_threshold):
+    # the per-sample selection loop train() used before PseudoLabelSelector
+    mixup_idx = []
+    threshold_size = int(pred_u_all.size(0) * percentile)
+    crit = torch.max(pred_u_all, axis=1)
+    prec_idx = torch.argsort(crit[0], descending=True)[:threshold_size]
+    for i in prec_idx:
+        if crit[0][i] >= min_threshold:
+            mixup_idx.append(i.item())
+    return pred_u_all[mixup_idx]
+
+
+def _time_step(fn, device, iters):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def bench_select(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    selector = PseudoLabelSelector('adaptive', min_threshold=args.min_threshold)
+    percentile_t = torch.tensor(args.percentile, device=device)
+    print('device {}, {} classes, percentile {}, min_threshold {}'.format(device, args.num_classes, args.percentile, args.min_threshold))
+    print('{:>10}{:>14}{:>18}{:>18}'.format('batchsize2', 'loop (ms)', 'indices (ms)', 'mask (ms)'))
+    for n in [int(b) for b in args.batch_sizes.split(',')]:
+        # peaked softmax outputs, so a part of the batch passes min_threshold
+        probs = torch.softmax(torch.randn(n, args.num_classes, device=device) * 4, dim=1)
+        loop = _time_step(lambda: _loop_select(probs, args.percentile, args.min_threshold), device, args.iters)
+        indices = _time_step(lambda: probs[selector(probs, args.percentile)], device, args.iters)
+        mask = _time_step(lambda: selector.mask(probs, percentile_t), device, args.iters)
+        print('{:>10}{:>14.3f}{:>18.3f}{:>18.3f}'.format(n, loop, indices, mask))
+
+
+def _chunked_step(model, inputs_x, inputs_u1, inputs_u2, mixed, batch_size):
+    # label guessing and the mixed forward as train() runs them without --fused_forward
+    with torch.no_grad():
+        model(inputs_u1)
+        model(inputs_u2)
+    logits = [model(chunk)[1] for chunk in torch.split(mixed, batch_size)]
+    return torch.cat(logits, dim=0)
+
+
+def _fused_step(model, inputs_x, inputs_u1, inputs_u2, mixed, batch_size, bn_mode):
+    batch_size_u = inputs_u1.size(0)
+    with torch.no_grad():
+        fused_forward(model, torch.cat([inputs_u1, inputs_u2], dim=0), batch_size_u, 'full' if bn_mode == 'full' else 'chunk')
+    return fused_forward(model, mixed, batch_size, bn_mode)[1]
+
+
+def bench_forward(args):
+    from efficientnet_pytorch import EfficientNet
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # no dropout or drop connect, so that the modes can be compared output for output
+    model = EfficientNet.from_name(args.arch, override_params={'num_classes': 265, 'dropout_rate': 0.0, 'drop_connect_rate': None})
+    model.to(device).train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9)
+
+    inputs_x = torch.randn(args.batchsize, 3, args.imsize, args.imsize, device=device)
+    inputs_u1 = torch.randn(args.batchsize2, 3, args.imsize, args.imsize, device=device)
+    inputs_u2 = torch.randn(args.batchsize2, 3, args.imsize, args.imsize, device=device)
+    mixed = torch.cat([inputs_x, inputs_u1, inputs_u2], dim=0)
+
+    steps = [('chunked loop', lambda: _chunked_step(model, inputs_x, inputs_u1, inputs_u2, mixed, args.batchsize))]
+    for bn_mode in ('chunk', 'interleave', 'full'):
+        steps.append(('fused, bn_mode={}'.format(bn_mode),
+                      lambda bn_mode=bn_mode: _fused_step(model, inputs_x, inputs_u1, inputs_u2, mixed, args.batchsize, bn_mode)))
+
+    # outputs first, before the timed steps start updating the weights
+    with torch.no_grad():
+        reference = steps[0][1]()
+        diffs = [(step() - reference).abs().max().item() for _, step in steps]
+    print('{} on {}, batchsize {}, batchsize2 {}, {} mixed samples'.format(args.arch, device, args.batchsize, args.batchsize2, mixed.size(0)))
+    print('{:<26}{:>12}{:>16}{:>20}'.format('', 'step (ms)', 'peak mem (MB)', 'max |logit diff|'))
+    for (name, step), diff in zip(steps, diffs):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_max_memory_allocated()
+
+        def train_step():
+            optimizer.zero_grad()
+            step().logsumexp(1).mean().backward()
+            optimizer.step()
+        elapsed = _time_step(train_step, device, args.iters)
+        memory = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+        print('{:<26}{:>12.1f}{:>16.0f}{:>20.2e}'.format(name, elapsed, memory, diff))
+
+
+def _reference_loss(pred_u1, pred_u2, logits, targets_x, index, lamda, T, batch_size, unlabeled_loss):
+    # label guessing, mixup and SemiLoss as main.py wrote them before losses.py
+    pred_u_all = (torch.softmax(pred_u1, dim=1) + torch.softmax(pred_u2, dim=1)) / 2
+    pt = pred_u_all**(1/T)
+    targets_u = pt / pt.sum(dim=1, keepdim=True)
+    all_targets = torch.cat([targets_x, targets_u, targets_u], dim=0)
+    mixed_target = lamda * all_targets + (1 - lamda) * all_targets[index]
+    logits_x, logits_u = logits[:batch_size], logits[batch_size:]
+    Lx = -torch.mean(torch.sum(F.log_softmax(logits_x, dim=1) * mixed_target[:batch_size], dim=1))
+    if unlabeled_loss == 'CEE':
+        Lu = -torch.mean(torch.sum(F.log_softmax(logits_u, dim=1) * mixed_target[batch_size:], dim=1))
+    else:
+        Lu = torch.mean((torch.softmax(logits_u, dim=1) - mixed_target[batch_size:])**2)
+    return Lx, Lu
+
+
+def _fused_loss(pred_u1, pred_u2, logits, targets_x, index, lamda, T, batch_size, unlabeled_loss):
+    _, targets_u = guess_labels(pred_u1, pred_u2, T)
+    mixed_target = mixup(torch.cat([targets_x, targets_u, targets_u], dim=0), index, lamda)
+    logits_x, logits_u = logits[:batch_size], logits[batch_size:]
+    Lx = soft_cross_entropy(logits_x, mixed_target[:batch_size])
+    if unlabeled_loss == 'CEE':
+        Lu = soft_cross_entropy(logits_u, mixed_target[batch_size:])
+    else:
+        Lu = softmax_mse(logits_u, mixed_target[batch_size:])
+    return Lx, Lu
+
+
+def bench_loss(args):
+    devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+    n = args.batchsize + 2 * args.batchsize2
+    lamda = 0.7
+    print('batchsize {}, batchsize2 {}, {} classes, T={}, lamda={}'.format(args.batchsize, args.batchsize2, args.num_classes, args.T, lamda))
+    print('{:<8}{:<6}{:<10}{:>12}{:>16}{:>14}{:>14}'.format('device', 'Lu', 'version', 'step (ms)', 'peak mem (MB)', 'max |L diff|', 'max |g diff|'))
+    for device in devices:
+        pred_u1 = torch.randn(args.batchsize2, args.num_classes, device=device) * 3
+        pred_u2 = torch.randn(args.batchsize2, args.num_classes, device=device) * 3
+        targets_x = torch.zeros(args.batchsize, args.num_classes, device=device)
+        targets_x[torch.arange(args.batchsize), torch.randint(args.num_classes, (args.batchsize,))] = 1
+        logits = torch.randn(n, args.num_classes, device=device, requires_grad=True)
+        index = torch.randperm(n, device=device)
+
+        for unlabeled_loss in ('CEE', 'MSE'):
+            versions = [('former', _reference_loss), ('fused', _fused_loss)]
+            results = []
+            for _, fn in versions:
+                logits.grad = None
+                Lx, Lu = fn(pred_u1, pred_u2, logits, targets_x, index, lamda, args.T, args.batchsize, unlabeled_loss)
+                (Lx + args.lambda_u * Lu).backward()
+                results.append((torch.stack([Lx, Lu]).detach(), logits.grad.clone()))
+
+            for (name, fn), (loss, grad) in zip(versions, results):
+                loss_diff = (loss - results[0][0]).abs().max().item()
+                grad_diff = (grad - results[0][1]).abs().max().item()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_max_memory_allocated()
+                    base = torch.cuda.memory_allocated()
+
+                def step():
+                    logits.grad = None
+                    Lx, Lu = fn(pred_u1, pred_u2, logits, targets_x, index, lamda, args.T, args.batchsize, unlabeled_loss)
+                    (Lx + args.lambda_u * Lu).backward()
+                elapsed = _time_step(step, device, args.iters)
+                memory = (torch.cuda.max_memory_allocated() - base) / 2**20 if device.type == 'cuda' else float('nan')
+                print('{:<8}{:<6}{:<10}{:>12.3f}{:>16.2f}{:>14.2e}{:>14.2e}'.format(device.type, unlabeled_loss, name, elapsed, memory, loss_diff, grad_diff))
+
+
+def _allocator_stats(device):
+    # (cudaMalloc calls, block allocations) so far, None where this torch has no memory_stats()
+    if device.type != 'cuda' or not hasattr(torch.cuda, 'memory_stats'):
+        return None
+    stats = torch.cuda.memory_stats(device)
+    return stats.get('segment.all.allocated', 0), stats.get('allocation.all.allocated', 0)
+
+
+def bench_mixup(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # a convolution stands in for the model, so that its activations compete with the mixup tensors for the cache
+    conv = torch.nn.Conv2d(3, 32, 3, stride=2, padding=1).to(device)
+    rng = np.random.RandomState(0)
+    kept = rng.randint(0, args.batchsize2 + 1, size=args.steps)
+    lamdas = rng.beta(0.75, 0.75, size=args.steps)
+    lamdas = np.maximum(lamdas, 1 - lamdas)
+
+    inputs_x = torch.randn(args.batchsize, 3, args.imsize, args.imsize, device=device)
+    targets_x = torch.softmax(torch.randn(args.batchsize, args.num_classes, device=device), dim=1)
+    inputs_u = torch.randn(args.batchsize2, 3, args.imsize, args.imsize, device=device)
+    targets_u = torch.softmax(torch.randn(args.batchsize2, args.num_classes, device=device), dim=1)
+
+    def former(step):
+        k = kept[step]
+        all_inputs = torch.cat([inputs_x, inputs_u[:k], inputs_u[:k]], dim=0)
+        all_targets = torch.cat([targets_x, targets_u[:k], targets_u[:k]], dim=0)
+        newidx = torch.randperm(all_inputs.size(0))
+        return mixup(all_inputs, newidx, lamdas[step]), mixup(all_targets, newidx, lamdas[step])
+
+    buffers = MixupBuffers(args.batchsize + 2 * args.batchsize2)
+
+    def reused(step):
+        k = kept[step]
+        return buffers(inputs_x, targets_x, inputs_u[:k], inputs_u[:k], targets_u[:k], lamdas[step])
+
+    print('{} steps on {}, batchsize {}, 0 to {} kept unlabeled samples per step'.format(args.steps, device, args.batchsize, args.batchsize2))
+    print('{:<10}{:>12}{:>16}{:>18}{:>14}{:>14}'.format('', 'step (ms)', 'peak mem (MB)', 'reserved (MB)', 'cudaMalloc', 'allocations'))
+    for name, mix in (('former', former), ('buffers', reused)):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.empty_cache()
+            torch.cuda.reset_max_memory_allocated()
+        before = _allocator_stats(device)
+        start = time.time()
+        for step in range(args.steps):
+            mixed_input, mixed_target = mix(step)
+            out = conv(mixed_input)
+            out.mean().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.time() - start) / args.steps * 1000
+        after = _allocator_stats(device)
+        peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+        reserved = (torch.cuda.memory_reserved() if hasattr(torch.cuda, 'memory_reserved') else torch.cuda.memory_cached()) / 2**20 if device.type == 'cuda' else float('nan')
+        mallocs, allocs = [after[i] - before[i] for i in range(2)] if before is not None else ('n/a', 'n/a')
+        print('{:<10}{:>12.2f}{:>16.0f}{:>18.0f}{:>14}{:>14}'.format(name, elapsed, peak, reserved, mallocs, allocs))
+
+
+def bench_report(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 32, 3, stride=2, padding=1), torch.nn.ReLU(),
+                                torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(32, args.num_classes)).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    inputs = torch.randn(args.batchsize, 3, args.imsize, args.imsize, device=device)
+    targets = torch.randint(0, args.num_classes, (args.batchsize,), device=device)
+    directory = tempfile.mkdtemp()
+
+    def synchronous(name):
+        # the former pattern: float() on every metric and a blocking write per call
+        path = os.path.join(directory, name + '.jsonl')
+
+        def report(step, **metrics):
+            values = {key: float(value) for key, value in metrics.items()}
+            with open(path, 'a') as f:
+                f.write(json.dumps(dict(values, step=step)) + '\n')
+        return report
+
+    def buffered(name):
+        session = Session(LocalNSML())
+        session.configure(os.path.join(directory, name), args.report_interval)
+        return session
+
+    print('{} steps on {}, batchsize {}, {} reports of 3 metrics per step'.format(args.steps, device, args.batchsize, args.reports))
+    print('{:<14}{:>12}{:>14}'.format('', 'steps/s', 'overhead'))
+    baseline = None
+    for name in ('off', 'synchronous', 'buffered'):
+        losses, conf_avg, conf_min = DeviceMeter(), DeviceMeter(), DeviceMeter()
+        session = None
+        if name == 'synchronous':
+            report = synchronous(name)
+        elif name == 'buffered':
+            session = buffered(name)
+            report = lambda step, **metrics: session.report(summary=True, step=step, **metrics)
+        for step in range(args.steps + args.warmup):
+            if step == args.warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            logits = model(inputs)
+            loss = F.cross_entropy(logits, targets)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            probs = torch.softmax(logits.detach(), dim=1).max(dim=1)[0]
+            losses.update(loss, inputs.size(0))
+            conf_avg.update(probs.mean())
+            conf_min.update(probs.min())
+            if name != 'off':
+                for _ in range(args.reports):
+                    report(step, losses=losses.avg, conf_avg=conf_avg.avg, conf_min=conf_min.avg)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        rate = args.steps / (time.time() - start)
+        if session is not None:
+            session.close()
+        baseline = baseline or rate
+        print('{:<14}{:>12.1f}{:>13.1f}%'.format(name, rate, (baseline / rate - 1) * 100))
+
+
+def bench_fuse(args):
+    from efficientnet_pytorch import EfficientNet
+
+    torch.manual_seed(0)
+    print('CPU, {} threads, batchsize {}, {}x{} inputs'.format(torch.get_num_threads(), args.batchsize, args.imsize, args.imsize))
+    print('{:<18}{:>14}{:>14}{:>10}{:>20}{:>14}'.format('', 'eval (ms)', 'fused (ms)', 'speedup', 'max |logit diff|', 'same top-1'))
+    failed = []
+    for arch in args.archs.split(','):
+        model = EfficientNet.from_name(arch, override_params={'num_classes': 265})
+        # trained-looking statistics, the defaults (mean 0, var 1, weight 1, bias 0) would make the folding trivial
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.normal_(0, 0.1)
+                m.running_var.uniform_(0.5, 2.0)
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.normal_(0, 0.1)
+        model.eval()
+        fused = model.fuse_for_inference()
+        inputs = torch.randn(args.batchsize, 3, args.imsize, args.imsize)
+        with torch.no_grad():
+            reference = model(inputs)[1]
+            outputs = fused(inputs)[1]
+            diff = (outputs - reference).abs().max().item()
+            same = (outputs.argmax(1) == reference.argmax(1)).float().mean().item()
+            eval_ms = _time_step(lambda: model(inputs), torch.device('cpu'), args.iters)
+            fused_ms = _time_step(lambda: fused(inputs), torch.device('cpu'), args.iters)
+        print('{:<18}{:>14.1f}{:>14.1f}{:>9.2f}x{:>20.2e}{:>13.0f}%'.format(arch, eval_ms, fused_ms, eval_ms / fused_ms, diff, same * 100))
+        if diff > args.atol + args.rtol * reference.abs().max().item() or same < args.min_agreement:
+            failed.append(arch)
+    if failed:
+        sys.exit('fused logits out of tolerance for {}'.format(', '.join(failed)))
+
+
+def _former_dynamic_forward(conv, x):
+    # Conv2dDynamicSamePadding.forward before the padding cache
+    ih, iw = x.size()[-2:]
+    kh, kw = conv.weight.size()[-2:]
+    sh, sw = conv.stride
+    oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
+    pad_h = max((oh - 1) * sh + (kh - 1) * conv.dilation[0] + 1 - ih, 0)
+    pad_w = max((ow - 1) * sw + (kw - 1) * conv.dilation[1] + 1 - iw, 0)
+    if pad_h > 0 or pad_w > 0:
+        x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
+    return F.conv2d(x, conv.weight, conv.bias, conv.stride, 0, conv.dilation, conv.groups)
+
+
+def _former_static_forward(conv, x):
+    # Conv2dStaticSamePadding.forward before symmetric padding went into the convolution
+    if isinstance(conv.static_padding, torch.nn.ZeroPad2d):
+        pad = list(conv.static_padding.padding)
+    else:
+        pad = [conv.padding[1], conv.padding[1], conv.padding[0], conv.padding[0]]
+    if any(pad):
+        x = F.pad(x, pad)
+    return F.conv2d(x, conv.weight, conv.bias, conv.stride, 0, conv.dilation, conv.groups)
+
+
+def _pad_ops(model, inputs):
+    # number of padded copies made by one forward
+    with torch.autograd.profiler.profile() as prof:
+        model(inputs)
+    return sum(1 for event in prof.function_events if event.name == 'constant_pad_nd')
+
+
+def bench_padding(args):
+    from efficientnet_pytorch import EfficientNet
+    from efficientnet_pytorch.utils import Conv2dDynamicSamePadding, Conv2dStaticSamePadding
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('{} on {}, batchsize {}, forward in eval mode'.format(args.arch, device, args.batchsize))
+    print('{:<10}{:<10}{:<10}{:>10}{:>14}{:>14}{:>12}{:>16}'.format('imsize', 'convs', '', 'pad ops', 'cudaMalloc', 'allocations', 'ms', 'max |diff|'))
+    for conv_type, image_size in (('static', EfficientNet.get_image_size(args.arch)), ('dynamic', None)):
+        model = EfficientNet.from_name(args.arch, override_params={'num_classes': 265, 'image_size': image_size})
+        model.to(device).eval()
+        former = copy.deepcopy(model)
+        for m in former.modules():
+            if isinstance(m, Conv2dDynamicSamePadding):
+                m.forward = lambda x, m=m: _former_dynamic_forward(m, x)
+            elif isinstance(m, Conv2dStaticSamePadding):
+                m.forward = lambda x, m=m: _former_static_forward(m, x)
+        for imsize in [int(v) for v in args.imsizes.split(',')]:
+            inputs = torch.randn(args.batchsize, 3, imsize, imsize, device=device)
+            with torch.no_grad():
+                reference = former(inputs)[1]
+                for name, net in (('former', former), ('cached', model)):
+                    diff = (net(inputs)[1] - reference).abs().max().item()
+                    pads = _pad_ops(net, inputs)
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    before = _allocator_stats(device)
+                    net(inputs)
+                    after = _allocator_stats(device)
+                    mallocs, allocs = [after[i] - before[i] for i in range(2)] if before is not None else ('n/a', 'n/a')
+                    elapsed = _time_step(lambda: net(inputs), device, args.iters)
+                    print('{:<10}{:<10}{:<10}{:>10}{:>14}{:>14}{:>12.1f}{:>16.2e}'.format(imsize, conv_type, name, pads, mallocs, allocs, elapsed, diff))
+
+
+def bench_checkpoint(args):
+    from efficientnet_pytorch import EfficientNet
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # drop connect stays on, the recompute has to drop the same samples
+    initial = EfficientNet.from_name(args.arch, override_params={'num_classes': 265, 'dropout_rate': 0.0})
+    initial.to(device).train()
+    mixed = torch.randn(args.batchsize + 2 * args.batchsize2, 3, args.imsize, args.imsize, device=device)
+
+    def step(model):
+        model.zero_grad()
+        fused_forward(model, mixed, args.batchsize, 'chunk')[1].logsumexp(1).mean().backward()
+
+    print('{} on {}, {} mixed samples, {} blocks'.format(args.arch, device, mixed.size(0), len(initial._blocks)))
+    print('{:<16}{:>12}{:>16}{:>18}{:>20}'.format('blocks/segment', 'step (ms)', 'peak mem (MB)', 'max |grad diff|', 'max |running diff|'))
+    reference = None
+    for n in [int(v) for v in args.segments.split(',')]:
+        model = copy.deepcopy(initial)
+        model.set_checkpointing(n)
+        torch.manual_seed(0)
+        step(model)
+        grads = [p.grad.clone() for p in model.parameters()]
+        running = [b.clone() for name, b in model.named_buffers() if 'running' in name]
+        if reference is None:
+            reference = grads, running
+        grad_diff = max((g - r).abs().max().item() for g, r in zip(grads, reference[0]))
+        running_diff = max((b - r).abs().max().item() for b, r in zip(running, reference[1]))
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_max_memory_allocated()
+        elapsed = _time_step(lambda: step(model), device, args.iters)
+        memory = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+        print('{:<16}{:>12.1f}{:>16.0f}{:>18.2e}{:>20.2e}'.format(n if n > 0 else 'off', elapsed, memory, grad_diff, running_diff))
+
+
+def _backbone(arch):
+    from efficientnet_pytorch import EfficientNet
+    from models import Res18, Res50, Dense121
+
+    if arch.startswith('efficientnet'):
+        return EfficientNet.from_name(arch, override_params={'num_classes': 265})
+    return {'res18': Res18, 'res50': Res50, 'dense121': Dense121}[arch](265, pretrained=False)
+
+
+def bench_backbone(args):
+    from models import set_execution_mode
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batch_sizes = [int(v) for v in args.batch_sizes.split(',')]
+    modes = [('eager', False, 'none'), ('channels_last', True, 'none'), ('trace', False, 'trace'),
+             ('channels_last+trace', True, 'trace'), ('compile', False, 'compile'), ('channels_last+compile', True, 'compile')]
+    print('{} on {}, batch sizes {} in turn, images/s'.format(args.archs, device, batch_sizes))
+    print('{:<18}{:<24}{:>14}{:>20}'.format('', '', 'forward', 'forward+backward'))
+    for arch in args.archs.split(','):
+        for name, channels_last, graph in modes:
+            model = _backbone(arch).to(device)
+            try:
+                set_execution_mode(model, channels_last, graph)
+            except ValueError as e:
+                print('{:<18}{:<24}{:>34}'.format(arch, name, str(e)))
+                continue
+            inputs = [torch.randn(n, 3, args.imsize, args.imsize, device=device) for n in batch_sizes]
+            images = sum(batch_sizes) * args.iters
+
+            def forward():
+                for x in inputs:
+                    model(x)
+
+            def train_step():
+                for x in inputs:
+                    model.zero_grad()
+                    model(x)[1].logsumexp(1).mean().backward()
+
+            model.eval()
+            with torch.no_grad():
+                forward_rate = images / (_time_step(forward, device, args.iters) * args.iters / 1000)
+            model.train()
+            train_rate = images / (_time_step(train_step, device, args.iters) * args.iters / 1000)
+            print('{:<18}{:<24}{:>14.1f}{:>20.1f}'.format(arch, name, forward_rate, train_rate))
+
+
+def _synthetic_task(num_classes, n, imsize, generator):
+    # class prototypes plus noise, with colour and position jitter for the two unlabeled views
+    prototypes = torch.randn(num_classes, 3, imsize, imsize, generator=generator)
+    labels = torch.randint(0, num_classes, (n,), generator=generator)
+    images = prototypes[labels] + 1.5 * torch.randn(n, 3, imsize, imsize, generator=generator)
+    return images, labels
+
+
+def _view(images, generator):
+    return images.roll(int(torch.randint(-2, 3, (1,), generator=generator)), dims=3) + 0.3 * torch.randn(images.shape, generator=generator)
+
+
+def bench_precision(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    generator = torch.Generator().manual_seed(0)
+    images, labels = _synthetic_task(args.num_classes, args.labeled + args.unlabeled + args.test, args.imsize, generator)
+    x_l, y_l = images[:args.labeled], labels[:args.labeled]
+    x_u = images[args.labeled:args.labeled + args.unlabeled]
+    x_t, y_t = images[-args.test:].to(device), labels[-args.test:].to(device)
+
+    print('{} steps on {}, {} labeled and {} unlabeled samples of {} classes, batchsize {}/{}'.format(
+        args.steps, device, args.labeled, args.unlabeled, args.num_classes, args.batchsize, args.batchsize2))
+    print('{:<8}{:>14}{:>14}{:>16}'.format('', 'steps/s', 'final loss', 'test top-1 (%)'))
+    accuracies = {}
+    for precision in ('fp32', 'bf16'):
+        try:
+            autocast(precision, device.type)
+        except ValueError as e:
+            print('{:<8}{:>44}'.format(precision, str(e)))
+            continue
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 32, 3, padding=1), torch.nn.BatchNorm2d(32), torch.nn.ReLU(), torch.nn.MaxPool2d(2),
+            torch.nn.Conv2d(32, 64, 3, padding=1), torch.nn.BatchNorm2d(64), torch.nn.ReLU(),
+            torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(64, args.num_classes)).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        buffers = MixupBuffers(args.batchsize + 2 * args.batchsize2)
+        data = torch.Generator().manual_seed(1)
+        rng = np.random.RandomState(0)
+        start = time.time()
+        for step in range(args.steps):
+            idx_l = torch.randint(0, args.labeled, (args.batchsize,), generator=data)
+            idx_u = torch.randint(0, args.unlabeled, (args.batchsize2,), generator=data)
+            inputs_x = x_l[idx_l].to(device)
+            targets_x = torch.zeros(args.batchsize, args.num_classes, device=device).scatter_(1, y_l[idx_l].view(-1, 1).to(device), 1)
+            inputs_u1, inputs_u2 = _view(x_u[idx_u], data).to(device), _view(x_u[idx_u], data).to(device)
+
+            # the MixMatch step of train(): guess under autocast, sharpen in fp32, mixed forward under autocast, loss in fp32
+            with torch.no_grad():
+                with autocast(precision, device.type):
+                    logits_u = model(torch.cat([inputs_u1, inputs_u2], dim=0))
+                logits_u1, logits_u2 = logits_u.float().split(args.batchsize2)
+                _, targets_u = guess_labels(logits_u1, logits_u2, args.T)
+            lamda = rng.beta(0.75, 0.75)
+            mixed_input, mixed_target = buffers(inputs_x, targets_x, inputs_u1, inputs_u2, targets_u, max(lamda, 1 - lamda))
+            with autocast(precision, device.type):
+                logits = model(mixed_input)
+            logits = logits.float()
+            loss = soft_cross_entropy(logits[:args.batchsize], mixed_target[:args.batchsize]) \
+                + args.lambda_u * softmax_mse(logits[args.batchsize:], mixed_target[args.batchsize:])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        rate = args.steps / (time.time() - start)
+
+        model.eval()
+        with torch.no_grad(), autocast(precision, device.type):
+            accuracy = (model(x_t).argmax(1) == y_t).float().mean().item() * 100
+        print('{:<8}{:>14.1f}{:>14.4f}{:>16.2f}'.format(precision, rate, loss.item(), accuracy))
+        accuracies[precision] = accuracy if np.isfinite(loss.item()) else float('nan')
+
+    if 'bf16' in accuracies and not accuracies['fp32'] - accuracies['bf16'] <= args.max_accuracy_drop:
+        sys.exit('bf16 test accuracy {:.2f}% is more than {} points below fp32 ({:.2f}%) or the loss diverged'.format(
+            accuracies['bf16'], args.max_accuracy_drop, accuracies['fp32']))
+
+
+parser = argparse.ArgumentParser(description='AdThMix benchmarks')
+subparsers = parser.add_subparsers(dest='benchmark')
+
+memory_parser = subparsers.add_parser('memory', help='per-worker memory across one epoch of SimpleImageLoader')
+memory_parser.add_argument('--num_images', default=200000, type=int)
+memory_parser.add_argument('--num_workers', default=4, type=int)
+memory_parser.add_argument('--batchsize', default=256, type=int)
+memory_parser.add_argument('--layouts', default='packed,list', type=str, help='packed: StringTable/ndarray, list: Python lists')
+memory_parser.set_defaults(func=bench_memory)
+
+decode_parser = subparsers.add_parser('decode', help='single-process JPEG decode throughput of the full, draft and crop decoders')
+decode_parser.add_argument('--image_dir', default='', type=str, help='directory of sample JPEGs (default: synthetic images)')
+decode_parser.add_argument('--num_images', default=200, type=int)
+decode_parser.add_argument('--width', default=800, type=int, help='size of the synthetic images')
+decode_parser.add_argument('--height', default=1000, type=int)
+decode_parser.add_argument('--imResize', default=256, type=int)
+decode_parser.add_argument('--imsize', default=224, type=int)
+decode_parser.add_argument('--repeat', default=3, type=int)
+decode_parser.set_defaults(func=bench_decode)
+
+select_parser = subparsers.add_parser('select', help='per-step latency of the pseudo-label selection loop and of PseudoLabelSelector')
+select_parser.add_argument('--batch_sizes', default='50,100,200,300,512', type=str, help='comma separated batchsize2 values')
+select_parser.add_argument('--num_classes', default=265, type=int)
+select_parser.add_argument('--percentile', default=0.6, type=float, help='train accuracy used as percentile')
+select_parser.add_argument('--min_threshold', default=0.5, type=float)
+select_parser.add_argument('--iters', default=100, type=int)
+select_parser.set_defaults(func=bench_select)
+
+forward_parser = subparsers.add_parser('forward', help='training step time and memory of the chunked loop and of the fused forward')
+forward_parser.add_argument('--arch', default='efficientnet-b3', type=str)
+forward_parser.add_argument('--batchsize', default=32, type=int)
+forward_parser.add_argument('--batchsize2', default=64, type=int, help='unlabeled samples kept after selection')
+forward_parser.add_argument('--imsize', default=224, type=int)
+forward_parser.add_argument('--iters', default=10, type=int)
+forward_parser.set_defaults(func=bench_forward)
+
+loss_parser = subparsers.add_parser('loss', help='parity and step time of the former and the fused label guessing, mixup and SemiLoss')
+loss_parser.add_argument('--batchsize', default=32, type=int)
+loss_parser.add_argument('--batchsize2', default=64, type=int, help='unlabeled samples kept after selection')
+loss_parser.add_argument('--num_classes', default=265, type=int)
+loss_parser.add_argument('--T', default=0.5, type=float)
+loss_parser.add_argument('--lambda_u', default=150, type=float)
+loss_parser.add_argument('--iters', default=100, type=int)
+loss_parser.set_defaults(func=bench_loss)
+
+mixup_parser = subparsers.add_parser('mixup', help='step time, peak memory and allocator churn of the per-step mixup tensors and of MixupBuffers')
+mixup_parser.add_argument('--batchsize', default=20, type=int)
+mixup_parser.add_argument('--batchsize2', default=50, type=int, help='largest number of kept unlabeled samples')
+mixup_parser.add_argument('--imsize', default=224, type=int)
+mixup_parser.add_argument('--num_classes', default=265, type=int)
+mixup_parser.add_argument('--steps', default=500, type=int, help='steps of one simulated epoch')
+mixup_parser.set_defaults(func=bench_mixup)
+
+report_parser = subparsers.add_parser('report', help='steps/s of a small training step with no, synchronous and buffered metric reporting')
+report_parser.add_argument('--batchsize', default=32, type=int)
+report_parser.add_argument('--imsize', default=64, type=int)
+report_parser.add_argument('--num_classes', default=265, type=int)
+report_parser.add_argument('--steps', default=500, type=int)
+report_parser.add_argument('--warmup', default=20, type=int)
+report_parser.add_argument('--reports', default=3, type=int, help='nsml.report calls per step, as in train()')
+report_parser.add_argument('--report_interval', default=10.0, type=float, help='seconds between two flushes of the buffered reports')
+report_parser.set_defaults(func=bench_report)
+
+fuse_parser = subparsers.add_parser('fuse', help='parity and CPU latency of EfficientNet in eval mode and of fuse_for_inference()')
+fuse_parser.add_argument('--archs', default='efficientnet-b0,efficientnet-b1,efficientnet-b2,efficientnet-b3', type=str, help='comma separated')
+fuse_parser.add_argument('--batchsize', default=8, type=int)
+fuse_parser.add_argument('--imsize', default=224, type=int)
+fuse_parser.add_argument('--iters', default=10, type=int)
+fuse_parser.add_argument('--atol', default=1e-4, type=float, help='parity: allowed max |logit diff| is atol + rtol * max |logit|')
+fuse_parser.add_argument('--rtol', default=1e-4, type=float)
+fuse_parser.add_argument('--min_agreement', default=1.0, type=float, help='parity: fraction of samples with the same top-1 class')
+fuse_parser.set_defaults(func=bench_fuse)
+
+padding_parser = subparsers.add_parser('padding', help='padded copies, allocations and forward time of the former and the cached SAME padding')
+padding_parser.add_argument('--arch', default='efficientnet-b3', type=str)
+padding_parser.add_argument('--imsizes', default='224,256', type=str, help='comma separated input sizes')
+padding_parser.add_argument('--batchsize', default=16, type=int)
+padding_parser.add_argument('--iters', default=10, type=int)
+padding_parser.set_defaults(func=bench_padding)
+
+checkpoint_parser = subparsers.add_parser('checkpoint', help='step time, peak memory and gradient parity of block checkpointing for several segment sizes')
+checkpoint_parser.add_argument('--arch', default='efficientnet-b3', type=str)
+checkpoint_parser.add_argument('--batchsize', default=20, type=int)
+checkpoint_parser.add_argument('--batchsize2', default=50, type=int, help='kept unlabeled samples')
+checkpoint_parser.add_argument('--imsize', default=224, type=int)
+checkpoint_parser.add_argument('--segments', default='0,1,2,4,8', type=str, help='comma separated blocks per segment, 0 is no checkpointing')
+checkpoint_parser.add_argument('--iters', default=5, type=int)
+checkpoint_parser.set_defaults(func=bench_checkpoint)
+
+backbone_parser = subparsers.add_parser('backbone', help='forward and training throughput of each backbone under each memory format and graph mode')
+backbone_parser.add_argument('--archs', default='efficientnet-b3,res18,res50,dense121', type=str, help='comma separated')
+backbone_parser.add_argument('--batch_sizes', default='32,48', type=str, help='comma separated, run in turn as the adaptive threshold varies the batch')
+backbone_parser.add_argument('--imsize', default=224, type=int)
+backbone_parser.add_argument('--iters', default=5, type=int)
+backbone_parser.set_defaults(func=bench_backbone)
+
+precision_parser = subparsers.add_parser('precision', help='throughput and test accuracy of the MixMatch step on synthetic data with --precision fp32 and bf16')
+precision_parser.add_argument('--num_classes', default=10, type=int)
+precision_parser.add_argument('--labeled', default=500, type=int)
+precision_parser.add_argument('--unlabeled', default=5000, type=int)
+precision_parser.add_argument('--test', default=1000, type=int)
+precision_parser.add_argument('--imsize', default=32, type=int)
+precision_parser.add_argument('--batchsize', default=32, type=int)
+precision_parser.add_argument('--batchsize2', default=64, type=int)
+precision_parser.add_argument('--T', default=0.5, type=float)
+precision_parser.add_argument('--lambda_u', default=75, type=float)
+precision_parser.add_argument('--steps', default=300, type=int)
+precision_parser.add_argument('--max_accuracy_drop', default=2.0, type=float, help='parity: allowed test top-1 loss of bf16 against fp32, in points')
+precision_parser.set_defaults(func=bench_precision)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+    else:
+        args.func(args)
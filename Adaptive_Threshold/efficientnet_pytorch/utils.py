@@ -4,6 +4,7 @@ These helper functions are built to mirror those in the official TensorFlow impl
 """
 
 import re
+import copy
 import math
 import collections
 from functools import partial
@@ -55,6 +56,13 @@ class Swish(nn.Module):
     def forward(self, x):
         return x * torch.sigmoid(x)
 
+class SiLU(nn.Module):
+    """ Swish for inference: F.silu where torch has it (>= 1.7), a single fused kernel. """
+    def forward(self, x):
+        if hasattr(F, 'silu'):
+            return F.silu(x)
+        return x * torch.sigmoid(x)
+
 
 def round_filters(filters, global_params):
     """ Calculate and round number of filters based on depth multiplier. """
@@ -100,23 +108,42 @@ def get_same_padding_conv2d(image_size=None):
         return partial(Conv2dStaticSamePadding, image_size=image_size)
 
 
+def same_padding(ih, iw, kernel_size, stride, dilation):
+    """ (F.pad amounts, conv padding) of TensorFlow's SAME padding for an ih x iw input.
+        If the padding is symmetric it is all done by the convolution and the pad amounts are None,
+        otherwise the pad amounts are [left, right, top, bottom] and the conv padding is 0. """
+    kh, kw = kernel_size
+    sh, sw = stride
+    oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
+    pad_h = max((oh - 1) * sh + (kh - 1) * dilation[0] + 1 - ih, 0)
+    pad_w = max((ow - 1) * sw + (kw - 1) * dilation[1] + 1 - iw, 0)
+    if pad_h % 2 == 0 and pad_w % 2 == 0:
+        return None, (pad_h // 2, pad_w // 2)
+    return [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2], (0, 0)
+
+
 class Conv2dDynamicSamePadding(nn.Conv2d):
-    """ 2D Convolutions like TensorFlow, for a dynamic image size """
+    """ 2D Convolutions like TensorFlow, for a dynamic image size
+
+        The padding is computed once per input size and kept in _pad_cache. Symmetric padding
+        (every stride 1 convolution) is passed to the convolution, so only the asymmetric
+        stride 2 cases copy the input into a padded tensor. """
 
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, bias=True):
         super().__init__(in_channels, out_channels, kernel_size, stride, 0, dilation, groups, bias)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
+        self._pad_cache = {}
 
     def forward(self, x):
-        ih, iw = x.size()[-2:]
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
-        return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+        size = x.shape[-2:]
+        padding = self._pad_cache.get(size)
+        if padding is None:
+            padding = same_padding(size[0], size[1], self.weight.shape[-2:], self.stride, self.dilation)
+            self._pad_cache[size] = padding
+        pad, conv_padding = padding
+        if pad is not None:
+            x = F.pad(x, pad)
+        return F.conv2d(x, self.weight, self.bias, self.stride, conv_padding, self.dilation, self.groups)
 
 
 class Conv2dStaticSamePadding(nn.Conv2d):
@@ -126,16 +153,12 @@ class Conv2dStaticSamePadding(nn.Conv2d):
         super().__init__(in_channels, out_channels, kernel_size, **kwargs)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
 
-        # Calculate padding based on image size and save it
+        # Calculate padding based on image size and save it; symmetric padding goes to the convolution
         assert image_size is not None
         ih, iw = image_size if type(image_size) == list else [image_size, image_size]
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            self.static_padding = nn.ZeroPad2d((pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2))
+        pad, self.padding = same_padding(ih, iw, self.weight.shape[-2:], self.stride, self.dilation)
+        if pad is not None:
+            self.static_padding = nn.ZeroPad2d(tuple(pad))
         else:
             self.static_padding = Identity()
 
@@ -153,6 +176,36 @@ class Identity(nn.Module):
         return input
 
 
+def fuse_conv_bn(conv, bn):
+    """ A copy of conv that computes bn(conv(x)) with the running statistics of bn (eval mode). """
+    fused = copy.deepcopy(conv)
+    with torch.no_grad():
+        # folded in float64, so that the fused model matches the eval-mode one to float rounding
+        scale = torch.rsqrt(bn.running_var.double() + bn.eps)
+        if bn.weight is not None:
+            scale = scale * bn.weight.double()
+        bias = conv.bias.double() if conv.bias is not None else torch.zeros_like(scale)
+        bias = (bias - bn.running_mean.double()) * scale
+        if bn.bias is not None:
+            bias = bias + bn.bias.double()
+        weight = conv.weight.double() * scale.view(-1, 1, 1, 1)
+    fused.weight = nn.Parameter(weight.to(conv.weight.dtype), requires_grad=False)
+    fused.bias = nn.Parameter(bias.to(conv.weight.dtype), requires_grad=False)
+    return fused
+
+
+class PointwiseLinear(nn.Module):
+    """ A 1x1 convolution on (N, C, 1, 1) inputs, e.g. after global pooling, as one matrix product. """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.weight = nn.Parameter(conv.weight.detach().flatten(1).clone(), requires_grad=False)
+        self.bias = None if conv.bias is None else nn.Parameter(conv.bias.detach().clone(), requires_grad=False)
+
+    def forward(self, x):
+        return F.linear(x.flatten(1), self.weight, self.bias).view(x.size(0), -1, 1, 1)
+
+
 ########################################################################
 ############## HELPERS FUNCTIONS FOR LOADING MODEL PARAMS ##############
 ########################################################################
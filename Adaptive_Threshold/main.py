@@ -25,70 +25,30 @@ from torchvision import datasets, models, transforms
 import tensorflow as tf
 import torch.nn.functional as F
 
-from ImageDataLoader import SimpleImageLoader
-from models import Res18, Res50
+from ImageDataLoader import SimpleImageLoader, InfiniteSampler, PairedStreamLoader, DevicePrefetcher, DatasetManifest, IndexedCollate
+from ImageDataLoader import AcceptanceScheduler, DynamicBatchSampler
+from ImageDataLoader import default_image_loader, lazy_image_loader, DraftResize, DraftRandomResizedCrop
+from ImageStore import open_image_store
+from pseudo_label import PseudoLabelSelector, PseudoLabelCache, top_confident
+from batch_transforms import ToUint8Tensor, uint8_collate, DeviceNormalize, pad_collate, BatchAugment
+from fused_forward import fused_forward
+from losses import autocast, guess_labels, sharpen, soft_cross_entropy, softmax_mse, MixupBuffers
+from metrics import topk_metrics, DeviceMeter, ClassMeter
+from models import Res18, Res50, set_execution_mode
 from efficientnet_pytorch import EfficientNet
 
 import glob
 
-import nsml
-from nsml import DATASET_PATH, IS_ON_NSML
+# nsml if available, a local stand-in otherwise; nsml.report() is buffered, see reporting.py
+from reporting import nsml, DATASET_PATH, IS_ON_NSML
 
 NUM_CLASSES = 265
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
 if not IS_ON_NSML:
     DATASET_PATH = 'fashion_demo'
 
 
-def top_1_accuracy_score_with_confidence(y_true, y_prob, n=5, normalize=True):
-    num_obs, num_labels = y_prob.shape
-    idx = num_labels - n - 1
-    counter = 0
-    confid = []
-    y_prob_softmax = torch.softmax(y_prob, dim=1)
-    argsorted = np.argsort(y_prob.cpu().numpy(), axis=1)
-    for i in range(num_obs):
-        if y_true[i] in argsorted[i, idx+1:]:
-            counter += 1
-            confid.append(y_prob_softmax[i, argsorted[i, idx+1]].item())
-    if len(confid)==0:
-        confid_avg = 0
-        confid_min = 0
-    else:
-        confid_avg = sum(confid)/len(confid)
-        confid_min = min(confid)
-    if normalize:
-        return (counter * 1.0 / num_obs)*100, confid_avg, confid_min
-    else:
-        return counter*100, confid_avg, confid_min
-
-def top_n_accuracy_score(y_true, y_prob, n=5, normalize=True):
-    num_obs, num_labels = y_prob.shape
-    idx = num_labels - n - 1
-    counter = 0
-    argsorted = np.argsort(y_prob, axis=1)
-    for i in range(num_obs):
-        if y_true[i] in argsorted[i, idx+1:]:
-            counter += 1
-    if normalize:
-        return counter * 1.0 / num_obs
-    else:
-        return counter
-
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
 def adjust_learning_rate(opts, optimizer, epoch):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
     lr = opts.lr * (0.1 ** (epoch // 30))
@@ -110,12 +70,11 @@ def update_ema_variables(model, ema_model, alpha, global_step):
 
 class SemiLoss(object):
     def __call__(self, outputs_x, targets_x, outputs_u, targets_u, epoch, final_epoch):
-        probs_u = torch.softmax(outputs_u, dim=1)
-        Lx = -torch.mean(torch.sum(F.log_softmax(outputs_x, dim=1) * targets_x, dim=1))
+        Lx = soft_cross_entropy(outputs_x, targets_x)
         if opts.unlabeled_loss == "CEE":
-            Lu = -torch.mean(torch.sum(F.log_softmax(outputs_u, dim=1) * targets_u, dim=1))
+            Lu = soft_cross_entropy(outputs_u, targets_u)
         elif opts.unlabeled_loss == "MSE":
-            Lu = torch.mean((probs_u - targets_u)**2)
+            Lu = softmax_mse(outputs_u, targets_u)
         else:
             print("ERROR: clarify the loss term for unlabeled data")
         return Lx, Lu, opts.lambda_u
@@ -138,21 +97,10 @@ def interleave(xy, batch, batch_u):
         xy[0][i], xy[i][i] = xy[i][i], xy[0][i]
     return [torch.cat(v, dim=0) for v in xy]
 
-def split_ids(path, ratio):
-    with open(path) as f:
-        ids_l = []
-        ids_u = []
-        for i, line in enumerate(f.readlines()):
-            if i == 0 or line == '' or line == '\n':
-                continue
-            line = line.replace('\n', '').split('\t')
-            if int(line[1]) >= 0:
-                ids_l.append(int(line[0]))
-            else:
-                ids_u.append(int(line[0]))
-
-    ids_l = np.array(ids_l)
-    ids_u = np.array(ids_u)
+def split_ids(manifest, ratio):
+    labeled = manifest.labels >= 0
+    ids_l = manifest.ids[labeled]
+    ids_u = manifest.ids[~labeled]
 
     perm = np.random.permutation(np.arange(len(ids_l)))
     cut = int(ratio*len(ids_l))
@@ -164,49 +112,64 @@ def split_ids(path, ratio):
     return train_ids, val_ids, ids_u
 
 # equalize the ratio between each class in the training set and the validation set
-def split_ids_distributedly(path, ratio):
-    with open(path) as f:
-        ids_l = []
-        for i in range(NUM_CLASSES):
-           ids_l.append([])
-        ids_u = []
-        for i, line in enumerate(f.readlines()):
-            if i == 0 or line == '' or line == '\n':
-                continue
-            line = line.replace('\n', '').split('\t')
-            if int(line[1]) >= 0:
-                ids_l[int(line[1])].append(int(line[0]))
-            else:
-                ids_u.append(int(line[0]))
-
-    train_ids = np.array([])
-    val_ids = np.array([])
-    ids_u = np.array(ids_u)
-
-    for i in range(NUM_CLASSES):
-        ids_len = len(ids_l[i])
-        ids_array = np.array(ids_l[i])
-        perm = np.random.permutation(np.arange(ids_len))
-        cut = int(ratio*ids_len)
-        train_ids = np.concatenate((train_ids,ids_array[perm][cut:]),axis=0)
-        val_ids = np.concatenate((val_ids,ids_array[perm][:cut]),axis=0)
-
+def split_ids_distributedly(manifest, ratio):
+    labeled = manifest.labels >= 0
+    ids_l = manifest.ids[labeled]
+    labels_l = manifest.labels[labeled]
+    ids_u = manifest.ids[~labeled]
+
+    # group by class with a random order inside every class, then cut the first ratio of each group
+    order = np.lexsort((np.random.random(len(ids_l)), labels_l))
+    labels_sorted = labels_l[order]
+    counts = np.bincount(labels_l, minlength=NUM_CLASSES)
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(order)) - starts[labels_sorted]
+    cut = (ratio*counts).astype(np.int64)
+    is_val = rank < cut[labels_sorted]
+
+    train_ids = ids_l[order][~is_val]
+    val_ids = ids_l[order][is_val]
 
     return train_ids, val_ids, ids_u
 
+def decode_transforms(decode, random_crop=False):
+    """(loader, leading transforms) of a SimpleImageLoader: the file is turned into an imResize
+    image, or into an imsize RandomResizedCrop of it if random_crop.
+
+    decode: 'full' decodes the whole JPEG, 'draft' decodes it at the smallest DCT scale covering
+    imResize, 'crop' also samples the crop box first and decodes at the scale that box needs.
+    """
+    if decode == 'full':
+        loader, resize = default_image_loader, [transforms.Resize(opts.imResize)]
+    elif decode == 'draft' or (decode == 'crop' and not random_crop):
+        loader, resize = lazy_image_loader, [DraftResize(opts.imResize)]
+    elif decode == 'crop':
+        return lazy_image_loader, [DraftRandomResizedCrop(opts.imResize, opts.imsize)]
+    else:
+        raise ValueError('unknown decode mode {}'.format(decode))
+    if random_crop:
+        resize.append(transforms.RandomResizedCrop(opts.imsize))
+    return loader, resize
+
 ### NSML functions
 def _infer(model, root_path, test_loader=None):
     if test_loader is None:
+        store = None
+        if opts.image_store:
+            store = open_image_store(opts.image_store, root_path, 'test', opts.imResize)
+        loader, resize = decode_transforms(opts.decode_eval)
         test_loader = torch.utils.data.DataLoader(
-            SimpleImageLoader(root_path, 'test',
-                               transform=transforms.Compose([
-                                   transforms.Resize(opts.imResize),
+            SimpleImageLoader(root_path, 'test', store=store, loader=loader,
+                               transform=transforms.Compose(resize + [
                                    transforms.CenterCrop(opts.imsize),
                                    transforms.ToTensor(),
-                                   transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+                                   transforms.Normalize(mean=MEAN, std=STD),
                                ])), batch_size=opts.batchsize, shuffle=False, num_workers=4, pin_memory=True)
         print('loaded {} test images'.format(len(test_loader.dataset)))
 
+    if opts.fuse_inference:
+        # built per call, so the folded weights are always the current ones
+        model = model.fuse_for_inference()
     outputs = []
     s_t = time.time()
     for idx, image in enumerate(test_loader):
@@ -262,6 +225,12 @@ parser.add_argument('--imResize', default=256, type=int, help='')
 parser.add_argument('--imsize', default=224, type=int, help='')
 parser.add_argument('--lossXent', type=float, default=1, help='lossWeight for Xent')
 parser.add_argument('--min_threshold', type=float, default=0.5, help='minimum threshold')
+parser.add_argument('--uint8_pipeline', type=int, default=0, help='1: workers return uint8 crops, normalization and flips run batched on the training device')
+parser.add_argument('--batch_augment', type=int, default=0, help='1: crop and flip both unlabeled views in one batched pass instead of per sample in the workers')
+parser.add_argument('--image_store', default='', type=str, help='directory of the pre-decoded image store, built on first use (default: decode JPEGs every epoch)')
+parser.add_argument('--decode_train', default='full', type=str, choices=['full', 'draft', 'crop'], help='JPEG decoding of the labeled loader: full, draft (DCT-scaled to imResize) or crop (DCT-scaled to the crop box)')
+parser.add_argument('--decode_unlabel', default='full', type=str, choices=['full', 'draft', 'crop'], help='JPEG decoding of the unlabeled loader, crop decodes like draft')
+parser.add_argument('--decode_eval', default='full', type=str, choices=['full', 'draft'], help='JPEG decoding of the validation and test loaders')
 
 # arguments for logging and backup
 parser.add_argument('--log_interval', type=int, default=10, metavar='N', help='logging training status')
@@ -271,6 +240,21 @@ parser.add_argument('--save_epoch', type=int, default=50, help='saving epoch int
 parser.add_argument('--alpha', default=0.75, type=float)
 parser.add_argument('--lambda-u', default=1, type=float)
 parser.add_argument('--T', default=0.5, type=float)
+parser.add_argument('--fused_forward', type=int, default=0, help='one forward for label guessing and one for the mixed batch, instead of one per view and chunk')
+parser.add_argument('--bn_mode', type=str, default='chunk', choices=['chunk', 'interleave', 'full'], help='BatchNorm statistics of the fused forward, see fused_forward.py')
+parser.add_argument('--train_acc', type=str, default='exact', choices=['exact', 'probe'], help='train accuracy from a forward after every step (exact) or from a forward every train_acc_interval steps (probe)')
+parser.add_argument('--train_acc_interval', type=int, default=10, help='steps between two accuracy forwards with --train_acc probe')
+parser.add_argument('--report_dir', type=str, default='runs/metrics', help='reported metrics are appended to <report_dir>.jsonl and .csv (empty: no files)')
+parser.add_argument('--report_interval', type=float, default=10.0, help='seconds between two flushes of the reported metrics')
+parser.add_argument('--fuse_inference', type=int, default=0, help='run inference and validation on a copy with BatchNorm folded into the convolutions')
+parser.add_argument('--checkpoint_blocks', type=int, default=0, help='recompute the MBConv blocks in backward, in segments of this many blocks (0: off)')
+parser.add_argument('--channels_last', type=int, default=0, help='parameters and inputs in NHWC memory format (torch >= 1.5)')
+parser.add_argument('--graph_mode', type=str, default='none', choices=['none', 'trace', 'compile'], help='eager forward, torch.jit.trace per batch shape or torch.compile (torch >= 2.0)')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16: label guessing and the mixed forward under bfloat16 autocast (torch >= 1.10)')
+parser.add_argument('--ulb_target', type=int, default=0, help='accepted unlabeled samples per step to aim for by resizing the unlabeled batch, at most batchsize2 are drawn (0: always batchsize2)')
+parser.add_argument('--ulb_min', type=int, default=8, help='smallest unlabeled batch with --ulb_target')
+parser.add_argument('--pl_cache_age', type=int, default=0, help='reuse the label guess of an unlabeled sample for this many steps (0: off)')
+parser.add_argument('--pl_cache_skip', type=float, default=0.0, help='with --pl_cache_age, skip unlabeled samples whose cached confidence is this far below the selection threshold (0: off)')
 
 ### DO NOT MODIFY THIS BLOCK ###
 # arguments for nsml
@@ -282,6 +266,7 @@ parser.add_argument('--mode', type=str, default='train')
 def main():
     global opts
     opts = parser.parse_args()
+    nsml.configure(opts.report_dir or None, opts.report_interval)
     opts.cuda = 0
 
     # Set GPU
@@ -295,6 +280,7 @@ def main():
 
     os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_ids
     use_gpu = torch.cuda.is_available()
+    autocast(opts.precision, 'cuda' if use_gpu else 'cpu')  # unsupported precisions stop here, not at the first step
     if use_gpu:
         opts.cuda = 1
         print("Currently using GPU {}".format(opts.gpu_ids))
@@ -306,6 +292,7 @@ def main():
 
     # Set model
     model = EfficientNet.from_pretrained('efficientnet-b3')
+    model.set_checkpointing(opts.checkpoint_blocks)
 
     model.eval()
 
@@ -315,6 +302,7 @@ def main():
 
     if use_gpu:
         model.cuda()
+    set_execution_mode(model, opts.channels_last, opts.graph_mode)
 
     ### DO NOT MODIFY THIS BLOCK ###
     if IS_ON_NSML:
@@ -329,40 +317,68 @@ def main():
     if opts.mode == 'train':
         model.train()
         # Set dataloader
-        train_ids, val_ids, unl_ids = split_ids(os.path.join(DATASET_PATH, 'train/train_label'), 0.2)
+        manifest = DatasetManifest.compile(os.path.join(DATASET_PATH, 'train/train_label'), os.path.join(DATASET_PATH, 'train/train_data'))
+        train_ids, val_ids, unl_ids = split_ids(manifest, 0.2)
         print('found {} train, {} validation and {} unlabeled images'.format(len(train_ids), len(val_ids), len(unl_ids)))
-        train_loader = torch.utils.data.DataLoader(
-            SimpleImageLoader(DATASET_PATH, 'train', train_ids,
-                              transform=transforms.Compose([
-                                  transforms.Resize(opts.imResize),
-                                  transforms.RandomResizedCrop(opts.imsize),
-                                  transforms.RandomHorizontalFlip(),
-                                  transforms.RandomVerticalFlip(),
-                                  transforms.ToTensor(),
-                                  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
-                                batch_size=opts.batchsize, shuffle=True, num_workers=4, pin_memory=True, drop_last=True)
+        store = None
+        if opts.image_store:
+            store = open_image_store(opts.image_store, DATASET_PATH, 'train', opts.imResize, manifest=manifest)
+            print('using image store with {} images'.format(len(store)))
+        to_tensor = [transforms.ToTensor(), transforms.Normalize(mean=MEAN, std=STD)]
+        flips = [transforms.RandomHorizontalFlip(), transforms.RandomVerticalFlip()]
+        collate_fn = torch.utils.data.dataloader.default_collate
+        if opts.uint8_pipeline:
+            # workers stop at uint8 pixels, flips and normalization happen in train() and validation()
+            to_tensor = [ToUint8Tensor()]
+            flips = []
+            collate_fn = uint8_collate
+
+        loader, resize = decode_transforms(opts.decode_train, random_crop=True)
+        train_set = SimpleImageLoader(DATASET_PATH, 'train', train_ids, store=store, manifest=manifest, loader=loader,
+                                      transform=transforms.Compose(resize + flips + to_tensor))
+        train_loader = torch.utils.data.DataLoader(train_set, batch_size=opts.batchsize, sampler=InfiniteSampler(train_set), num_workers=4, pin_memory=True, drop_last=True, collate_fn=collate_fn)
         print('train_loader done')
 
-        unlabel_loader = torch.utils.data.DataLoader(
-            SimpleImageLoader(DATASET_PATH, 'unlabel', unl_ids,
-                              transform=transforms.Compose([
-                                  transforms.Resize(opts.imResize),
-                                  transforms.RandomResizedCrop(opts.imsize),
-                                  transforms.RandomHorizontalFlip(),
-                                  transforms.RandomVerticalFlip(),
-                                  transforms.ToTensor(),
-                                  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
-                                batch_size=opts.batchsize2, shuffle=True, num_workers=4, pin_memory=True, drop_last=True)
+        use_cache = opts.pl_cache_age > 0
+        if opts.batch_augment:
+            # workers only resize, BatchAugment crops and flips both views in train()
+            loader, resize = decode_transforms(opts.decode_unlabel)
+            unlabel_set = SimpleImageLoader(DATASET_PATH, 'unlabel', unl_ids, store=store, manifest=manifest, loader=loader, views=1, return_index=use_cache,
+                                            transform=transforms.Compose(resize + [ToUint8Tensor()]))
+            unlabel_collate = pad_collate
+        else:
+            # both views are cut from one decoded image, so 'crop' decodes like 'draft' here
+            loader, resize = decode_transforms(opts.decode_unlabel)
+            unlabel_set = SimpleImageLoader(DATASET_PATH, 'unlabel', unl_ids, store=store, manifest=manifest, loader=loader, return_index=use_cache,
+                                            transform=transforms.Compose(resize + [transforms.RandomResizedCrop(opts.imsize)] + flips + to_tensor))
+            unlabel_collate = collate_fn
+        pl_cache = None
+        unlabel_sampler = InfiniteSampler(unlabel_set)
+        if use_cache:
+            # label guesses by unlabeled index, the batches carry the indices (see IndexedCollate)
+            pl_cache = PseudoLabelCache(len(unlabel_set), NUM_CLASSES, opts.pl_cache_age, 'cuda' if use_gpu else 'cpu', margin=opts.pl_cache_skip)
+            unlabel_sampler = InfiniteSampler(unlabel_set, skip=pl_cache.skip_mask)
+            unlabel_collate = IndexedCollate(unlabel_collate)
+        ulb_schedule = None
+        batching = dict(batch_size=opts.batchsize2, sampler=unlabel_sampler, drop_last=True)
+        if opts.ulb_target:
+            # unlabeled batch size follows the acceptance rate, batchsize2 is the upper bound
+            ulb_schedule = AcceptanceScheduler(opts.ulb_target, opts.ulb_min, opts.batchsize2)
+            batching = dict(batch_sampler=DynamicBatchSampler(unlabel_sampler, ulb_schedule))
+        unlabel_loader = torch.utils.data.DataLoader(unlabel_set, num_workers=4, pin_memory=True, collate_fn=unlabel_collate, **batching)
         print('unlabel_loader done')
+        # one pair of iterators (and worker pools) for the whole run
+        train_stream = PairedStreamLoader(train_loader, unlabel_loader)
+        train_stream.on_epoch_end(lambda stream, n: print('{} stream: finished pass {}'.format(stream, n)))
+        # copies the next pair to the device while the current step runs
+        train_batches = DevicePrefetcher(train_stream, NUM_CLASSES, 'cuda' if use_gpu else 'cpu')
 
+        loader, resize = decode_transforms(opts.decode_eval)
         validation_loader = torch.utils.data.DataLoader(
-            SimpleImageLoader(DATASET_PATH, 'val', val_ids,
-                               transform=transforms.Compose([
-                                   transforms.Resize(opts.imResize),
-                                   transforms.CenterCrop(opts.imsize),
-                                   transforms.ToTensor(),
-                                   transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
-                               batch_size=opts.batchsize2, shuffle=False, num_workers=4, pin_memory=True, drop_last=False)
+            SimpleImageLoader(DATASET_PATH, 'val', val_ids, store=store, manifest=manifest, loader=loader,
+                               transform=transforms.Compose(resize + [
+                                   transforms.CenterCrop(opts.imsize),] + to_tensor)),
+                               batch_size=opts.batchsize2, shuffle=False, num_workers=4, pin_memory=True, drop_last=False, collate_fn=collate_fn)
         print('validation_loader done')
 
         # Set optimizer
@@ -379,7 +395,7 @@ def main():
         train_loss_un_val = 0
         for epoch in range(opts.start_epoch, opts.epochs + 1):
             print('start training')
-            loss, _, _, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val = train(opts, train_loader, unlabel_loader, model, train_criterion, optimizer, epoch, use_gpu, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val)
+            loss, _, _, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val = train(opts, train_batches, model, train_criterion, optimizer, epoch, use_gpu, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val, pl_cache=pl_cache, ulb_schedule=ulb_schedule)
 
             print('start validation')
             acc_top1, acc_top5 = validation(opts, validation_loader, model, epoch, use_gpu)
@@ -399,16 +415,17 @@ def main():
                     torch.save(model.state_dict(), os.path.join('runs', opts.name + '_e{}'.format(epoch)))
 
 
-def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch, use_gpu, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val):
-    losses = AverageMeter()
-    losses_x = AverageMeter()
-    losses_un = AverageMeter()
-    good_ulb = AverageMeter()
-    weight_scale = AverageMeter()
-    acc_top1 = AverageMeter()
-    acc_top5 = AverageMeter()
-    conf_avg = AverageMeter()
-    conf_min = AverageMeter()
+def train(opts, train_batches, model, criterion, optimizer, epoch, use_gpu, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val, pl_cache=None, ulb_schedule=None):
+    losses = DeviceMeter()
+    losses_x = DeviceMeter()
+    losses_un = DeviceMeter()
+    good_ulb = DeviceMeter()
+    weight_scale = DeviceMeter()
+    acc_top1 = DeviceMeter()
+    acc_top5 = DeviceMeter()
+    data_time = DeviceMeter()
+    conf_avg = DeviceMeter()
+    conf_min = DeviceMeter()
 
     avg_loss = 0.0
     avg_top1 = 0.0
@@ -422,112 +439,126 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
 
     model.train()
 
+    if opts.uint8_pipeline:
+        normalize = DeviceNormalize(MEAN, STD, hflip=True, vflip=True)
+    if opts.batch_augment:
+        augment_u = BatchAugment(opts.imsize, MEAN, STD, views=2)
+
+    selector = PseudoLabelSelector('adaptive', min_threshold=opts.min_threshold)
+
+    # sized for the largest mixed batch: batchsize labeled and two views of batchsize2 unlabeled samples
+    mix_buffers = MixupBuffers(opts.batchsize + 2 * opts.batchsize2)
+
     nCnt =0
-    labeled_train_iter = iter(train_loader)
-    unlabeled_train_iter = iter(unlabel_loader)
-
-    for batch_idx in range(len(train_loader)):
-        try:
-            data = labeled_train_iter.next()
-            inputs_x, targets_x = data
-        except:
-            labeled_train_iter = iter(train_loader)
-            data = labeled_train_iter.next()
-            inputs_x, targets_x = data
-        try:
-            data = unlabeled_train_iter.next()
-            inputs_u1, inputs_u2 = data
-        except:
-            unlabeled_train_iter = iter(unlabel_loader)
-            data = unlabeled_train_iter.next()
-            inputs_u1, inputs_u2 = data
+    for batch_idx, ((inputs_x, targets_org, targets_x), data_u) in enumerate(train_batches.epoch()):
+        data_time.update(train_batches.last_wait)
+
+        if pl_cache is not None:
+            data_u, ids_u = data_u
+        if opts.batch_augment:
+            inputs_u, sizes_u = data_u
+            inputs_u1, inputs_u2 = augment_u(inputs_u, sizes_u)
+        else:
+            inputs_u1, inputs_u2 = data_u
 
         batch_size = inputs_x.size(0)
-        batch_size_u = inputs_u1.size(0)
-        # Transform label to one-hot
-        classno = NUM_CLASSES
-        targets_org = targets_x
-        targets_x = torch.zeros(batch_size, classno).scatter_(1, targets_x.view(-1,1), 1)
-
-        if use_gpu :
-            inputs_x, targets_x = inputs_x.cuda(), targets_x.cuda()
-            inputs_u1, inputs_u2 = inputs_u1.cuda(), inputs_u2.cuda()
+        if opts.uint8_pipeline:
+            inputs_x = normalize(inputs_x)
+            if not opts.batch_augment:
+                inputs_u1, inputs_u2 = normalize(inputs_u1), normalize(inputs_u2)
         inputs_x, targets_x = Variable(inputs_x), Variable(targets_x)
         inputs_u1, inputs_u2 = Variable(inputs_u1), Variable(inputs_u2)
 
-        mixup_idx = []
-
         percentile = acc_top1.avg/100
-        threshold_size = int(opts.batchsize2*percentile)
-
 
         with torch.no_grad():
-            embed_u1, pred_u1 = model(inputs_u1)
-            embed_u2, pred_u2 = model(inputs_u2)
-            pred_u_all = (torch.softmax(pred_u1, dim=1) + torch.softmax(pred_u2, dim=1)) / 2
-
-            crit = torch.max(pred_u_all, axis=1)
-
-            prec_idx = torch.argsort(crit[0], descending = True)[:threshold_size]
-
-            for i in prec_idx:
-                if crit[0][i] >= opts.min_threshold:
-                    mixup_idx.append(i.item())
-
-            pt = pred_u_all**(1/opts.T)
-            targets_u = pt / pt.sum(dim=1, keepdim=True)
-            targets_u = targets_u.detach()
-
+            guess_u1, guess_u2 = inputs_u1, inputs_u2
+            if pl_cache is not None:
+                # fresh cached guesses are reused, the model only sees the stale samples
+                fresh, cached_u = pl_cache.lookup(ids_u)
+                stale = (~fresh).nonzero().view(-1)
+                guess_u1, guess_u2 = inputs_u1[stale], inputs_u2[stale]
+            n_guess = guess_u1.size(0)
+
+            if n_guess != 0:
+                with autocast(opts.precision, inputs_x.device.type):
+                    if opts.fused_forward:
+                        # both views in one forward, each view keeps its own BatchNorm statistics unless bn_mode is full
+                        _, pred_u = fused_forward(model, torch.cat([guess_u1, guess_u2], dim=0), n_guess,
+                                                  'full' if opts.bn_mode == 'full' else 'chunk')
+                        pred_u1, pred_u2 = torch.split(pred_u, n_guess)
+                    else:
+                        embed_u1, pred_u1 = model(guess_u1)
+                        embed_u2, pred_u2 = model(guess_u2)
+                # sharpening and the softmax average stay in fp32 under --precision bf16
+                pred_u1, pred_u2 = pred_u1.float(), pred_u2.float()
+                # averaged and sharpened guesses, computed in place (losses.py)
+                pred_u_all, targets_u = guess_labels(pred_u1, pred_u2, opts.T)
+
+            if pl_cache is not None:
+                if n_guess != 0:
+                    pl_cache.update(ids_u[stale], pred_u_all)
+                    cached_u[stale] = pred_u_all
+                pred_u_all = cached_u
+                targets_u = sharpen(pred_u_all, opts.T)
+
+            mixup_idx = selector(pred_u_all, percentile)
+            if pl_cache is not None and len(mixup_idx) != 0:
+                pl_cache.set_threshold(pred_u_all[mixup_idx].max(1)[0].min())
+
+        drawn = inputs_u1.size(0)
+        if ulb_schedule is not None:
+            # next unlabeled batch size from the acceptance rate; the cap keeps the mixed batch at a fixed size
+            ulb_schedule.update(len(mixup_idx), drawn)
+            # the selection is in batch order when the percentile is a device tensor, so cap by confidence
+            mixup_idx = top_confident(pred_u_all, mixup_idx, opts.ulb_target)
 
         inputs_u1 = inputs_u1[mixup_idx]
         inputs_u2 = inputs_u2[mixup_idx]
         targets_u = targets_u[mixup_idx]
 
-        good_ulb.update(len(mixup_idx)/opts.batchsize2)
+        good_ulb.update(len(mixup_idx)/drawn)
 
         # mixup
-        all_inputs = torch.cat([inputs_x, inputs_u1, inputs_u2], dim=0)
-        all_targets = torch.cat([targets_x, targets_u, targets_u], dim=0)
-
         lamda = np.random.beta(opts.alpha, opts.alpha)
         lamda= max(lamda, 1-lamda)
-        newidx = torch.randperm(all_inputs.size(0))
-        input_a, input_b = all_inputs, all_inputs[newidx]
-        target_a, target_b = all_targets, all_targets[newidx]
-
-        mixed_input = lamda * input_a + (1 - lamda) * input_b
-        mixed_target = lamda * target_a + (1 - lamda) * target_b
-
-        mixed_input = list(torch.split(mixed_input, batch_size))
+        # cat, permute and blend inside the reused buffers, the results are views valid for this step
+        mixed_input, mixed_target = mix_buffers(inputs_x, targets_x, inputs_u1, inputs_u2, targets_u, lamda)
 
         optimizer.zero_grad()
 
-        fea, logits_temp = model(mixed_input[0])
+        with autocast(opts.precision, inputs_x.device.type):
+            if opts.fused_forward:
+                # the whole mixed batch in one forward, BatchNorm groups chosen by bn_mode
+                fea, logits_all = fused_forward(model, mixed_input, batch_size, opts.bn_mode)
+                logits = list(torch.split(logits_all, batch_size))
+            else:
+                mixed_input = list(torch.split(mixed_input, batch_size))
+                logits = []
+                for newinput in mixed_input:
+                    fea, logits_temp = model(newinput)
+                    logits.append(logits_temp)
+        # the loss terms in fp32
+        logits = [logits_temp.float() for logits_temp in logits]
 
         if len(mixup_idx) != 0:
-            logits = [logits_temp]
-            for newinput in mixed_input[1:]:
-                fea, logits_temp = model(newinput)
-                logits.append(logits_temp)
-
             logits_x = logits[0]
             logits_u = torch.cat(logits[1:], dim=0)
 
-            loss_x, loss_un, weigts_mixing = criterion(logits_x, mixed_target[:batch_size], logits_u, mixed_target[batch_size:], epoch+batch_idx/len(train_loader), opts.epochs)
+            loss_x, loss_un, weigts_mixing = criterion(logits_x, mixed_target[:batch_size], logits_u, mixed_target[batch_size:], epoch+batch_idx/len(train_batches), opts.epochs)
             loss = loss_x + weigts_mixing * loss_un
-            losses.update(loss.item(), inputs_x.size(0))
-            losses_x.update(loss_x.item(), inputs_x.size(0))
-            losses_un.update(loss_un.item(), inputs_x.size(0))
+            losses.update(loss.detach(), inputs_x.size(0))
+            losses_x.update(loss_x.detach(), inputs_x.size(0))
+            losses_un.update(loss_un.detach(), inputs_x.size(0))
             weight_scale.update(weigts_mixing, inputs_x.size(0))
 
         else:
-            logits = [logits_temp]
             weigts_mixing = opts.lambda_u
             logits_x = logits[0]
-            loss_x = -torch.mean(torch.sum(F.log_softmax(logits_x, dim=1) * targets_x, dim=1))
+            loss_x = soft_cross_entropy(logits_x, targets_x)
             loss = loss_x
-            losses.update(loss.item(), inputs_x.size(0))
-            losses_x.update(loss_x.item(), inputs_x.size(0))
+            losses.update(loss.detach(), inputs_x.size(0))
+            losses_x.update(loss_x.detach(), inputs_x.size(0))
             losses_un.update(0, inputs_x.size(0))
             weight_scale.update(75, inputs_x.size(0))
 
@@ -537,65 +568,90 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
         loss.backward()
         optimizer.step()
 
-        with torch.no_grad():
-            # compute guessed labels of unlabel samples
-            embed_x, pred_x1 = model(inputs_x)
-
-        acc_top1b, confid_avg, confid_min = top_1_accuracy_score_with_confidence(targets_org.data.cpu().numpy(), pred_x1.data, n=1)
-        acc_top5b = top_n_accuracy_score(targets_org.data.cpu().numpy(), pred_x1.data.cpu().numpy(), n=5)*100
-        acc_top1.update(torch.as_tensor(acc_top1b), inputs_x.size(0))
-        acc_top5.update(torch.as_tensor(acc_top5b), inputs_x.size(0))
-        conf_avg.update(confid_avg, inputs_x.size(0))
-        conf_min.update(confid_min, inputs_x.size(0))
-
-        avg_loss += loss.item()
+        if opts.train_acc == 'exact' or batch_idx % opts.train_acc_interval == 0:
+            with torch.no_grad():
+                embed_x, pred_x1 = model(inputs_x)
+        else:
+            # probe: the meters keep the last probe until the next one
+            pred_x1 = None
+
+        if pred_x1 is not None:
+            scores = topk_metrics(pred_x1, targets_org, ks=(1, 5))
+            acc_top1b, acc_top5b = scores['top1'], scores['top5']
+            confid_avg, confid_min = scores['conf_avg'], scores['conf_min']
+            acc_top1.update(acc_top1b, inputs_x.size(0))
+            acc_top5.update(acc_top5b, inputs_x.size(0))
+            conf_avg.update(confid_avg, inputs_x.size(0))
+            conf_min.update(confid_min, inputs_x.size(0))
+
+        avg_loss += loss.detach()
         avg_top1 += acc_top1b
         avg_top5 += acc_top5b
 
         if batch_idx % opts.log_interval == 0:
-            print('Train Epoch:{} [{}/{}] Loss:{:.4f}({:.4f}) Top-1:{:.2f}%({:.2f}%) Top-5:{:.2f}%({:.2f}%)'.format(
-                epoch, batch_idx *inputs_x.size(0), len(train_loader.dataset), losses.val, losses.avg, acc_top1.val, acc_top1.avg, acc_top5.val, acc_top5.avg))
-            nsml.report(summary=True, train_confidence_avg=conf_avg.avg, train_confidence_min=conf_min.avg, step = epoch+batch_idx/len(train_loader))
+            print('Train Epoch:{} [{}/{}] Loss:{:.4f}({:.4f}) Top-1:{:.2f}%({:.2f}%) Top-5:{:.2f}%({:.2f}%) Data:{:.3f}s({:.3f}s)'.format(
+                epoch, batch_idx *inputs_x.size(0), len(train_batches.stream.labeled.dataset), losses.val, losses.avg, acc_top1.val, acc_top1.avg, acc_top5.val, acc_top5.avg, data_time.val, data_time.avg))
+            nsml.report(summary=True, train_confidence_avg=conf_avg.avg, train_confidence_min=conf_min.avg, step = epoch+batch_idx/len(train_batches))
             if batch_idx != 0:
-                nsml.report(summary=True, good_unlabeled = good_ulb.avg, step=epoch + batch_idx*inputs_x.size(0)/len(train_loader.dataset) )
-
+                nsml.report(summary=True, good_unlabeled = good_ulb.avg, step=epoch + batch_idx*inputs_x.size(0)/len(train_batches.stream.labeled.dataset) )
+            # the meters live on the device, so the running losses are reported here rather than every step
+            nsml.report(summary=True, data_wait=data_time.avg, losses=losses.avg, losses_x = losses_x.avg, losses_un = losses_un.avg*weigts_mixing,  step = epoch+batch_idx/len(train_batches))
+            if ulb_schedule is not None:
+                print('Unlabeled batch:{} acceptance:{:.3f} size changes:{}'.format(ulb_schedule.size, ulb_schedule.rate, len(ulb_schedule.decisions)))
+                nsml.report(summary=True, unlabeled_batch=ulb_schedule.size, acceptance_rate=ulb_schedule.rate, step = epoch+batch_idx/len(train_batches))
+            if pl_cache is not None:
+                hit_rate, saved = pl_cache.stats()
+                nsml.report(summary=True, pl_cache_hit_rate=hit_rate, pl_cache_saved_forwards=saved, step = epoch+batch_idx/len(train_batches))
+
+        if pl_cache is not None:
+            pl_cache.tick()
         nCnt += 1
-        if confid_avg!=0:
-            nsml.report(summary = True, step = epoch+batch_idx/len(train_loader))
-        nsml.report(summary=True, losses=losses.avg, losses_x = losses_x.avg, losses_un = losses_un.avg*weigts_mixing,  step = epoch+batch_idx/len(train_loader))
 
     avg_loss =  float(avg_loss/nCnt)
     avg_top1 = float(avg_top1/nCnt)
     avg_top5 = float(avg_top5/nCnt)
 
     nsml.report(summary=True, train_acc_top1= avg_top1, train_acc_top5=avg_top5, step=epoch)
+    if pl_cache is not None:
+        hit_rate, saved = pl_cache.stats()
+        print('Pseudo-label cache: {:.1f}% hits, {} of {} per-sample guess forwards saved'.format(hit_rate*100, saved, 2*pl_cache.lookups))
+        pl_cache.reset_stats()
 
-    return  avg_loss, avg_top1, avg_top5, acc_top1.val, losses.val, losses_x.val, losses_un.val
+    return  avg_loss, avg_top1, avg_top5, float(acc_top1.val), float(losses.val), float(losses_x.val), float(losses_un.val)
 
 
 def validation(opts, validation_loader, model, epoch, use_gpu):
     model.eval()
+    if opts.fuse_inference:
+        model = model.fuse_for_inference()
     avg_top1= 0.0
     avg_top5 = 0.0
+    classes = ClassMeter(NUM_CLASSES)
     nCnt =0
+    if opts.uint8_pipeline:
+        normalize = DeviceNormalize(MEAN, STD)
     with torch.no_grad():
         for batch_idx, data in enumerate(validation_loader):
             inputs, labels = data
             if use_gpu :
                 inputs = inputs.cuda()
+            if opts.uint8_pipeline:
+                inputs = normalize(inputs)
             inputs = Variable(inputs)
             nCnt +=1
             embed_fea, preds = model(inputs)
 
-            acc_top1, confid_avg, confid_min = top_1_accuracy_score_with_confidence(labels.numpy(), preds.data, n=1)
-            acc_top5 = top_n_accuracy_score(labels.numpy(), preds.data.cpu().numpy(), n=5)*100
-            avg_top1 += acc_top1
-            avg_top5 += acc_top5
+            scores = topk_metrics(preds, labels, ks=(1, 5))
+            classes.update(preds, labels)
+            avg_top1 += scores['top1']
+            avg_top5 += scores['top5']
 
+        # everything above stayed on the device, this is the only sync of the pass
         avg_top1 = float(avg_top1/nCnt)
         avg_top5= float(avg_top5/nCnt)
-        print('Test Epoch:{} Top1_acc_val:{:.2f}% Top5_acc_val:{:.2f}% '.format(epoch, avg_top1, avg_top5))
-    nsml.report(summary = True, valid_confidence_avg = confid_avg, valid_confidence_min = confid_min, step = epoch)
+        avg_class = classes.mean_accuracy()
+        print('Test Epoch:{} Top1_acc_val:{:.2f}% Top5_acc_val:{:.2f}% Class_mean_acc_val:{:.2f}% '.format(epoch, avg_top1, avg_top5, avg_class))
+    nsml.report(summary = True, valid_confidence_avg = float(scores['conf_avg']), valid_confidence_min = float(scores['conf_min']), valid_acc_class_mean = avg_class, step = epoch)
     return avg_top1, avg_top5
 
 
@@ -0,0 +1,98 @@
+"""
+One forward pass over a whole mixed batch, with selectable BatchNorm statistics.
+
+The training step used to split the mixed batch into chunks of `batch` samples and call the
+model once per chunk, so every BatchNorm normalized each chunk with its own statistics. Here
+the model runs once over the concatenated batch; within batchnorm_groups() every BatchNorm
+layer normalizes consecutive groups of samples separately, which keeps the chunked statistics
+(and the same running-stat updates) while the convolutions see one large batch.
+
+bn_mode:
+    chunk       groups of the chunked loop: batch, batch, ..., rest
+    interleave  the same groups after MixMatch's interleave(), so that every group holds a
+                share of the labeled samples
+    full        a single group, statistics over the whole batch
+"""
+
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+@contextmanager
+def batchnorm_groups(model, sizes):
+    """Within the block, every BatchNorm of model in training mode normalizes each consecutive
+    group of `sizes` samples with the group's own statistics. sizes=None leaves them alone.
+
+    The forward of the BatchNorm modules is patched in place, so the model must not be wrapped
+    in DataParallel while the block is active.
+    """
+    if sizes is None or len(sizes) <= 1:
+        yield
+        return
+
+    def grouped(bn):
+        def forward(x):
+            if not bn.training:
+                return type(bn).forward(bn, x)
+            return torch.cat([type(bn).forward(bn, part) for part in x.split(sizes)], dim=0)
+        return forward
+
+    bns = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    for bn in bns:
+        bn.forward = grouped(bn)
+    try:
+        yield
+    finally:
+        for bn in bns:
+            del bn.forward
+
+
+def _interleave_offsets(batch, nu):
+    groups = [batch // (nu + 1)] * (nu + 1)
+    for x in range(batch - sum(groups)):
+        groups[-x - 1] += 1
+    offsets = [0]
+    for g in groups:
+        offsets.append(offsets[-1] + g)
+    return offsets
+
+
+def group_order(n, batch, bn_mode, device=None):
+    """(order, sizes) of a mixed batch of n samples: the model sees inputs[order] (order is None
+    for the identity) and BatchNorm statistics are taken per consecutive group of `sizes`."""
+    if bn_mode == 'full':
+        return None, None
+    index = list(torch.arange(n, device=device).split(batch))
+    if bn_mode == 'chunk':
+        return None, [len(v) for v in index]
+    if bn_mode != 'interleave':
+        raise ValueError('unknown bn_mode {}'.format(bn_mode))
+
+    # interleave() from main.py, applied to the sample indices
+    nu = len(index) - 1
+    offsets = _interleave_offsets(batch, nu)
+    index = [[v[offsets[p]:offsets[p + 1]] for p in range(nu + 1)] for v in index]
+    for i in range(1, nu + 1):
+        index[0][i], index[i][i] = index[i][i], index[0][i]
+    index = [torch.cat(v, dim=0) for v in index]
+    return torch.cat(index, dim=0), [len(v) for v in index]
+
+
+def fused_forward(model, inputs, batch, bn_mode='chunk'):
+    """model(inputs) in one pass, with the BatchNorm groups of bn_mode. The outputs are in the
+    order of inputs."""
+    n = inputs.size(0)
+    order, sizes = group_order(n, batch, bn_mode, inputs.device)
+    if order is not None:
+        inputs = inputs[order]
+    with batchnorm_groups(model, sizes):
+        outputs = model(inputs)
+    if order is None:
+        return outputs
+
+    inverse = torch.empty_like(order)
+    inverse[order] = torch.arange(n, device=order.device)
+    return tuple(out[inverse] if torch.is_tensor(out) and out.dim() > 0 and out.size(0) == n else out
+                 for out in outputs)
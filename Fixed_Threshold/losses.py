@@ -0,0 +1,125 @@
+"""
+Label guessing, mixup and the MixMatch loss terms with as few (N, C) temporaries as possible.
+
+The training step used to write the guessed labels as
+    pred_u_all = (softmax(u1) + softmax(u2)) / 2;  pt = pred_u_all**(1/T);  pt / pt.sum()
+the mixup as lamda * a + (1 - lamda) * b for the inputs and the targets, and the losses through
+a full log_softmax / softmax of the logits. Every one of those expressions allocates a new
+tensor per op. Here the guess and the sharpening reuse their buffers in place, mixup is one
+lerp into the permuted copy, the MSE term is a single mse_loss and the soft cross entropy is
+taken as
+    sum(t * x) - logsumexp(x) * sum(t)
+which needs no (N, C) log-probabilities. The functions are TorchScript, so the graph executor
+can fuse the elementwise parts on the GPU.
+
+The losses have the same values and gradients as the former expressions up to float rounding;
+`python benchmark.py loss` checks both and times the two versions.
+"""
+
+from contextlib import contextmanager
+
+import torch
+
+
+@contextmanager
+def _fp32():
+    yield
+
+
+def autocast(precision, device_type):
+    """Context of --precision for the forwards: nothing for fp32, bfloat16 autocast on
+    device_type ('cpu' or 'cuda') for bf16. The weights stay fp32, outputs may be bfloat16."""
+    if precision == 'fp32':
+        return _fp32()
+    if precision != 'bf16':
+        raise ValueError('unknown precision {}'.format(precision))
+    if not hasattr(torch, 'autocast'):
+        raise ValueError('--precision bf16 needs torch >= 1.10, this is {}'.format(torch.__version__))
+    return torch.autocast(device_type, dtype=torch.bfloat16)
+
+
+@torch.jit.script
+def guess_labels(logits_u1, logits_u2, T: float):
+    """(average of the two views' softmax, the same sharpened with temperature T).
+    Works in place on its temporaries, so it is meant for the no-grad label guessing."""
+    probs = torch.softmax(logits_u1, dim=1)
+    probs.add_(torch.softmax(logits_u2, dim=1)).mul_(0.5)
+    sharpened = probs.pow(1.0 / T)
+    sharpened.div_(sharpened.sum(dim=1, keepdim=True))
+    return probs, sharpened
+
+
+@torch.jit.script
+def sharpen(probs, T: float):
+    """probs**(1/T) renormalized over the classes."""
+    sharpened = probs.pow(1.0 / T)
+    return sharpened.div_(sharpened.sum(dim=1, keepdim=True))
+
+
+def mixup(x, index, lamda):
+    """lamda * x + (1 - lamda) * x[index], as one gather and one in-place lerp."""
+    mixed = x[index]
+    return mixed.lerp_(x, float(lamda))
+
+
+@torch.jit.script
+def soft_cross_entropy(logits, targets):
+    """-mean(sum(log_softmax(logits) * targets, 1)) without the log_softmax tensor."""
+    dot = (logits * targets).sum(dim=1)
+    return (torch.logsumexp(logits, dim=1) * targets.sum(dim=1) - dot).mean()
+
+
+@torch.jit.script
+def softmax_mse(logits, targets):
+    """mean((softmax(logits) - targets)**2) over all elements."""
+    return torch.nn.functional.mse_loss(torch.softmax(logits, dim=1), targets)
+
+
+class MixupBuffers(object):
+    """Mixup into two max-size input buffers and two target buffers that are reused every step.
+
+    The number of selected unlabeled samples changes from step to step, so the torch.cat,
+    the permuted copy and the blend used to allocate differently sized tensors each time,
+    which fragments the caching allocator. Here the labeled and unlabeled samples are copied
+    into rows [0, n) of the first buffer, the permutation is gathered into the second one and
+    blended there in place; the mixed batch is a view of its first n rows. The views are
+    overwritten by the next call, so they must not outlive the step.
+
+    The buffers hold max_size rows and grow if a step needs more.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.inputs = None
+        self.targets = None
+
+    def _buffers(self, buffers, n, like):
+        # (source, mixed) buffers of at least n rows shaped like `like`, reallocated only when needed
+        if buffers is None or buffers[0].size(0) < n or buffers[0].shape[1:] != like.shape[1:] \
+                or buffers[0].dtype != like.dtype or buffers[0].device != like.device:
+            rows = max(n, self.max_size)
+            return [like.new_empty((rows,) + like.shape[1:]) for _ in range(2)]
+        return buffers
+
+    def _fill(self, buffers, parts, perm, lamda):
+        n = perm.size(0)
+        source, mixed = buffers[0][:n], buffers[1][:n]
+        start = 0
+        for part in parts:
+            source[start:start + part.size(0)].copy_(part)
+            start += part.size(0)
+        torch.index_select(source, 0, perm, out=mixed)
+        return mixed.lerp_(source, lamda)
+
+    def __call__(self, inputs_x, targets_x, inputs_u1, inputs_u2, targets_u, lamda):
+        """(mixed inputs, mixed targets) of cat([x, u1, u2]) with a random permutation of itself."""
+        n = inputs_x.size(0) + inputs_u1.size(0) + inputs_u2.size(0)
+        perm = torch.randperm(n, device=inputs_x.device)
+
+        self.inputs = self._buffers(self.inputs, n, inputs_x)
+        self.targets = self._buffers(self.targets, n, targets_x)
+
+        lamda = float(lamda)
+        mixed_input = self._fill(self.inputs, (inputs_x, inputs_u1, inputs_u2), perm, lamda)
+        mixed_target = self._fill(self.targets, (targets_x, targets_u, targets_u), perm, lamda)
+        return mixed_input, mixed_target
@@ -0,0 +1,107 @@
+"""
+Accuracy and confidence metrics that stay on the device.
+
+The former helpers (top_1_accuracy_score_with_confidence, top_n_accuracy_score) copied the
+logits to the host, ran np.argsort over all classes and walked the batch in Python with one
+.item() per correct sample. topk_metrics() does the same with a single torch.topk on the
+device, and DeviceMeter keeps its running sum there too, so a training step no longer syncs
+for bookkeeping; the values are read (and the device synced) only when they are printed or
+reported.
+"""
+
+import torch
+
+
+def topk_metrics(logits, targets, ks=(1, 5)):
+    """Top-k accuracies and the confidence of the top-1 hits of one batch.
+
+    Returns a dict of 0-dim tensors on the device of logits:
+        top<k>      accuracy in percent for every k in ks
+        conf_avg    mean softmax probability of the correctly classified samples (0 if none)
+        conf_min    smallest such probability (0 if none)
+        correct     number of top-1 hits
+    """
+    probs = torch.softmax(logits.detach(), dim=1)
+    conf, pred = probs.topk(min(max(ks), probs.size(1)), dim=1)
+    hits = pred == targets.view(-1, 1).to(pred.device)
+    out = {}
+    for k in ks:
+        out['top{}'.format(k)] = hits[:, :k].any(1).float().mean() * 100
+
+    top1 = hits[:, 0]
+    correct = top1.sum()
+    zero = conf.new_zeros(())
+    conf = conf[:, 0]
+    out['conf_avg'] = torch.where(correct > 0, (conf * top1.float()).sum() / correct.clamp(min=1).float(), zero)
+    out['conf_min'] = torch.where(correct > 0, conf.masked_fill(~top1, 1.0).min(), zero)
+    out['correct'] = correct
+    return out
+
+
+def class_counts(logits, targets, num_classes):
+    """(top-1 hits, samples) per class, as two int64 tensors of length num_classes."""
+    targets = targets.view(-1).to(logits.device)
+    hits = logits.argmax(1) == targets
+    total = torch.bincount(targets, minlength=num_classes)
+    correct = torch.bincount(targets[hits], minlength=num_classes)
+    return correct, total
+
+
+class DeviceMeter(object):
+    """Computes and stores the average and current value, without syncing.
+
+    update() accepts numbers or tensors; tensors are only added to the running sum, so val,
+    sum and avg are 0-dim tensors on their device once a tensor has been seen. float(meter.avg)
+    or meter.item() reads them back.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0
+        self.sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        if torch.is_tensor(val):
+            val = val.detach()
+        self.val = val
+        self.sum = self.sum + val * n
+        self.count += n
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return 0
+        return self.sum / self.count
+
+    def item(self):
+        """(val, avg) as floats."""
+        return float(self.val), float(self.avg)
+
+
+class ClassMeter(object):
+    """Per-class top-1 hits and sample counts, accumulated on the device."""
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.correct = 0
+        self.total = 0
+
+    def update(self, logits, targets):
+        correct, total = class_counts(logits, targets, self.num_classes)
+        self.correct = self.correct + correct
+        self.total = self.total + total
+
+    def accuracy(self):
+        """Per-class accuracy in percent, NaN for classes without samples."""
+        total = self.total.float()
+        return torch.where(total > 0, self.correct.float() * 100 / total.clamp(min=1), torch.full_like(total, float('nan')))
+
+    def mean_accuracy(self):
+        """Accuracy averaged over the classes that have samples, as a float."""
+        total = self.total.float()
+        seen = total > 0
+        return float((self.correct.float()[seen] / total[seen]).mean() * 100)
@@ -5,6 +5,7 @@ from torchvision import models
 from torch.autograd import Variable
 import torch.utils.model_zoo as model_zoo
 
+import copy
 import math
 from collections import OrderedDict
 import re
@@ -105,10 +106,10 @@ class ClassBlock(nn.Module):
 # Define the ResNet18-based Model
 ######################################################################     
 class Res18_basic(nn.Module):
-    def __init__(self, class_num):
+    def __init__(self, class_num, pretrained=True):
         super(Res18_basic, self).__init__()
         fea_dim = 256
-        model_ft = models.resnet18(pretrained=True)
+        model_ft = models.resnet18(pretrained=pretrained)
         model_ft.avgpool = nn.AdaptiveAvgPool2d((1,1))
         model_ft.fc = nn.Sequential()
         self.model = model_ft
@@ -134,10 +135,10 @@ class Res18_basic(nn.Module):
 
 # Define the ResNet18-based Model
 class Res18(nn.Module):
-    def __init__(self, class_num):
+    def __init__(self, class_num, pretrained=True):
         super(Res18, self).__init__()
         fea_dim = 256
-        model_ft = models.resnet18(pretrained=True)
+        model_ft = models.resnet18(pretrained=pretrained)
         model_ft.avgpool = nn.AdaptiveAvgPool2d((1,1))
         model_ft.fc = nn.Sequential()
         self.model = model_ft
@@ -163,10 +164,10 @@ class Res18(nn.Module):
     
         
 class Res50(nn.Module):
-    def __init__(self, class_num):
+    def __init__(self, class_num, pretrained=True):
         super(Res50, self).__init__()
         fea_dim = 256        
-        model_ft = models.resnet50(pretrained=True)
+        model_ft = models.resnet50(pretrained=pretrained)
         model_ft.avgpool = nn.AdaptiveAvgPool2d((1,1))
         model_ft.fc = nn.Sequential()        
         self.model = model_ft
@@ -191,15 +192,15 @@ class Res50(nn.Module):
         return embed_fea, pred     
         
 class Dense121(nn.Module):
-    def __init__(self, class_num):
+    def __init__(self, class_num, pretrained=True):
         super(Dense121, self).__init__()
         fea_dim = 256        
-        model_ft = models.densenet121(pretrained=True)
+        model_ft = models.densenet121(pretrained=pretrained)
         model_ft.features.classifier = nn.Sequential()
         model_ft.features.avgpool = nn.AdaptiveAvgPool2d((1,1))
         model_ft.features.fc_embed = nn.Linear(1024, fea_dim)
         model_ft.features.fc_embed.apply(weights_init_classifier)  
-        model_ft.classifier = ClassBlock(2048, class_num)
+        model_ft.classifier = ClassBlock(1024, class_num)
         model_ft.classifier.apply(weights_init_classifier)  
         self.model = model_ft
         
@@ -220,7 +221,119 @@ class Dense121(nn.Module):
         fea =  x.view(x.size(0), -1)
         embed_fea = self.model.features.fc_embed(fea)
         pred = self.model.classifier(fea)        
-        return embed_fea, pred              
-        
+        return embed_fea, pred
+
+
+######################################################################
+# Memory format and graph execution
+######################################################################
+def _is_tracing():
+    return torch._C._get_tracing_state() is not None
+
+def _autocast_state():
+    # a trace keeps the dtypes autocast chose while it was recorded
+    if not hasattr(torch, 'is_autocast_enabled'):
+        return ()
+    try:
+        return tuple(torch.is_autocast_enabled(device) for device in ('cpu', 'cuda'))
+    except TypeError:
+        # torch < 2.4: no device argument, CPU autocast (if any) has its own query
+        return (torch.is_autocast_enabled(), getattr(torch, 'is_autocast_cpu_enabled', lambda: False)())
+
+class _TensorOutputs(nn.Module):
+    # the model without its non-tensor outputs (EfficientNet's -1), torch.jit.trace only returns tensors
+    def __init__(self, model):
+        super(_TensorOutputs, self).__init__()
+        self.model = model
+        self.structure = None
+
+    def forward(self, x):
+        outputs = self.model(x)
+        self.structure = [None if torch.is_tensor(out) else out for out in outputs]
+        return tuple(out for out in outputs if torch.is_tensor(out))
+
+class GraphForward(object):
+    """model.forward as set by set_execution_mode().
+
+    Converts 4-d inputs to channels_last if asked, then runs the model eagerly, through a
+    torch.jit.trace per (training, autocast state, input shape, dtype, device) or through
+    torch.compile with dynamic shapes. The adaptive threshold changes the mixed batch size from
+    step to step, so at most max_shapes traces are kept and further shapes run eagerly. A trace
+    is made with the BatchNorm forwards of that moment, so batches with fused_forward's grouped
+    statistics or with block checkpointing in training also run eagerly.
+    """
+    def __init__(self, model, channels_last=False, graph='none', max_shapes=8):
+        self.model = model
+        self.channels_last = channels_last
+        self.graph = graph
+        self.max_shapes = max_shapes
+        self.eager = type(model).forward.__get__(model, type(model))
+        self.traces = OrderedDict()
+        self.compiled = None
+        self.bns = None
+
+    def __deepcopy__(self, memo):
+        # a copy of the model (e.g. fuse_for_inference) gets its own, empty set of traces
+        return GraphForward(copy.deepcopy(self.model, memo), self.channels_last, self.graph, self.max_shapes)
+
+    def _eager_only(self):
+        if self.bns is None:
+            self.bns = [m for m in self.model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        if self.model.training and getattr(self.model, '_checkpoint_blocks', 0) > 0:
+            return True
+        return any('forward' in bn.__dict__ for bn in self.bns)
+
+    def _trace(self, x):
+        # tracing runs the forward once, which must not count for the BatchNorm running statistics
+        buffers = [b.clone() for bn in self.bns for b in bn.buffers()]
+        wrapper = _TensorOutputs(self.model)
+        try:
+            traced = torch.jit.trace(wrapper, x, check_trace=False)
+        finally:
+            with torch.no_grad():
+                for b, saved in zip([b for bn in self.bns for b in bn.buffers()], buffers):
+                    b.copy_(saved)
+        return traced, wrapper.structure
+
+    def __call__(self, x):
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.graph == 'none' or _is_tracing():
+            return self.eager(x)
+        if self.graph == 'compile':
+            if self.compiled is None:
+                self.compiled = torch.compile(self.eager, dynamic=True)
+            return self.compiled(x)
+        if self._eager_only():
+            return self.eager(x)
+
+        key = (self.model.training, _autocast_state(), tuple(x.shape), x.dtype, x.device)
+        entry = self.traces.get(key)
+        if entry is None:
+            if len(self.traces) >= self.max_shapes:
+                return self.eager(x)
+            entry = self.traces[key] = self._trace(x)
+        traced, structure = entry
+        outputs = traced(x)
+        outputs = iter((outputs,) if torch.is_tensor(outputs) else outputs)
+        return tuple(next(outputs) if value is None else value for value in structure)
+
+def set_execution_mode(model, channels_last=False, graph='none', max_shapes=8):
+    """Memory format and graph execution of an EfficientNet or of Res18/Res50/Dense121, in place.
 
-            
\ No newline at end of file
+    channels_last: parameters and 4-d inputs in NHWC (torch >= 1.5)
+    graph: 'none' (eager), 'trace' (torch.jit.trace per input shape, at most max_shapes of
+           them) or 'compile' (torch.compile with dynamic shapes, torch >= 2.0)
+    The state_dict is unchanged, so checkpoints load either way.
+    """
+    if graph not in ('none', 'trace', 'compile'):
+        raise ValueError('unknown graph mode {}'.format(graph))
+    if channels_last and not hasattr(torch, 'channels_last'):
+        raise ValueError('channels_last needs torch >= 1.5, this is {}'.format(torch.__version__))
+    if graph == 'compile' and not hasattr(torch, 'compile'):
+        raise ValueError('graph mode compile needs torch >= 2.0, this is {}'.format(torch.__version__))
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if channels_last or graph != 'none':
+        model.forward = GraphForward(model, channels_last, graph, max_shapes)
+    return model
@@ -0,0 +1,165 @@
+"""
+Metric reporting that never blocks the training step, with a local stand-in for nsml.
+
+    from reporting import nsml, DATASET_PATH, IS_ON_NSML
+
+`nsml` here is a session object with the calls the training scripts make. report() only appends
+the step and the metrics to a bounded ring buffer; values may be 0-dim tensors on the GPU and
+are converted to floats later. A background thread drains the buffer every `interval` seconds:
+it writes one JSON line per report and one CSV row (time, step, name, value) per metric, and
+forwards the report to the real nsml when running there. save, load, bind and paused go to the
+real nsml if it can be imported and to LocalNSML otherwise, so the scripts also run without it.
+"""
+
+import os
+import csv
+import json
+import time
+import atexit
+import threading
+import collections
+
+import torch
+
+try:
+    import nsml as _nsml
+except ImportError:
+    _nsml = None
+
+
+class LocalNSML(object):
+    """The parts of the nsml API used by the training scripts, for runs outside nsml.
+
+    bind() keeps the save/load/infer functions; save(checkpoint) and load(checkpoint) call them
+    with the directory root/checkpoint. report() does nothing, the session writes the files.
+    """
+
+    IS_ON_NSML = False
+    DATASET_PATH = os.environ.get('DATASET_PATH', 'fashion_demo')
+
+    def __init__(self, root='runs'):
+        self.root = root
+        self.functions = {}
+
+    def bind(self, save=None, load=None, infer=None, **kwargs):
+        self.functions.update(save=save, load=load, infer=infer)
+
+    def save(self, checkpoint, **kwargs):
+        if self.functions.get('save') is not None:
+            self.functions['save'](os.path.join(self.root, str(checkpoint)))
+
+    def load(self, checkpoint, session=None, **kwargs):
+        if self.functions.get('load') is not None:
+            self.functions['load'](os.path.join(self.root, str(checkpoint)))
+
+    def paused(self, scope=None):
+        pass
+
+    def report(self, summary=False, scope=None, **kwargs):
+        pass
+
+
+def _to_float(value):
+    if isinstance(value, torch.Tensor):
+        return value.item()
+    return float(value)
+
+
+class MetricBuffer(object):
+    """Ring buffer of reports, flushed by a daemon thread.
+
+    put() is an O(1) append under the GIL; when `capacity` reports are waiting the oldest is
+    dropped and counted in `dropped`. Files are appended to, `path` + '.jsonl' and '.csv'.
+    """
+
+    def __init__(self, path=None, interval=10.0, capacity=65536, forward=None):
+        self.path = path
+        self.interval = interval
+        self.forward = forward
+        self.queue = collections.deque(maxlen=capacity)
+        self.dropped = 0
+        self.written = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, step, summary, metrics):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((time.time(), step, summary, metrics))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """Writes out everything reported so far. Safe to call from any thread."""
+        with self._lock:
+            reports = []
+            while self.queue:
+                reports.append(self.queue.popleft())
+            if not reports:
+                return
+            rows = []
+            for t, step, summary, metrics in reports:
+                values = {name: _to_float(value) for name, value in metrics.items()}
+                step = _to_float(step) if step is not None else None
+                rows.append((t, step, summary, values))
+                if self.forward is not None:
+                    self.forward(summary=summary, step=step, **values)
+            if self.path is not None:
+                with open(self.path + '.jsonl', 'a') as f:
+                    for t, step, _, values in rows:
+                        f.write(json.dumps(dict(values, time=t, step=step)) + '\n')
+                with open(self.path + '.csv', 'a') as f:
+                    writer = csv.writer(f)
+                    for t, step, _, values in rows:
+                        for name, value in values.items():
+                            writer.writerow([t, step, name, value])
+            self.written += len(rows)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+class Session(object):
+    """report() into a MetricBuffer, everything else to the backend (nsml or LocalNSML)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.buffer = None
+
+    def configure(self, path=None, interval=10.0, capacity=65536):
+        """Starts the flush thread. Without a call, the first report() starts it with the defaults
+        and no files."""
+        if self.buffer is not None:
+            self.buffer.close()
+        forward = self.backend.report if self.backend.IS_ON_NSML else None
+        self.buffer = MetricBuffer(path, interval, capacity, forward)
+        return self.buffer
+
+    def report(self, summary=False, scope=None, step=None, **metrics):
+        if self.buffer is None:
+            self.configure()
+        # tensors are only referenced here, .item() happens on the flush thread
+        metrics = {name: value.detach() if isinstance(value, torch.Tensor) else value for name, value in metrics.items()}
+        self.buffer.put(step, summary, metrics)
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+nsml = Session(_nsml if _nsml is not None else LocalNSML())
+IS_ON_NSML = nsml.IS_ON_NSML
+DATASET_PATH = nsml.DATASET_PATH
+atexit.register(nsml.close)
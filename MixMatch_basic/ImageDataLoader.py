@@ -1,6 +1,10 @@
 from PIL import Image
 import os
 import os.path
+import time
+import queue
+import itertools
+import threading
 import torch.utils.data
 import torchvision.transforms as transforms
 import numpy as np
@@ -17,6 +21,185 @@ class TransformTwice:
         out2 = self.transform(inp)
         return out1, out2
 
+class InfiniteSampler(torch.utils.data.Sampler):
+    """Shuffled indices of data_source, one fresh permutation after another, forever.
+
+    A DataLoader over this sampler never runs out, so its iterator (and the worker processes
+    behind it) is created once for the whole run instead of once per pass. len() is one pass.
+    """
+
+    def __init__(self, data_source, shuffle=True):
+        self.num_samples = len(data_source)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        while True:
+            order = torch.randperm(self.num_samples) if self.shuffle else torch.arange(self.num_samples)
+            for index in order.tolist():
+                yield index
+
+    def __len__(self):
+        return self.num_samples
+
+def _batch_len(batch):
+    # samples in a collated batch: the length of its first tensor
+    while not isinstance(batch, torch.Tensor):
+        batch = batch[0]
+    return batch.size(0)
+
+class PairedStreamLoader(object):
+    """Endless (labeled batch, unlabeled batch) pairs from two DataLoaders over InfiniteSamplers.
+
+    Both iterators are created once and kept for the whole run, so the workers are never torn
+    down and an exception raised while loading reaches the training loop. A training epoch is
+    len(labeled_loader) steps, see epoch(); the unlabeled stream runs through its own passes
+    independently. Callbacks registered with on_epoch_end are called as fn(stream, epoch) every
+    time the 'labeled' or the 'unlabeled' stream has gone through its dataset once more. Passes
+    are counted in samples, so batches of varying size are fine.
+    """
+
+    def __init__(self, labeled, unlabeled):
+        for loader in (labeled, unlabeled):
+            if not isinstance(getattr(loader.batch_sampler, 'sampler', None), InfiniteSampler):
+                raise ValueError('PairedStreamLoader needs DataLoaders built with sampler=InfiniteSampler(dataset)')
+        self.loaders = {'labeled': labeled, 'unlabeled': unlabeled}
+        self.batches = {'labeled': 0, 'unlabeled': 0}
+        self.samples = {'labeled': 0, 'unlabeled': 0}
+        self.epochs = {'labeled': 0, 'unlabeled': 0}
+        self.callbacks = []
+        self._iters = None
+
+    @property
+    def labeled(self):
+        return self.loaders['labeled']
+
+    @property
+    def unlabeled(self):
+        return self.loaders['unlabeled']
+
+    def __len__(self):
+        return len(self.labeled)
+
+    def on_epoch_end(self, fn):
+        self.callbacks.append(fn)
+
+    def _next(self, stream):
+        batch = next(self._iters[stream])
+        loader = self.loaders[stream]
+        self.batches[stream] += 1
+        self.samples[stream] += _batch_len(batch)
+        epoch = self.samples[stream] // len(loader.dataset)
+        while self.epochs[stream] < epoch:
+            self.epochs[stream] += 1
+            for fn in self.callbacks:
+                fn(stream, self.epochs[stream])
+        return batch
+
+    def __iter__(self):
+        if self._iters is None:
+            self._iters = {stream: iter(loader) for stream, loader in self.loaders.items()}
+        while True:
+            yield self._next('labeled'), self._next('unlabeled')
+
+    def epoch(self):
+        """The next len(self) pairs."""
+        return itertools.islice(iter(self), len(self))
+
+class DevicePrefetcher(object):
+    """Stages the next (labeled, unlabeled) pair of a PairedStreamLoader on the training device
+    while the current step computes.
+
+    Labeled batches come out as (inputs_x, targets, onehot_targets), with the one-hot matrix
+    built directly on the device; unlabeled batches keep their structure. On CUDA the copies are
+    issued from pinned memory on a side stream and the compute stream only waits for them when
+    the pair is handed out. Without CUDA a background thread keeps the next pairs loaded, so
+    collation and pinning in the loader overlap with the step instead of preceding it.
+
+    last_wait and total_wait are the seconds the training loop spent blocked on data.
+    """
+
+    def __init__(self, stream, num_classes, device, depth=2):
+        self.stream = stream
+        self.num_classes = num_classes
+        self.device = torch.device(device)
+        self.depth = depth
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+        self.steps = 0
+        self._pairs = None
+        self._cuda_stream = None
+        self._staged = None
+        self._queue = None
+
+    def __len__(self):
+        return len(self.stream)
+
+    def _to_device(self, obj):
+        if isinstance(obj, torch.Tensor):
+            return obj.to(self.device, non_blocking=True)
+        if isinstance(obj, (tuple, list)):
+            return type(obj)(self._to_device(o) for o in obj)
+        return obj
+
+    def _stage(self, pair):
+        (inputs_x, targets_x), data_u = pair
+        inputs_x, targets_x, data_u = self._to_device((inputs_x, targets_x, data_u))
+        onehot = torch.zeros(targets_x.size(0), self.num_classes, device=self.device)
+        onehot.scatter_(1, targets_x.view(-1, 1), 1)
+        return (inputs_x, targets_x, onehot), data_u
+
+    def _record(self, obj):
+        # the side-stream tensors are now used on the compute stream, keep the allocator in sync
+        if isinstance(obj, torch.Tensor):
+            obj.record_stream(torch.cuda.current_stream())
+        elif isinstance(obj, (tuple, list)):
+            for o in obj:
+                self._record(o)
+
+    def _stage_cuda(self):
+        pair = next(self._pairs)
+        with torch.cuda.stream(self._cuda_stream):
+            self._staged = self._stage(pair)
+
+    def _fill(self):
+        try:
+            for pair in self._pairs:
+                self._queue.put((True, self._stage(pair)))
+        except Exception as e:
+            self._queue.put((False, e))
+
+    def _start(self):
+        self._pairs = iter(self.stream)
+        if self.device.type == 'cuda':
+            self._cuda_stream = torch.cuda.Stream(self.device)
+            self._stage_cuda()
+        else:
+            self._queue = queue.Queue(maxsize=self.depth)
+            threading.Thread(target=self._fill, daemon=True).start()
+
+    def __iter__(self):
+        if self._pairs is None:
+            self._start()
+        while True:
+            start = time.time()
+            if self._cuda_stream is not None:
+                torch.cuda.current_stream().wait_stream(self._cuda_stream)
+                pair = self._staged
+                self._record(pair)
+                self._stage_cuda()
+            else:
+                ok, pair = self._queue.get()
+                if not ok:
+                    raise pair
+            self.last_wait = time.time() - start
+            self.total_wait += self.last_wait
+            self.steps += 1
+            yield pair
+
+    def epoch(self):
+        """The next len(self) pairs."""
+        return itertools.islice(iter(self), len(self))
+
 class SimpleImageLoader(torch.utils.data.Dataset):
     def __init__(self, rootdir, split, ids=None, transform=None, loader=default_image_loader):
         if split == 'test':
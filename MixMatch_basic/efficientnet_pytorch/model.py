@@ -1,6 +1,10 @@
+import copy
+import inspect
+
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .utils import (
     round_filters,
@@ -12,8 +16,15 @@ from .utils import (
     load_pretrained_weights,
     Swish,
     MemoryEfficientSwish,
+    SiLU,
+    Identity,
+    PointwiseLinear,
+    fuse_conv_bn,
 )
 
+# the segments are written for reentrant checkpointing; newer torch asks for the choice explicitly
+_CHECKPOINT_KWARGS = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
 class MBConvBlock(nn.Module):
     """
     Mobile Inverted Residual Bottleneck Block
@@ -97,6 +108,21 @@ class MBConvBlock(nn.Module):
         """Sets swish function as memory efficient (for training) or standard (for export)"""
         self._swish = MemoryEfficientSwish() if memory_efficient else Swish()
 
+    def fuse_for_inference(self):
+        """Folds _bn0, _bn1 and _bn2 into the preceding convolutions, replaces the squeeze and
+        excitation convolutions by matrix products and switches to SiLU. In place, eval only."""
+        if self._block_args.expand_ratio != 1:
+            self._expand_conv = fuse_conv_bn(self._expand_conv, self._bn0)
+            self._bn0 = Identity()
+        self._depthwise_conv = fuse_conv_bn(self._depthwise_conv, self._bn1)
+        self._bn1 = Identity()
+        if self.has_se:
+            self._se_reduce = PointwiseLinear(self._se_reduce)
+            self._se_expand = PointwiseLinear(self._se_expand)
+        self._project_conv = fuse_conv_bn(self._project_conv, self._bn2)
+        self._bn2 = Identity()
+        self._swish = SiLU()
+
 
 class EfficientNet(nn.Module):
     """
@@ -160,6 +186,7 @@ class EfficientNet(nn.Module):
         self._dropout = nn.Dropout(self._global_params.dropout_rate)
         self._fc = nn.Linear(out_channels, self._global_params.num_classes)
         self._swish = MemoryEfficientSwish()
+        self._checkpoint_blocks = 0
 
     def set_swish(self, memory_efficient=True):
         """Sets swish function as memory efficient (for training) or standard (for export)"""
@@ -167,6 +194,69 @@ class EfficientNet(nn.Module):
         for block in self._blocks:
             block.set_swish(memory_efficient)
 
+    def set_checkpointing(self, blocks_per_segment=0):
+        """
+        Activation checkpointing over self._blocks: in training mode with gradients enabled, the
+        blocks run in segments of blocks_per_segment, and only the input of every segment is kept
+        for the backward pass, which runs the segment forward again. 0 turns it off.
+        """
+        self._checkpoint_blocks = blocks_per_segment
+
+    def _checkpoint_segment(self, blocks, rates, x):
+        # BatchNorm forwards patched by the caller (fused_forward's grouped statistics) are gone by
+        # the time backward recomputes the segment, so they are kept and put back for the recompute
+        bns = [m for block in blocks for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        forwards = [bn.__dict__.get('forward') for bn in bns]
+        calls = [0]
+
+        def run(x):
+            # the first call is the forward, a second one is the recompute in backward
+            recompute = calls[0] > 0
+            calls[0] += 1
+            if recompute:
+                momenta = [bn.momentum for bn in bns]
+                # the recompute would count the batch a second time
+                tracked = [None if bn.num_batches_tracked is None else bn.num_batches_tracked.clone() for bn in bns]
+                for bn, forward in zip(bns, forwards):
+                    bn.momentum = 0.0  # the first forward already updated the running statistics
+                    if forward is not None:
+                        bn.forward = forward
+            try:
+                for block, rate in zip(blocks, rates):
+                    x = block(x, drop_connect_rate=rate)
+            finally:
+                if recompute:
+                    for bn, momentum, count, forward in zip(bns, momenta, tracked, forwards):
+                        bn.momentum = momentum
+                        if count is not None:
+                            with torch.no_grad():
+                                bn.num_batches_tracked.copy_(count)
+                        if forward is not None:
+                            del bn.forward
+            return x
+
+        # the RNG state is restored for the recompute, so drop_connect drops the same samples
+        return checkpoint(run, x, **_CHECKPOINT_KWARGS)
+
+    def fuse_for_inference(self):
+        """
+        Returns a copy for inference with the outputs of this model in eval mode: every BatchNorm
+        is folded into its convolution, swish is a plain SiLU, the squeeze and excitation path runs
+        as matrix products and dropout is gone. The copy has no gradients and must stay in eval
+        mode; this model is left unchanged.
+        """
+        model = copy.deepcopy(self).eval()
+        model._conv_stem = fuse_conv_bn(model._conv_stem, model._bn0)
+        model._bn0 = Identity()
+        for block in model._blocks:
+            block.fuse_for_inference()
+        model._conv_head = fuse_conv_bn(model._conv_head, model._bn1)
+        model._bn1 = Identity()
+        model._dropout = Identity()
+        model._swish = SiLU()
+        for param in model.parameters():
+            param.requires_grad_(False)
+        return model
 
     def extract_features(self, inputs):
         """ Returns output of the final convolution layer """
@@ -175,11 +265,19 @@ class EfficientNet(nn.Module):
         x = self._swish(self._bn0(self._conv_stem(inputs)))
 
         # Blocks
-        for idx, block in enumerate(self._blocks):
+        rates = []
+        for idx in range(len(self._blocks)):
             drop_connect_rate = self._global_params.drop_connect_rate
             if drop_connect_rate:
                 drop_connect_rate *= float(idx) / len(self._blocks)
-            x = block(x, drop_connect_rate=drop_connect_rate)
+            rates.append(drop_connect_rate)
+        if self._checkpoint_blocks > 0 and self.training and torch.is_grad_enabled() and x.requires_grad:
+            n = self._checkpoint_blocks
+            for start in range(0, len(self._blocks), n):
+                x = self._checkpoint_segment(self._blocks[start:start + n], rates[start:start + n], x)
+        else:
+            for block, drop_connect_rate in zip(self._blocks, rates):
+                x = block(x, drop_connect_rate=drop_connect_rate)
 
         # Head
         x = self._swish(self._bn1(self._conv_head(x)))
@@ -25,69 +25,22 @@ from torchvision import datasets, models, transforms
 import tensorflow as tf
 import torch.nn.functional as F
 
-from ImageDataLoader import SimpleImageLoader
-from models import Res18, Res50
+from ImageDataLoader import SimpleImageLoader, InfiniteSampler, PairedStreamLoader, DevicePrefetcher
+from fused_forward import fused_forward
+from losses import autocast, guess_labels, soft_cross_entropy, softmax_mse, MixupBuffers
+from metrics import topk_metrics, DeviceMeter, ClassMeter
+from models import Res18, Res50, set_execution_mode
 from efficientnet_pytorch import EfficientNet
 
 import glob
 
-import nsml
-from nsml import DATASET_PATH, IS_ON_NSML
+# nsml if available, a local stand-in otherwise; nsml.report() is buffered, see reporting.py
+from reporting import nsml, DATASET_PATH, IS_ON_NSML
 
 NUM_CLASSES = 265
 if not IS_ON_NSML:
     DATASET_PATH = 'fashion_demo'
 
-def top_n_accuracy_score(y_true, y_prob, n=5, normalize=True):
-    num_obs, num_labels = y_prob.shape
-    idx = num_labels - n - 1
-    counter = 0
-    argsorted = np.argsort(y_prob, axis=1)
-    for i in range(num_obs):
-        if y_true[i] in argsorted[i, idx+1:]:
-            counter += 1
-    if normalize:
-        return counter * 1.0 / num_obs
-    else:
-        return counter
-
-def top_1_accuracy_score_with_confidence(y_true, y_prob, n=5, normalize=True):
-    num_obs, num_labels = y_prob.shape
-    idx = num_labels - n - 1
-    counter = 0
-    confid = []
-    y_prob_softmax = torch.softmax(y_prob, dim=1)
-    argsorted = np.argsort(y_prob.cpu().numpy(), axis=1)
-    for i in range(num_obs):
-        if y_true[i] in argsorted[i, idx+1:]:
-            counter += 1
-            confid.append(y_prob_softmax[i, argsorted[i, idx+1]].item())
-    if len(confid)==0:
-        confid_avg = 0
-        confid_min = 0
-    else:
-        confid_avg = sum(confid)/len(confid)
-        confid_min = min(confid)
-    if normalize:
-        return (counter * 1.0 / num_obs)*100, confid_avg, confid_min
-    else:
-        return counter*100, confid_avg, confid_min
-
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
 def adjust_learning_rate(opts, optimizer, epoch):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
     lr = opts.lr * (0.1 ** (epoch // 30))
@@ -103,9 +56,8 @@ def linear_rampup(current, rampup_length):
 
 class SemiLoss(object):
     def __call__(self, outputs_x, targets_x, outputs_u, targets_u, epoch, final_epoch):
-        probs_u = torch.softmax(outputs_u, dim=1)
-        Lx = -torch.mean(torch.sum(F.log_softmax(outputs_x, dim=1) * targets_x, dim=1))
-        Lu = torch.mean((probs_u - targets_u)**2)
+        Lx = soft_cross_entropy(outputs_x, targets_x)
+        Lu = softmax_mse(outputs_u, targets_u)
         return Lx, Lu, opts.lambda_u * linear_rampup(epoch, final_epoch)
 
 def interleave_offsets(batch, nu):
@@ -166,6 +118,9 @@ def _infer(model, root_path, test_loader=None):
                                ])), batch_size=opts.batchsize, shuffle=False, num_workers=4, pin_memory=True)
         print('loaded {} test images'.format(len(test_loader.dataset)))
 
+    if opts.fuse_inference:
+        # built per call, so the folded weights are always the current ones
+        model = model.fuse_for_inference()
     outputs = []
     s_t = time.time()
     for idx, image in enumerate(test_loader):
@@ -228,6 +183,17 @@ parser.add_argument('--save_epoch', type=int, default=50, help='saving epoch int
 parser.add_argument('--alpha', default=0.75, type=float)
 parser.add_argument('--lambda-u', default=150, type=float)
 parser.add_argument('--T', default=0.5, type=float)
+parser.add_argument('--fused_forward', type=int, default=0, help='one forward for label guessing and one for the mixed batch, instead of one per view and chunk')
+parser.add_argument('--bn_mode', type=str, default='interleave', choices=['chunk', 'interleave', 'full'], help='BatchNorm statistics of the fused forward, see fused_forward.py')
+parser.add_argument('--train_acc', type=str, default='exact', choices=['exact', 'probe'], help='train accuracy from a forward after every step (exact) or from a forward every train_acc_interval steps (probe)')
+parser.add_argument('--train_acc_interval', type=int, default=10, help='steps between two accuracy forwards with --train_acc probe')
+parser.add_argument('--report_dir', type=str, default='runs/metrics', help='reported metrics are appended to <report_dir>.jsonl and .csv (empty: no files)')
+parser.add_argument('--report_interval', type=float, default=10.0, help='seconds between two flushes of the reported metrics')
+parser.add_argument('--fuse_inference', type=int, default=0, help='run inference and validation on a copy with BatchNorm folded into the convolutions')
+parser.add_argument('--checkpoint_blocks', type=int, default=0, help='recompute the MBConv blocks in backward, in segments of this many blocks (0: off)')
+parser.add_argument('--channels_last', type=int, default=0, help='parameters and inputs in NHWC memory format (torch >= 1.5)')
+parser.add_argument('--graph_mode', type=str, default='none', choices=['none', 'trace', 'compile'], help='eager forward, torch.jit.trace per batch shape or torch.compile (torch >= 2.0)')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='bf16: label guessing and the mixed forward under bfloat16 autocast (torch >= 1.10)')
 
 ### DO NOT MODIFY THIS BLOCK ###
 # arguments for nsml
@@ -238,6 +204,7 @@ parser.add_argument('--mode', type=str, default='train')
 def main():
     global opts
     opts = parser.parse_args()
+    nsml.configure(opts.report_dir or None, opts.report_interval)
     opts.cuda = 0
 
     # Set GPU
@@ -251,6 +218,7 @@ def main():
 
     os.environ['CUDA_VISIBLE_DEVICES'] = opts.gpu_ids
     use_gpu = torch.cuda.is_available()
+    autocast(opts.precision, 'cuda' if use_gpu else 'cpu')  # unsupported precisions stop here, not at the first step
     if use_gpu:
         opts.cuda = 1
         print("Currently using GPU {}".format(opts.gpu_ids))
@@ -262,6 +230,7 @@ def main():
 
     # Set model
     model = EfficientNet.from_pretrained('efficientnet-b3')
+    model.set_checkpointing(opts.checkpoint_blocks)
     model.eval()
 
     parameters = filter(lambda p: p.requires_grad, model.parameters())
@@ -270,6 +239,7 @@ def main():
 
     if use_gpu:
         model.cuda()
+    set_execution_mode(model, opts.channels_last, opts.graph_mode)
 
     ### DO NOT MODIFY THIS BLOCK ###
     if IS_ON_NSML:
@@ -286,29 +256,32 @@ def main():
         # Set dataloader
         train_ids, val_ids, unl_ids = split_ids(os.path.join(DATASET_PATH, 'train/train_label'), 0.2)
         print('found {} train, {} validation and {} unlabeled images'.format(len(train_ids), len(val_ids), len(unl_ids)))
-        train_loader = torch.utils.data.DataLoader(
-            SimpleImageLoader(DATASET_PATH, 'train', train_ids,
-                              transform=transforms.Compose([
-                                  transforms.Resize(opts.imResize),
-                                  transforms.RandomResizedCrop(opts.imsize),
-                                  transforms.RandomHorizontalFlip(),
-                                  transforms.RandomVerticalFlip(),
-                                  transforms.ToTensor(),
-                                  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
-                                batch_size=opts.batchsize, shuffle=True, num_workers=4, pin_memory=True, drop_last=True)
+        train_set = SimpleImageLoader(DATASET_PATH, 'train', train_ids,
+                                      transform=transforms.Compose([
+                                          transforms.Resize(opts.imResize),
+                                          transforms.RandomResizedCrop(opts.imsize),
+                                          transforms.RandomHorizontalFlip(),
+                                          transforms.RandomVerticalFlip(),
+                                          transforms.ToTensor(),
+                                          transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),]))
+        train_loader = torch.utils.data.DataLoader(train_set, batch_size=opts.batchsize, sampler=InfiniteSampler(train_set), num_workers=4, pin_memory=True, drop_last=True)
         print('train_loader done')
 
-        unlabel_loader = torch.utils.data.DataLoader(
-            SimpleImageLoader(DATASET_PATH, 'unlabel', unl_ids,
-                              transform=transforms.Compose([
-                                  transforms.Resize(opts.imResize),
-                                  transforms.RandomResizedCrop(opts.imsize),
-                                  transforms.RandomHorizontalFlip(),
-                                  transforms.RandomVerticalFlip(),
-                                  transforms.ToTensor(),
-                                  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
-                                batch_size=opts.batchsize2, shuffle=True, num_workers=4, pin_memory=True, drop_last=True)
+        unlabel_set = SimpleImageLoader(DATASET_PATH, 'unlabel', unl_ids,
+                                        transform=transforms.Compose([
+                                            transforms.Resize(opts.imResize),
+                                            transforms.RandomResizedCrop(opts.imsize),
+                                            transforms.RandomHorizontalFlip(),
+                                            transforms.RandomVerticalFlip(),
+                                            transforms.ToTensor(),
+                                            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),]))
+        unlabel_loader = torch.utils.data.DataLoader(unlabel_set, batch_size=opts.batchsize2, sampler=InfiniteSampler(unlabel_set), num_workers=4, pin_memory=True, drop_last=True)
         print('unlabel_loader done')
+        # one pair of iterators (and worker pools) for the whole run
+        train_stream = PairedStreamLoader(train_loader, unlabel_loader)
+        train_stream.on_epoch_end(lambda stream, n: print('{} stream: finished pass {}'.format(stream, n)))
+        # copies the next pair to the device while the current step runs
+        train_batches = DevicePrefetcher(train_stream, NUM_CLASSES, 'cuda' if use_gpu else 'cpu')
 
         validation_loader = torch.utils.data.DataLoader(
             SimpleImageLoader(DATASET_PATH, 'val', val_ids,
@@ -330,7 +303,7 @@ def main():
         best_acc = -1
         for epoch in range(opts.start_epoch, opts.epochs + 1):
             print('start training')
-            loss, _, _ = train(opts, train_loader, unlabel_loader, model, train_criterion, optimizer, epoch, use_gpu)
+            loss, _, _ = train(opts, train_batches, model, train_criterion, optimizer, epoch, use_gpu)
 
             print('start validation')
             acc_top1, acc_top5 = validation(opts, validation_loader, model, epoch, use_gpu)
@@ -350,124 +323,119 @@ def main():
                     torch.save(model.state_dict(), os.path.join('runs', opts.name + '_e{}'.format(epoch)))
 
 
-def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch, use_gpu):
-    losses = AverageMeter()
-    losses_x = AverageMeter()
-    losses_un = AverageMeter()
-    weight_scale = AverageMeter()
-    acc_top1 = AverageMeter()
-    acc_top5 = AverageMeter()
+def train(opts, train_batches, model, criterion, optimizer, epoch, use_gpu):
+    losses = DeviceMeter()
+    losses_x = DeviceMeter()
+    losses_un = DeviceMeter()
+    weight_scale = DeviceMeter()
+    acc_top1 = DeviceMeter()
+    acc_top5 = DeviceMeter()
+    data_time = DeviceMeter()
     avg_loss = 0.0
     avg_top1 = 0.0
     avg_top5 = 0.0
 
     model.train()
 
+    # sized for the largest mixed batch: batchsize labeled and two views of batchsize2 unlabeled samples
+    mix_buffers = MixupBuffers(opts.batchsize + 2 * opts.batchsize2)
+
     nCnt =0
-    labeled_train_iter = iter(train_loader)
-    unlabeled_train_iter = iter(unlabel_loader)
-
-    for batch_idx in range(len(train_loader)):
-        try:
-            data = labeled_train_iter.next()
-            inputs_x, targets_x = data
-        except:
-            labeled_train_iter = iter(train_loader)
-            data = labeled_train_iter.next()
-            inputs_x, targets_x = data
-        try:
-            data = unlabeled_train_iter.next()
-            inputs_u1, inputs_u2 = data
-        except:
-            unlabeled_train_iter = iter(unlabel_loader)
-            data = unlabeled_train_iter.next()
-            inputs_u1, inputs_u2 = data
+    for batch_idx, ((inputs_x, targets_org, targets_x), data_u) in enumerate(train_batches.epoch()):
+        data_time.update(train_batches.last_wait)
+        inputs_u1, inputs_u2 = data_u
 
         batch_size = inputs_x.size(0)
         batch_size_u = inputs_u1.size(0)
-        # Transform label to one-hot
-        classno = NUM_CLASSES
-        targets_org = targets_x
-        targets_x = torch.zeros(batch_size, classno).scatter_(1, targets_x.view(-1,1), 1)
-
-        if use_gpu :
-            inputs_x, targets_x = inputs_x.cuda(), targets_x.cuda()
-            inputs_u1, inputs_u2 = inputs_u1.cuda(), inputs_u2.cuda()
         inputs_x, targets_x = Variable(inputs_x), Variable(targets_x)
         inputs_u1, inputs_u2 = Variable(inputs_u1), Variable(inputs_u2)
 
         with torch.no_grad():
             # compute guessed labels of unlabel samples
-            embed_u1, pred_u1 = model(inputs_u1)
-            embed_u2, pred_u2 = model(inputs_u2)
-            pred_u_all = (torch.softmax(pred_u1, dim=1) + torch.softmax(pred_u2, dim=1)) / 2
-            pt = pred_u_all**(1/opts.T)
-            targets_u = pt / pt.sum(dim=1, keepdim=True)
-            targets_u = targets_u.detach()
+            with autocast(opts.precision, inputs_x.device.type):
+                if opts.fused_forward:
+                    # both views in one forward, each view keeps its own BatchNorm statistics unless bn_mode is full
+                    _, pred_u = fused_forward(model, torch.cat([inputs_u1, inputs_u2], dim=0), batch_size_u,
+                                              'full' if opts.bn_mode == 'full' else 'chunk')
+                    pred_u1, pred_u2 = torch.split(pred_u, batch_size_u)
+                else:
+                    embed_u1, pred_u1 = model(inputs_u1)
+                    embed_u2, pred_u2 = model(inputs_u2)
+            # sharpening and the softmax average stay in fp32 under --precision bf16
+            pred_u1, pred_u2 = pred_u1.float(), pred_u2.float()
+            # averaged and sharpened guesses, computed in place (losses.py)
+            pred_u_all, targets_u = guess_labels(pred_u1, pred_u2, opts.T)
 
         # mixup
-        all_inputs = torch.cat([inputs_x, inputs_u1, inputs_u2], dim=0)
-        all_targets = torch.cat([targets_x, targets_u, targets_u], dim=0)
-
         lamda = np.random.beta(opts.alpha, opts.alpha)
         lamda= max(lamda, 1-lamda)
-        newidx = torch.randperm(all_inputs.size(0))
-        input_a, input_b = all_inputs, all_inputs[newidx]
-        target_a, target_b = all_targets, all_targets[newidx]
+        # cat, permute and blend inside the reused buffers, the results are views valid for this step
+        mixed_input, mixed_target = mix_buffers(inputs_x, targets_x, inputs_u1, inputs_u2, targets_u, lamda)
 
-        mixed_input = lamda * input_a + (1 - lamda) * input_b
-        mixed_target = lamda * target_a + (1 - lamda) * target_b
+        optimizer.zero_grad()
 
-        # interleave labeled and unlabed samples between batches to get correct batchnorm calculation
-        mixed_input = list(torch.split(mixed_input, batch_size))
-        mixed_input = interleave(mixed_input, batch_size)
+        with autocast(opts.precision, inputs_x.device.type):
+            if opts.fused_forward:
+                # the whole mixed batch in one forward, BatchNorm groups chosen by bn_mode
+                fea, logits_all = fused_forward(model, mixed_input, batch_size, opts.bn_mode)
+                logits = list(torch.split(logits_all, batch_size))
+            else:
+                # interleave labeled and unlabed samples between batches to get correct batchnorm calculation
+                mixed_input = list(torch.split(mixed_input, batch_size))
+                mixed_input = interleave(mixed_input, batch_size)
 
-        optimizer.zero_grad()
+                fea, logits_temp = model(mixed_input[0])
+                logits = [logits_temp]
+                for newinput in mixed_input[1:]:
+                    fea, logits_temp = model(newinput)
+                    logits.append(logits_temp)
 
-        fea, logits_temp = model(mixed_input[0])
-        logits = [logits_temp]
-        for newinput in mixed_input[1:]:
-            fea, logits_temp = model(newinput)
-            logits.append(logits_temp)
+                # put interleaved samples back
+                logits = interleave(logits, batch_size)
+        # the loss terms in fp32
+        logits = [logits_temp.float() for logits_temp in logits]
 
-        # put interleaved samples back
-        logits = interleave(logits, batch_size)
         logits_x = logits[0]
         logits_u = torch.cat(logits[1:], dim=0)
 
-        loss_x, loss_un, weigts_mixing = criterion(logits_x, mixed_target[:batch_size], logits_u, mixed_target[batch_size:], epoch+batch_idx/len(train_loader), 20)
+        loss_x, loss_un, weigts_mixing = criterion(logits_x, mixed_target[:batch_size], logits_u, mixed_target[batch_size:], epoch+batch_idx/len(train_batches), 20)
         loss = loss_x + weigts_mixing * loss_un
 
-        losses.update(loss.item(), inputs_x.size(0))
-        losses_x.update(loss_x.item(), inputs_x.size(0))
-        losses_un.update(loss_un.item(), inputs_x.size(0))
+        losses.update(loss.detach(), inputs_x.size(0))
+        losses_x.update(loss_x.detach(), inputs_x.size(0))
+        losses_un.update(loss_un.detach(), inputs_x.size(0))
         weight_scale.update(weigts_mixing, inputs_x.size(0))
 
         # compute gradient and do SGD step
         loss.backward()
         optimizer.step()
 
-        with torch.no_grad():
-            # compute guessed labels of unlabel samples
-            embed_x, pred_x1 = model(inputs_x)
-
-        acc_top1b, confid_avg, confid_min = top_1_accuracy_score_with_confidence(targets_org.data.cpu().numpy(), pred_x1.data, n=1)
-        acc_top5b = top_n_accuracy_score(targets_org.data.cpu().numpy(), pred_x1.data.cpu().numpy(), n=5)*100
-        acc_top1.update(torch.as_tensor(acc_top1b), inputs_x.size(0))
-        acc_top5.update(torch.as_tensor(acc_top5b), inputs_x.size(0))
-
-        avg_loss += loss.item()
+        if opts.train_acc == 'exact' or batch_idx % opts.train_acc_interval == 0:
+            with torch.no_grad():
+                embed_x, pred_x1 = model(inputs_x)
+        else:
+            # probe: the meters keep the last probe until the next one
+            pred_x1 = None
+
+        if pred_x1 is not None:
+            scores = topk_metrics(pred_x1, targets_org, ks=(1, 5))
+            acc_top1b, acc_top5b = scores['top1'], scores['top5']
+            confid_avg, confid_min = scores['conf_avg'], scores['conf_min']
+            acc_top1.update(acc_top1b, inputs_x.size(0))
+            acc_top5.update(acc_top5b, inputs_x.size(0))
+
+        avg_loss += loss.detach()
         avg_top1 += acc_top1b
         avg_top5 += acc_top5b
 
         if batch_idx % opts.log_interval == 0:
-            print('Train Epoch:{} [{}/{}] Loss:{:.4f}({:.4f}) Top-1:{:.2f}%({:.2f}%) Top-5:{:.2f}%({:.2f}%) '.format(
-                epoch, batch_idx *inputs_x.size(0), len(train_loader.dataset), losses.val, losses.avg, acc_top1.val, acc_top1.avg, acc_top5.val, acc_top5.avg))
+            print('Train Epoch:{} [{}/{}] Loss:{:.4f}({:.4f}) Top-1:{:.2f}%({:.2f}%) Top-5:{:.2f}%({:.2f}%) Data:{:.3f}s({:.3f}s) '.format(
+                epoch, batch_idx *inputs_x.size(0), len(train_batches.stream.labeled.dataset), losses.val, losses.avg, acc_top1.val, acc_top1.avg, acc_top5.val, acc_top5.avg, data_time.val, data_time.avg))
+            # the meters live on the device, so they are read back only at the log interval
+            nsml.report(summary = True, train_confidence_avg = confid_avg, train_confidence_min = confid_min, step = epoch+batch_idx/len(train_batches))
+            nsml.report(summary=True, data_wait=data_time.avg, losses_x = losses_x.avg, losses_un = losses_un.avg*weigts_mixing,  step = epoch+batch_idx/len(train_batches))
 
         nCnt += 1
-        if confid_avg!=0:
-            nsml.report(summary = True, train_confidence_avg = confid_avg, train_confidence_min = confid_min, step = epoch+batch_idx/len(train_loader))
-        nsml.report(summary=True, losses_x = losses_x.avg, losses_un = losses_un.avg*weigts_mixing,  step = epoch+batch_idx/len(train_loader))
 
     avg_loss =  float(avg_loss/nCnt)
     avg_top1 = float(avg_top1/nCnt)
@@ -479,8 +447,11 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
 
 def validation(opts, validation_loader, model, epoch, use_gpu):
     model.eval()
+    if opts.fuse_inference:
+        model = model.fuse_for_inference()
     avg_top1= 0.0
     avg_top5 = 0.0
+    classes = ClassMeter(NUM_CLASSES)
     nCnt =0
     with torch.no_grad():
         for batch_idx, data in enumerate(validation_loader):
@@ -491,15 +462,17 @@ def validation(opts, validation_loader, model, epoch, use_gpu):
             nCnt +=1
             embed_fea, preds = model(inputs)
 
-            acc_top1, confid_avg, confid_min = top_1_accuracy_score_with_confidence(labels.numpy(), preds.data, n=1)
-            acc_top5 = top_n_accuracy_score(labels.numpy(), preds.data.cpu().numpy(), n=5)*100
-            avg_top1 += acc_top1
-            avg_top5 += acc_top5
+            scores = topk_metrics(preds, labels, ks=(1, 5))
+            classes.update(preds, labels)
+            avg_top1 += scores['top1']
+            avg_top5 += scores['top5']
 
+        # everything above stayed on the device, this is the only sync of the pass
         avg_top1 = float(avg_top1/nCnt)
         avg_top5= float(avg_top5/nCnt)
-        print('Test Epoch:{} Top1_acc_val:{:.2f}% Top5_acc_val:{:.2f}% '.format(epoch, avg_top1, avg_top5))
-    nsml.report(summary = True, valid_confidence_avg = confid_avg, valid_confidence_min = confid_min, step = epoch)
+        avg_class = classes.mean_accuracy()
+        print('Test Epoch:{} Top1_acc_val:{:.2f}% Top5_acc_val:{:.2f}% Class_mean_acc_val:{:.2f}% '.format(epoch, avg_top1, avg_top5, avg_class))
+    nsml.report(summary = True, valid_confidence_avg = float(scores['conf_avg']), valid_confidence_min = float(scores['conf_min']), valid_acc_class_mean = avg_class, step = epoch)
     return avg_top1, avg_top5
 
 
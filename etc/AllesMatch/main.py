@@ -29,6 +29,7 @@ import tensorflow as tf
 import torch.nn.functional as F
 
 from ImageDataLoader import SimpleImageLoader
+from pseudo_label import PseudoLabelSelector
 from models import Res18, Res50, Dense121, Res18_basic
 #
 # from pytorch_metric_learning import miners
@@ -396,6 +397,8 @@ def train(opts, train_loader, unlabel_loader, unlabel_loader_pl, model, criterio
 
     model.train()
 
+    selector = PseudoLabelSelector('fixed', threshold=0.7)
+
     nCnt =0
     labeled_train_iter = iter(train_loader)
     unlabeled_train_iter = iter(unlabel_loader)
@@ -439,19 +442,13 @@ def train(opts, train_loader, unlabel_loader, unlabel_loader_pl, model, criterio
         inputs_u1, inputs_u2 = Variable(inputs_u1), Variable(inputs_u2)
         inputs_u1p, inputs_u2p = Variable(inputs_u1p), Variable(inputs_u2p)
 
-        threshold = 0.7
-        rm_idx = []
-
         with torch.no_grad():
             # compute guessed labels of unlabel samples
             embed_u1, pred_u1 = model(inputs_u1p)
             embed_u2, pred_u2 = model(inputs_u2p)
             #print(pred_u1.size())
             pred_u_all = (torch.softmax(pred_u1, dim=1) + torch.softmax(pred_u2, dim=1)) / 2
-            crit = torch.max(pred_u_all, axis=1) #batch size
-            for i in range(int(crit[0].shape[0])):
-                if crit[0][i]<threshold:
-                    rm_idx.append(i)
+            keep_idx = selector(pred_u_all)
 
             #print(pred_u2.size())
             pt = pred_u_all**(1/opts.T)
@@ -460,15 +457,13 @@ def train(opts, train_loader, unlabel_loader, unlabel_loader_pl, model, criterio
             targets_u = targets_u.detach()
 
         #print(inputs_u1.size())
-        ##print(rm_idx)
-        inputs_u1 = np.delete(inputs_u1.cpu(), rm_idx, axis=0)
-        inputs_u2 = np.delete(inputs_u2.cpu(), rm_idx, axis=0)
-        targets_u = np.delete(targets_u.cpu(), rm_idx, axis=0)
-        good_ulb.update(batch_size_u - len(rm_idx))
+        inputs_u1 = inputs_u1[keep_idx]
+        inputs_u2 = inputs_u2[keep_idx]
+        targets_u = targets_u[keep_idx]
+        good_ulb.update(len(keep_idx))
         #print(inputs_u1.size())
         #print(targets_u.size())
 
-        inputs_u1, inputs_u2, targets_u = inputs_u1.cuda(), inputs_u2.cuda(), targets_u.cuda()
         # mixup
 
         all_inputs = torch.cat([inputs_x, inputs_u1, inputs_u2], dim=0)
@@ -499,7 +494,7 @@ def train(opts, train_loader, unlabel_loader, unlabel_loader_pl, model, criterio
 
         fea, logits_temp = model(mixed_input[0])
 
-        if len(rm_idx)!=batch_size_u:
+        if len(keep_idx)!=0:
             #print("asdlfkjasodifjasio")
             logits = [logits_temp]
             for newinput in mixed_input[1:]:
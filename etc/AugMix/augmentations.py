@@ -16,6 +16,8 @@
 
 import numpy as np
 from PIL import Image, ImageOps, ImageEnhance
+import torch
+import torch.nn.functional as F
 
 # ImageNet code should change this value
 IMAGE_SIZE = 256 # ㅋ 에러남
@@ -147,3 +149,201 @@ augmentations_all = [
     autocontrast, equalize, posterize, rotate, solarize, shear_x, shear_y,
     translate_x, translate_y, color, contrast, brightness, sharpness
 ]
+
+
+# Batched tensor versions of the operators above. They take a float batch
+# (N, C, H, W) with values in [0, 255] and a per-sample level tensor (N,)
+# already drawn by sample_level, and keep the image size.
+
+
+def _per_sample(v, x):
+  return v.view(-1, 1, 1, 1).to(dtype=x.dtype, device=x.device)
+
+
+def _random_sign(v):
+  return torch.where(torch.rand(v.size(0), device=v.device) > 0.5, -v, v)
+
+
+def _blend(degenerate, x, factor):
+  return (degenerate + _per_sample(factor, x) * (x - degenerate)).clamp(0, 255)
+
+
+def _grayscale(x):
+  w = x.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+  return (x * w).sum(1, keepdim=True)
+
+
+def _affine(x, a, b, c, d, e, f):
+  """Like PIL's AFFINE transform with BILINEAR resampling: output pixel (x, y)
+  samples the input at (a*x + b*y + c, d*x + e*y + f), zeros outside."""
+  n, _, h, w = x.size()
+  ys = torch.arange(h, dtype=x.dtype, device=x.device).view(1, h, 1) + 0.5
+  xs = torch.arange(w, dtype=x.dtype, device=x.device).view(1, 1, w) + 0.5
+  coef = [t.to(dtype=x.dtype, device=x.device).view(-1, 1, 1)
+          for t in (a, b, c, d, e, f)]
+  x_in = coef[0] * xs + coef[1] * ys + coef[2]
+  y_in = coef[3] * xs + coef[4] * ys + coef[5]
+  grid = torch.stack([2 * x_in / w - 1, 2 * y_in / h - 1], dim=3)
+  return F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros',
+                       align_corners=False)
+
+
+def batch_autocontrast(x, _):
+  lo = x.min(3, keepdim=True)[0].min(2, keepdim=True)[0]
+  hi = x.max(3, keepdim=True)[0].max(2, keepdim=True)[0]
+  out = (x - lo) * (255. / (hi - lo).clamp(min=1))
+  return torch.where(hi > lo, out, x)
+
+
+def batch_equalize(x, _):
+  n, c, h, w = x.size()
+  flat = x.round().long().clamp(0, 255).view(n * c, h * w)
+  hist = torch.zeros(n * c, 256, dtype=torch.long, device=x.device)
+  hist.scatter_add_(1, flat, torch.ones_like(flat))
+  last = 255 - torch.argmax((hist.flip(1) > 0).float(), dim=1, keepdim=True)
+  step = (h * w - hist.gather(1, last)) // 256
+  lut = ((step // 2 + torch.cumsum(hist, 1) - hist) // step.clamp(min=1))
+  out = lut.clamp(0, 255).gather(1, flat).view(n, c, h, w).to(x.dtype)
+  return torch.where((step > 0).view(n, c, 1, 1), out, x)
+
+
+def batch_posterize(x, level):
+  bits = 4 - (level * 4 / 10).long()
+  mask = 256 - torch.pow(2, 8 - bits)
+  return (x.round().long() &
+          mask.view(-1, 1, 1, 1).to(x.device)).to(x.dtype)
+
+
+def batch_rotate(x, level):
+  h, w = x.size(2), x.size(3)
+  degrees = _random_sign((level * 30 / 10).long().double())
+  angle = -degrees * np.pi / 180.
+  cos, sin = torch.cos(angle), torch.sin(angle)
+  cx, cy = w / 2., h / 2.
+  return _affine(x, cos, sin, -cos * cx - sin * cy + cx,
+                 -sin, cos, sin * cx - cos * cy + cy)
+
+
+def batch_solarize(x, level):
+  threshold = 256 - (level * 256 / 10).long()
+  return torch.where(x < _per_sample(threshold, x), x, 255. - x)
+
+
+def batch_shear_x(x, level):
+  level = _random_sign(level * 0.3 / 10)
+  one, zero = torch.ones_like(level), torch.zeros_like(level)
+  return _affine(x, one, level, zero, zero, one, zero)
+
+
+def batch_shear_y(x, level):
+  level = _random_sign(level * 0.3 / 10)
+  one, zero = torch.ones_like(level), torch.zeros_like(level)
+  return _affine(x, one, zero, zero, level, one, zero)
+
+
+def batch_translate_x(x, level):
+  level = _random_sign((level * (x.size(3) / 3.) / 10).long().to(level.dtype))
+  one, zero = torch.ones_like(level), torch.zeros_like(level)
+  return _affine(x, one, zero, level, zero, one, zero)
+
+
+def batch_translate_y(x, level):
+  level = _random_sign((level * (x.size(2) / 3.) / 10).long().to(level.dtype))
+  one, zero = torch.ones_like(level), torch.zeros_like(level)
+  return _affine(x, one, zero, zero, zero, one, level)
+
+
+def batch_color(x, level):
+  return _blend(_grayscale(x).expand_as(x), x, level * 1.8 / 10 + 0.1)
+
+
+def batch_contrast(x, level):
+  mean = _grayscale(x).mean((1, 2, 3), keepdim=True)
+  return _blend(mean.expand_as(x), x, level * 1.8 / 10 + 0.1)
+
+
+def batch_brightness(x, level):
+  return _blend(torch.zeros_like(x), x, level * 1.8 / 10 + 0.1)
+
+
+def batch_sharpness(x, level):
+  n, c, h, w = x.size()
+  kernel = x.new_tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]]) / 13.
+  smooth = F.conv2d(x.view(n * c, 1, h, w), kernel.view(1, 1, 3, 3))
+  degenerate = x.clone()
+  degenerate[:, :, 1:-1, 1:-1] = smooth.view(n, c, h - 2, w - 2)
+  return _blend(degenerate, x, level * 1.8 / 10 + 0.1)
+
+
+batch_augmentations = [
+    batch_autocontrast, batch_equalize, batch_posterize, batch_rotate,
+    batch_solarize, batch_shear_x, batch_shear_y, batch_translate_x,
+    batch_translate_y
+]
+
+batch_augmentations_all = [
+    batch_autocontrast, batch_equalize, batch_posterize, batch_rotate,
+    batch_solarize, batch_shear_x, batch_shear_y, batch_translate_x,
+    batch_translate_y, batch_color, batch_contrast, batch_brightness,
+    batch_sharpness
+]
+
+
+class BatchAugMix(object):
+  """AugMix over a whole batch of cropped uint8 images, JSD views included.
+
+  The 2 * width chains of both augmented views are run as one batch: every
+  depth step groups the samples by the op they drew, so a step costs at most
+  one call per op. Dirichlet and Beta weights are drawn for the whole batch.
+  Images are converted to float and normalized once, at the end.
+
+  Returns:
+    (clean, aug1, aug2): normalized float batches, like
+    (preprocess(image), aug(image, preprocess), aug(image, preprocess)).
+  """
+
+  def __init__(self, mean, std, severity=3, width=3, depth=-1,
+               all_ops=False):
+    self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+    self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+    self.severity = severity
+    self.width = width
+    self.depth = depth
+    self.ops = batch_augmentations_all if all_ops else batch_augmentations
+
+  def normalize(self, x):
+    mean, std = self.mean.to(x.device), self.std.to(x.device)
+    return (x / 255. - mean) / std
+
+  def __call__(self, batch):
+    x = batch.float()
+    n = x.size(0)
+    views = 2
+    m = views * self.width * n
+
+    # chain j of view v for sample s sits at (v * width + j) * n + s
+    chains = x.repeat(views * self.width, 1, 1, 1)
+    if self.depth > 0:
+      depth = torch.full((m,), self.depth, dtype=torch.long)
+    else:
+      depth = torch.randint(1, 4, (m,))
+    for d in range(int(depth.max())):
+      choice = torch.randint(len(self.ops), (m,))
+      level = torch.empty(m).uniform_(0.1, self.severity)
+      for k, op in enumerate(self.ops):
+        idx = ((choice == k) & (depth > d)).nonzero().view(-1)
+        if idx.numel() == 0:
+          continue
+        chains[idx.to(x.device)] = op(chains[idx.to(x.device)],
+                                      level[idx].to(x.device))
+
+    ws = torch.distributions.Dirichlet(torch.ones(self.width)).sample(
+        (views, n)).to(x.device)
+    mix_m = torch.distributions.Beta(1., 1.).sample((views, n)).to(x.device)
+    chains = chains.view(views, self.width, n, *x.shape[1:])
+    mix = (ws.transpose(1, 2).reshape(views, self.width, n, 1, 1, 1) *
+           chains).sum(1)
+    mixed = (1 - mix_m.view(views, n, 1, 1, 1)) * x + \
+        mix_m.view(views, n, 1, 1, 1) * mix
+    return self.normalize(x), self.normalize(mixed[0]), \
+        self.normalize(mixed[1])
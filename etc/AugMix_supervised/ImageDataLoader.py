@@ -32,7 +32,8 @@ parser.add_argument(
     action='store_true',
     help='Turn on all operations (+brightness,contrast,color,sharpness).')
 
-opts = parser.parse_args()
+# parse_known_args: main.py's own flags are on the same command line
+opts, _ = parser.parse_known_args()
 
 def default_image_loader(path):
     return Image.open(path).convert('RGB')
@@ -86,8 +87,13 @@ def aug(image, preprocess):
   mixed = (1 - m) * preprocess(image) + m * mix
   return mixed
 
+class ToUint8Tensor(object):
+    """PIL image -> uint8 CHW tensor, for loaders whose AugMix runs batched (see BatchAugMix)."""
+    def __call__(self, img):
+        return torch.from_numpy(np.array(img, dtype=np.uint8, copy=True)).permute(2, 0, 1).contiguous()
+
 class SimpleImageLoader(torch.utils.data.Dataset):
-    def __init__(self, rootdir, split, ids=None, transform=None, loader=default_image_loader):
+    def __init__(self, rootdir, split, ids=None, transform=None, loader=default_image_loader, batch_augmix=False):
         if split == 'test':
             self.impath = os.path.join(rootdir, 'test_data')
             meta_file = os.path.join(self.impath, 'test_meta.txt')
@@ -117,6 +123,7 @@ class SimpleImageLoader(torch.utils.data.Dataset):
         self.TransformTwice = TransformTwice(self.transform)
         #self.TransformFourth = TransformFourth(self.transform)
         self.loader = loader
+        self.batch_augmix = batch_augmix
         self.split = split
         self.imnames = imnames
         self.imclasses = imclasses
@@ -136,8 +143,13 @@ class SimpleImageLoader(torch.utils.data.Dataset):
             return img, label
         elif self.split == 'train':
             label = self.imclasses[index]
+            if self.batch_augmix:
+                # the clean view and both AugMix views are made from this crop in train()
+                return self.transform(img), label
             img_tuple = (self.transform(img), aug(img, self.transform), aug(img, self.transform), label)
             return img_tuple
+        elif self.batch_augmix:
+            return self.transform(img)
         else:
             img_tuple = (self.transform(img), aug(img, self.transform), aug(img, self.transform))
             #img1, img2, img3, img4 = self.TransformFourth(img) 여기서 코드 어케치냐
@@ -26,7 +26,8 @@ from torchvision import datasets, models, transforms
 import tensorflow as tf
 import torch.nn.functional as F
 
-from ImageDataLoader import SimpleImageLoader
+from ImageDataLoader import SimpleImageLoader, ToUint8Tensor, opts as aug_opts, parser as aug_parser
+from augmentations import BatchAugMix
 #from models import Res18, Res50, WideResNet # Dense121, Res18_basic, WideRes50_2
 #from wideresnet import WideResNet
 from efficientnet_pytorch import EfficientNet
@@ -243,7 +244,8 @@ def bind_nsml(model):
 ######################################################################
 # Options
 ######################################################################
-parser = argparse.ArgumentParser(description='Sample Product200K Training')
+# the AugMix flags of ImageDataLoader (--mixture-width, --mixture-depth, --aug-severity, --all-ops) are accepted here too
+parser = argparse.ArgumentParser(description='Sample Product200K Training', parents=[aug_parser], conflict_handler='resolve')
 parser.add_argument('--start_epoch', type=int, default=1, metavar='N', help='number of start epoch (default: 1)')
 parser.add_argument('--epochs', type=int, default=300, metavar='N', help='number of epochs to train (default: 200)')
 
@@ -273,6 +275,9 @@ parser.add_argument('--T', default=0.5, type=float)
 # hyper-parameters for ema model
 parser.add_argument('--ema-decay', default=0.999, type=float, metavar='ALPHA', help='ema variable decay rate (default: 0.999)')
 
+# augmentation
+parser.add_argument('--batch_augmix', type=int, default=0, help='run the AugMix chains batched on the training device instead of in the loader workers')
+
 ### DO NOT MODIFY THIS BLOCK ###
 # arguments for nsml
 parser.add_argument('--pause', type=int, default=0)
@@ -372,15 +377,20 @@ def main():
         # Set dataloader
         train_ids, val_ids, unl_ids = split_ids(os.path.join(DATASET_PATH, 'train/train_label'), 0.2)
         print('found {} train, {} validation and {} unlabeled images'.format(len(train_ids), len(val_ids), len(unl_ids)))
+        if opts.batch_augmix:
+            # workers stop after crop and flips, AugMix and Normalize run batched in train()
+            to_tensor = [ToUint8Tensor()]
+        else:
+            to_tensor = [transforms.ToTensor(),
+                         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]
         train_loader = torch.utils.data.DataLoader(
             SimpleImageLoader(DATASET_PATH, 'train', train_ids,
                               transform=transforms.Compose([
                                   transforms.Resize(opts.imResize),
                                   transforms.RandomResizedCrop(opts.imsize),
                                   transforms.RandomHorizontalFlip(),
-                                  transforms.RandomVerticalFlip(),
-                                  transforms.ToTensor(),
-                                  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
+                                  transforms.RandomVerticalFlip(),] + to_tensor),
+                              batch_augmix=opts.batch_augmix),
                                 batch_size=opts.batchsize, shuffle=True, num_workers=4, pin_memory=True, drop_last=True)
         print('train_loader done')
 
@@ -390,9 +400,8 @@ def main():
                                   transforms.Resize(opts.imResize),
                                   transforms.RandomResizedCrop(opts.imsize),
                                   transforms.RandomHorizontalFlip(),
-                                  transforms.RandomVerticalFlip(),
-                                  transforms.ToTensor(),
-                                  transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])),
+                                  transforms.RandomVerticalFlip(),] + to_tensor),
+                              batch_augmix=opts.batch_augmix),
                                 batch_size=opts.batchsize2, shuffle=True, num_workers=4, pin_memory=True, drop_last=True)
         print('unlabel_loader done')
 
@@ -489,16 +498,23 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
     #ema_model.train()
 
     nCnt =0
+    augmix = None
+    if opts.batch_augmix:
+        augmix = BatchAugMix(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], severity=aug_opts.aug_severity,
+                             width=aug_opts.mixture_width, depth=aug_opts.mixture_depth, all_ops=aug_opts.all_ops)
     labeled_train_iter = iter(train_loader)
     unlabeled_train_iter = iter(unlabel_loader)
 
     for batch_idx in range(len(train_loader)):
         try:
             data = labeled_train_iter.next()
-            inputs_x_clean, inputs_x_aug1, inputs_x_aug2, targets_x = data
         except:
             labeled_train_iter = iter(train_loader)
             data = labeled_train_iter.next()
+        if augmix is not None:
+            inputs_x, targets_x = data
+            inputs_x_clean, inputs_x_aug1, inputs_x_aug2 = augmix(inputs_x.cuda() if use_gpu else inputs_x)
+        else:
             inputs_x_clean, inputs_x_aug1, inputs_x_aug2, targets_x = data
         # try:
         #     data = unlabeled_train_iter.next()
@@ -0,0 +1,84 @@
+"""
+Pool of confidently pseudo-labeled unlabeled samples for ensuring the labeled/unlabeled ratio.
+
+To get batchsize2 confident samples per step, train() used to draw unlabeled batches until
+enough passed the adaptive threshold, concatenating them onto growing tensors, and threw away
+whatever was selected beyond batchsize2. CandidatePool keeps those samples instead: a fixed
+block of `capacity` slots on the training device, ordered by confidence. New selections replace
+the least confident (or empty) slots, take() hands out the most confident ones, and entries
+older than max_age steps are dropped because their guessed labels come from old weights. A step
+therefore draws only as many batches as the pool is short, and on average about
+batchsize2 / (selected per batch) of them, instead of retrying from an empty list every step.
+"""
+
+import torch
+
+
+class CandidatePool(object):
+    """Bounded priority buffer of (view 1, view 2, sharpened target) keyed by confidence.
+
+    The buffers are allocated on the first push() with the shapes and device of the samples.
+    Empty slots have confidence -1. Nothing but len() and take() syncs with the device.
+    """
+
+    def __init__(self, capacity, max_age=0):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.step = 0
+        self.inputs_u1 = None
+        self.inputs_u2 = None
+        self.targets_u = None
+        self.confidence = None
+        self.born = None
+
+    def _allocate(self, inputs_u1, targets_u):
+        device = inputs_u1.device
+        self.inputs_u1 = inputs_u1.new_zeros((self.capacity,) + inputs_u1.shape[1:])
+        self.inputs_u2 = inputs_u1.new_zeros((self.capacity,) + inputs_u1.shape[1:])
+        self.targets_u = targets_u.new_zeros((self.capacity,) + targets_u.shape[1:])
+        self.confidence = torch.full((self.capacity,), -1.0, device=device)
+        self.born = torch.zeros(self.capacity, dtype=torch.int64, device=device)
+
+    def __len__(self):
+        if self.confidence is None:
+            return 0
+        return int((self.confidence >= 0).sum())
+
+    def tick(self):
+        """Next training step: drops the entries older than max_age steps."""
+        self.step += 1
+        if self.confidence is not None and self.max_age > 0:
+            self.confidence.masked_fill_(self.step - self.born > self.max_age, -1.0)
+
+    def push(self, inputs_u1, inputs_u2, targets_u, confidence):
+        """Adds samples, keeping the `capacity` most confident of the pool and the new ones."""
+        if inputs_u1.size(0) == 0:
+            return
+        if self.confidence is None:
+            self._allocate(inputs_u1, targets_u)
+        k = min(inputs_u1.size(0), self.capacity)
+        new_conf, order = confidence.topk(k)
+        old_conf, slots = self.confidence.topk(k, largest=False)
+        # best new against worst slot, second best against second worst, ...: the pairs where the
+        # new sample wins are exactly the replacements that keep the top `capacity` of both sets
+        replace = new_conf > old_conf
+
+        def merge(buffer, new):
+            mask = replace.view((-1,) + (1,) * (new.dim() - 1))
+            buffer[slots] = torch.where(mask, new[order], buffer[slots])
+
+        merge(self.inputs_u1, inputs_u1)
+        merge(self.inputs_u2, inputs_u2)
+        merge(self.targets_u, targets_u)
+        self.confidence[slots] = torch.where(replace, new_conf, old_conf)
+        self.born[slots] = torch.where(replace, torch.full_like(slots, self.step), self.born[slots])
+
+    def take(self, n):
+        """Removes and returns (inputs_u1, inputs_u2, targets_u) of the up to n most confident samples."""
+        if self.confidence is None:
+            return None
+        conf, slots = self.confidence.topk(min(n, self.capacity))
+        slots = slots[:int((conf >= 0).sum())]
+        batch = self.inputs_u1[slots], self.inputs_u2[slots], self.targets_u[slots]
+        self.confidence[slots] = -1.0
+        return batch
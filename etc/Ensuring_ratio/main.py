@@ -27,6 +27,8 @@ import tensorflow as tf
 import torch.nn.functional as F
 
 from ImageDataLoader import SimpleImageLoader
+from pseudo_label import PseudoLabelSelector
+from candidate_pool import CandidatePool
 from models import Res18, Res50, WideResNet # Dense121, Res18_basic, WideRes50_2
 #from wideresnet import WideResNet
 from efficientnet_pytorch import EfficientNet
@@ -274,6 +276,8 @@ parser.add_argument('--ema-decay', default=0.999, type=float, metavar='ALPHA', h
 parser.add_argument('--threshold1', default=0.9, type=float, help='threshold for fixed_threshold_policy')
 parser.add_argument('--threshold2', default=0.5, type=float, help='threshold for adaptive_threshold_policy')
 parser.add_argument('--max_sup', default=5, type=float, help='maximum unlabeled data supplement for ensuring ratio')
+parser.add_argument('--pool_size', default=200, type=int, help='capacity of the pool of confident unlabeled samples for ensuring ratio (at least batchsize2)')
+parser.add_argument('--pool_max_age', default=20, type=int, help='steps a sample stays in the pool before its guessed label is considered stale (0: no limit)')
 
 
 ### DO NOT MODIFY THIS BLOCK ###
@@ -414,6 +418,8 @@ def main():
 
         # INSTANTIATE LOSS CLASS
         train_criterion = SemiLoss()
+        # confident unlabeled samples left over from earlier steps, kept across epochs
+        pool = CandidatePool(max(opts.pool_size, opts.batchsize2), opts.pool_max_age)
 
         # INSTANTIATE STEP LEARNING SCHEDULER CLASS
         #scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,  milestones=[2,4,8], gamma=0.5)
@@ -450,7 +456,7 @@ def main():
         #ema = False
         for epoch in range(opts.start_epoch, opts.epochs + 1):
             print('start training')
-            loss, train_avg_top1, _, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val = train(opts, train_loader, unlabel_loader, model, train_criterion, optimizer, epoch, use_gpu, train_avg_top1, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val)
+            loss, train_avg_top1, _, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val = train(opts, train_loader, unlabel_loader, model, train_criterion, optimizer, epoch, use_gpu, train_avg_top1, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val, pool)
             #scheduler.step()
 
             print('start validation')
@@ -473,7 +479,7 @@ def main():
                     torch.save(model.state_dict(), os.path.join('runs', opts.name + '_e{}'.format(epoch)))
 
 
-def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch, use_gpu, train_avg_top1, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val):
+def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch, use_gpu, train_avg_top1, train_acc_top1_val, train_loss_val, train_loss_x_val, train_loss_un_val, pool):
     print(train_avg_top1)
     ensure_ratio = (train_avg_top1 > 20)
     print(epoch, ensure_ratio)
@@ -505,6 +511,9 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
     model.train()
     #ema_model.train()
 
+    fixed_selector = PseudoLabelSelector('fixed', threshold=opts.threshold1)
+    adaptive_selector = PseudoLabelSelector('adaptive', min_threshold=opts.threshold2)
+
     nCnt =0
     labeled_train_iter = iter(train_loader)
     unlabeled_train_iter = iter(unlabel_loader)
@@ -530,7 +539,7 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
         inputs_x, targets_x = Variable(inputs_x), Variable(targets_x)
 
         # load unlabeled data
-        mixup_idx = []
+        num_selected = 0
 
         if ensure_ratio == False:
             try:
@@ -550,11 +559,8 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
                 embed_u2, pred_u2 = model(inputs_u2)
                 pred_u_all = (torch.softmax(pred_u1, dim=1) + torch.softmax(pred_u2, dim=1)) / 2
 
-                crit = torch.max(pred_u_all, axis=1) #batch size
-
-                for i in range(int(crit[0].shape[0])):
-                    if crit[0][i] >= opts.threshold1:
-                        mixup_idx.append(i)
+                mixup_idx = fixed_selector(pred_u_all)
+                num_selected = len(mixup_idx)
 
                 pt = pred_u_all**(1/opts.T)
                 targets_u = pt / pt.sum(dim=1, keepdim=True)
@@ -569,12 +575,11 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
 
 
         else:
-            print("epoch: ", epoch)
-            all_inputs_u1 = torch.tensor([]).cuda()
-            all_inputs_u2 = torch.tensor([]).cuda()
-            all_targets_u = torch.tensor([]).cuda()
+            # top the pool up until it can serve batchsize2 samples, surplus selections stay for later steps
+            pool.tick()
+            target = min(opts.batchsize2, pool.capacity)
             trial = 0
-            while len(mixup_idx) <= opts.batchsize2 and trial <= opts.max_sup:
+            while len(pool) < target and trial <= opts.max_sup:
                 trial += 1
                 try:
                     data = unlabeled_train_iter.next()
@@ -589,46 +594,26 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
                 inputs_u1, inputs_u2 = Variable(inputs_u1), Variable(inputs_u2)
 
                 percentile = acc_top1.avg/100
-                threshold_size = int(opts.batchsize2*percentile)
 
                 with torch.no_grad():
                     embed_u1, pred_u1 = model(inputs_u1)
                     embed_u2, pred_u2 = model(inputs_u2)
                     pred_u_all = (torch.softmax(pred_u1, dim=1) + torch.softmax(pred_u2, dim=1)) / 2
 
-                    crit = torch.max(pred_u_all, axis=1) #batch size
-
-                    prec_idx = torch.argsort(crit[0], descending = True)[:threshold_size]
-                    for i in prec_idx:
-                        if crit[0][i] >= opts.threshold2:
-                            mixup_idx.append(i.item())
+                    mixup_idx = adaptive_selector(pred_u_all, percentile)
 
                     pt = pred_u_all**(1/opts.T)
                     targets_u = pt / pt.sum(dim=1, keepdim=True)
-                    targets_u = targets_u.detach()
 
-                inputs_u1 = inputs_u1[mixup_idx]
-                inputs_u2 = inputs_u2[mixup_idx]
-                targets_u = targets_u[mixup_idx]
-                print(len(mixup_idx))
-
-                all_inputs_u1 = torch.cat([all_inputs_u1, inputs_u1], dim=0)
-                all_inputs_u2 = torch.cat([all_inputs_u2, inputs_u2], dim=0)
-                all_targets_u = torch.cat([all_targets_u, targets_u], dim=0)
-
-            print("each")
-            print(all_inputs_u1.size(), all_inputs_u2.size(), all_targets_u.size())
-            all_inputs_u1 = all_inputs_u1[:opts.batchsize2]
-            all_inputs_u2 = all_inputs_u2[:opts.batchsize2]
-            all_targets_u = all_targets_u[:opts.batchsize2]
-            print(all_inputs_u1.size(), all_inputs_u2.size(), all_targets_u.size())
+                pool.push(inputs_u1[mixup_idx], inputs_u2[mixup_idx], targets_u[mixup_idx], pred_u_all[mixup_idx].max(1)[0])
 
+            all_inputs_u1, all_inputs_u2, all_targets_u = pool.take(opts.batchsize2) if len(pool) != 0 else (inputs_x[:0], inputs_x[:0], targets_x[:0])
+            num_selected = all_inputs_u1.size(0)
+            good_ulb.update(num_selected/opts.batchsize2)
 
             all_inputs = torch.cat([inputs_x, all_inputs_u1, all_inputs_u2], dim=0)
             all_targets = torch.cat([targets_x, all_targets_u, all_targets_u], dim=0)
 
-            print("all", all_inputs.size(), all_targets.size())
-
 
 
         lamda = np.random.beta(opts.alpha, opts.alpha)
@@ -649,7 +634,7 @@ def train(opts, train_loader, unlabel_loader, model, criterion, optimizer, epoch
 
         fea, logits_temp = model(mixed_input[0])
 
-        if len(mixup_idx) != 0:
+        if num_selected != 0:
             #print("asdlfkjasodifjasio")
             logits = [logits_temp]
             for newinput in mixed_input[1:]:
@@ -0,0 +1,68 @@
+"""
+Pseudo-label selection for the unlabeled batch.
+
+The threshold policies used to walk the batch in Python (crit[0][i] >= t, i.item()), which
+costs one device sync per sample. PseudoLabelSelector makes the same choice with a max, a topk
+and a comparison on the device:
+
+    fixed      samples whose confidence (max class probability) is >= threshold
+    adaptive   the `percentile` most confident fraction of the batch, of which only the
+               samples with confidence >= min_threshold are kept
+
+mask() never leaves the device. indices() needs one sync for the variable-sized result, the
+same one the boolean indexing of the inputs would need anyway.
+"""
+
+import torch
+
+
+class PseudoLabelSelector(object):
+    """Selects confident samples from (N, C) class probabilities.
+
+    Args:
+        policy: 'fixed' or 'adaptive'.
+        threshold: confidence cut of the fixed policy.
+        min_threshold: confidence floor applied after the percentile of the adaptive policy.
+    """
+
+    def __init__(self, policy='fixed', threshold=0.0, min_threshold=0.0):
+        if policy not in ('fixed', 'adaptive'):
+            raise ValueError('unknown pseudo-label policy {}'.format(policy))
+        self.policy = policy
+        self.threshold = threshold
+        self.min_threshold = min_threshold
+
+    def _check(self, percentile):
+        if self.policy == 'adaptive' and percentile is None:
+            raise ValueError('the adaptive policy needs a percentile')
+
+    def mask(self, probs, percentile=None):
+        """Boolean mask over the batch. percentile may be a float or a 0-dim tensor on the device."""
+        self._check(percentile)
+        confidence = probs.max(1)[0]
+        if self.policy == 'fixed':
+            return confidence >= self.threshold
+
+        n = confidence.size(0)
+        if torch.is_tensor(percentile):
+            # rank of every sample in descending confidence, compared against n * percentile on the device
+            order = torch.argsort(confidence, descending=True)
+            rank = torch.empty_like(order).scatter_(0, order, torch.arange(n, device=order.device))
+            keep = rank < (n * percentile).floor().to(rank.dtype)
+        else:
+            keep = torch.zeros(n, dtype=torch.bool, device=confidence.device)
+            keep[confidence.topk(int(n * percentile))[1]] = True
+        return keep & (confidence >= self.min_threshold)
+
+    def indices(self, probs, percentile=None):
+        """Index tensor of the selected samples: most confident first for the adaptive policy,
+        batch order for the fixed one (the order of the former loops)."""
+        self._check(percentile)
+        if self.policy == 'fixed' or torch.is_tensor(percentile):
+            return self.mask(probs, percentile).nonzero().view(-1)
+
+        confidence = probs.max(1)[0]
+        values, idx = confidence.topk(int(confidence.size(0) * percentile))
+        return idx[values >= self.min_threshold]
+
+    __call__ = indices
@@ -5,6 +5,7 @@ import random
 import PIL, PIL.ImageOps, PIL.ImageEnhance, PIL.ImageDraw
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 
 from itertools import accumulate as _accumulate, repeat as _repeat
@@ -105,7 +106,7 @@ def Solarize(img, v):  # [0, 256]
 
 
 def SolarizeAdd(img, addition=0, threshold=128):
-    img_np = np.array(img).astype(np.int)
+    img_np = np.array(img).astype(np.int64)
     img_np = img_np + addition
     img_np = np.clip(img_np, 0, 255)
     img_np = img_np.astype(np.uint8)
@@ -286,3 +287,213 @@ class RandAugment:
             img = op(img, val)
 
         return img
+
+
+########################################################################
+############ BATCHED TENSOR IMPLEMENTATION OF augment_list #############
+########################################################################
+# Every op takes a float batch (N, C, H, W) with values in [0, 255] and a per-sample
+# magnitude tensor v of shape (N,), and mirrors the PIL op above, including its uint8
+# rounding. The random sign of the geometric ops is drawn by BatchRandAugment.
+
+_GRAY = (19595. / 65536., 38470. / 65536., 7471. / 65536.)  # PIL's RGB -> L weights
+_CUTOUT_COLOR = (125., 123., 114.)
+
+
+def _per_sample(v, x):
+    return v.view(-1, 1, 1, 1).to(dtype=x.dtype, device=x.device)
+
+
+def _blend(degenerate, x, v):
+    # PIL.Image.blend truncates to uint8
+    return (degenerate + _per_sample(v, x) * (x - degenerate)).clamp(0, 255).floor()
+
+
+def _grayscale(x):
+    w = x.new_tensor(_GRAY).view(1, 3, 1, 1)
+    return torch.floor((x * w).sum(1, keepdim=True) + 0.5)
+
+
+def _affine(x, a, b, c, d, e, f):
+    """PIL-style AFFINE transform with nearest sampling: output pixel (x, y) takes the input
+    pixel at (a*x + b*y + c, d*x + e*y + f), measured at pixel centers, and 0 outside."""
+    n, _, h, w = x.size()
+    ys = torch.arange(h, dtype=x.dtype, device=x.device).view(1, h, 1) + 0.5
+    xs = torch.arange(w, dtype=x.dtype, device=x.device).view(1, 1, w) + 0.5
+    coef = [t.to(dtype=x.dtype, device=x.device).view(-1, 1, 1) for t in (a, b, c, d, e, f)]
+    x_in = coef[0] * xs + coef[1] * ys + coef[2]
+    y_in = coef[3] * xs + coef[4] * ys + coef[5]
+    grid = torch.stack([2 * x_in / w - 1, 2 * y_in / h - 1], dim=3)
+    return F.grid_sample(x, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
+def TensorShearX(x, v):
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, one, v, zero, zero, one, zero)
+
+
+def TensorShearY(x, v):
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, one, zero, zero, v, one, zero)
+
+
+def TensorTranslateXabs(x, v):
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, one, zero, v, zero, one, zero)
+
+
+def TensorTranslateYabs(x, v):
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, one, zero, zero, zero, one, v)
+
+
+def TensorRotate(x, v):
+    # same matrix as PIL.Image.rotate without expand: rotation about the image center
+    h, w = x.size(2), x.size(3)
+    angle = -v.double() * np.pi / 180.
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    cx, cy = w / 2., h / 2.
+    c = cos * -cx + sin * -cy + cx
+    f = -sin * -cx + cos * -cy + cy
+    return _affine(x, cos, sin, c, -sin, cos, f)
+
+
+def TensorAutoContrast(x, _):
+    lo = x.min(3, keepdim=True)[0].min(2, keepdim=True)[0]
+    hi = x.max(3, keepdim=True)[0].max(2, keepdim=True)[0]
+    scale = 255. / (hi - lo).clamp(min=1)
+    out = ((x - lo) * scale).floor().clamp(0, 255)
+    return torch.where(hi > lo, out, x)
+
+
+def TensorInvert(x, _):
+    return 255. - x
+
+
+def TensorEqualize(x, _):
+    n, c, h, w = x.size()
+    flat = x.long().clamp(0, 255).view(n * c, h * w)
+    hist = torch.zeros(n * c, 256, dtype=torch.long, device=x.device)
+    hist.scatter_add_(1, flat, torch.ones_like(flat))
+    # PIL: step = (pixels - count of the highest occupied bin) // 256
+    last = 255 - torch.argmax((hist.flip(1) > 0).float(), dim=1, keepdim=True)
+    step = (h * w - hist.gather(1, last)) // 256
+    cum = torch.cumsum(hist, 1) - hist
+    lut = ((step // 2 + cum) // step.clamp(min=1)).clamp(0, 255)
+    out = lut.gather(1, flat).view(n, c, h, w).to(x.dtype)
+    return torch.where((step > 0).view(n, c, 1, 1), out, x)
+
+
+def TensorSolarize(x, v):
+    return torch.where(x < _per_sample(v, x), x, 255. - x)
+
+
+def TensorSolarizeAdd(x, v, threshold=128):
+    x = (x + _per_sample(v, x)).clamp(0, 255).floor()
+    return torch.where(x < threshold, x, 255. - x)
+
+
+def TensorPosterize(x, v):
+    bits = v.long().clamp(min=1, max=8)
+    mask = 256 - torch.pow(2, 8 - bits)
+    return (x.long() & mask.view(-1, 1, 1, 1).to(x.device)).to(x.dtype)
+
+
+def TensorColor(x, v):
+    return _blend(_grayscale(x).expand_as(x), x, v)
+
+
+def TensorContrast(x, v):
+    mean = torch.floor(_grayscale(x).mean((1, 2, 3), keepdim=True) + 0.5)
+    return _blend(mean.expand_as(x), x, v)
+
+
+def TensorBrightness(x, v):
+    return _blend(torch.zeros_like(x), x, v)
+
+
+def TensorSharpness(x, v):
+    n, c, h, w = x.size()
+    kernel = x.new_tensor([[1., 1., 1.], [1., 5., 1.], [1., 1., 1.]]).view(1, 1, 3, 3) / 13.
+    smooth = F.conv2d(x.view(n * c, 1, h, w), kernel).view(n, c, h - 2, w - 2)
+    degenerate = x.clone()
+    # PIL's SMOOTH filter leaves the one pixel border untouched
+    degenerate[:, :, 1:-1, 1:-1] = torch.floor(smooth + 0.5)
+    return _blend(degenerate, x, v)
+
+
+def TensorCutoutAbs(x, v):
+    n, _, h, w = x.size()
+    v = v.to(device=x.device, dtype=x.dtype).view(-1, 1, 1)
+    # CutoutAbs draws the center with np.random.uniform(w), i.e. uniformly between 1 and w
+    x0 = torch.floor((w + torch.rand(n, 1, 1, device=x.device) * (1 - w) - v / 2.).clamp(min=0))
+    y0 = torch.floor((h + torch.rand(n, 1, 1, device=x.device) * (1 - h) - v / 2.).clamp(min=0))
+    x1 = (x0 + v).clamp(max=w)
+    y1 = (y0 + v).clamp(max=h)
+    cols = torch.arange(w, dtype=x.dtype, device=x.device).view(1, 1, w)
+    rows = torch.arange(h, dtype=x.dtype, device=x.device).view(1, h, 1)
+    inside = ((cols >= x0) & (cols <= x1) & (rows >= y0) & (rows <= y1)).unsqueeze(1)
+    color = x.new_tensor(_CUTOUT_COLOR).view(1, 3, 1, 1)
+    return torch.where(inside, color.expand_as(x), x)
+
+
+def batch_augment_list():  # same 16 operations, order and ranges as augment_list(), plus whether the sign is random
+    l = [
+        (TensorAutoContrast, 0, 1, False),
+        (TensorEqualize, 0, 1, False),
+        (TensorInvert, 0, 1, False),
+        (TensorRotate, 0, 30, True),
+        (TensorPosterize, 0, 4, False),
+        (TensorSolarize, 0, 256, False),
+        (TensorSolarizeAdd, 0, 110, False),
+        (TensorColor, 0.1, 1.9, False),
+        (TensorContrast, 0.1, 1.9, False),
+        (TensorBrightness, 0.1, 1.9, False),
+        (TensorSharpness, 0.1, 1.9, False),
+        (TensorShearX, 0., 0.3, True),
+        (TensorShearY, 0., 0.3, True),
+        (TensorCutoutAbs, 0, 40, False),
+        (TensorTranslateXabs, 0., 100, True),
+        (TensorTranslateYabs, 0., 100, True),
+    ]
+
+    return l
+
+
+class BatchRandAugment:
+    """RandAugment over a whole (N, 3, H, W) batch of uint8 (or float in [0, 255]) images.
+
+    Every sample draws its own n ops and, if m is a (low, high) pair, its own magnitude.
+    Samples that drew the same op in a layer are transformed together, so one layer costs at
+    most 16 batched ops instead of N PIL calls. Works on CPU and GPU tensors.
+    """
+
+    def __init__(self, n, m):
+        self.n = n
+        self.m = m      # [0, 30] or a (low, high) range sampled per image
+        self.augment_list = batch_augment_list()
+
+    def __call__(self, batch):
+        x = batch.float()
+        if x is batch:
+            # float32 input: the ops write into x, which must not be the caller's batch
+            x = x.clone()
+        num = x.size(0)
+        for _ in range(self.n):
+            # op choice and magnitude live on the CPU, so no device sync is needed to group samples
+            choice = torch.randint(len(self.augment_list), (num,))
+            if isinstance(self.m, (tuple, list)):
+                m = torch.empty(num).uniform_(self.m[0], self.m[1])
+            else:
+                m = torch.full((num,), float(self.m))
+            for k, (op, minval, maxval, signed) in enumerate(self.augment_list):
+                idx = (choice == k).nonzero().view(-1)
+                if idx.numel() == 0:
+                    continue
+                val = (m[idx] / 30) * float(maxval - minval) + minval
+                if signed:
+                    val = torch.where(torch.rand(idx.numel()) > 0.5, -val, val)
+                idx = idx.to(x.device)
+                x[idx] = op(x[idx], val)
+
+        return x.to(batch.dtype) if batch.dtype == torch.uint8 else x
@@ -0,0 +1,123 @@
+"""
+Parity and throughput of BatchRandAugment against the per-image PIL RandAugment.
+
+    python benchmark_RA.py --batchsize 64 --imsize 224 --n 3 --m 9
+
+The parity check exits with an error if any op differs from PIL by more than one grey level
+on a larger share of pixels than its tolerance in PARITY_TOLERANCE.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+import RA
+from RA import RandAugment, BatchRandAugment, augment_list, batch_augment_list
+
+
+# share of pixels allowed to differ from PIL by more than 1: the colour ops replicate PIL's integer
+# arithmetic, the geometric ones may pick the other neighbour where nearest sampling is at a tie
+GEOMETRIC_OPS = ('Rotate', 'ShearX', 'ShearY', 'TranslateXabs', 'TranslateYabs')
+PARITY_TOLERANCE = dict({name: 0.02 for name in GEOMETRIC_OPS}, default=0.001)
+
+
+def synthetic_images(num, size):
+    # smooth random images, closer to photos than white noise
+    low = torch.rand(num, 3, size // 16, size // 16) * 255
+    images = F.interpolate(low, size=(size, size), mode='bilinear', align_corners=False)
+    return images.round().clamp(0, 255).to(torch.uint8)
+
+
+def to_pil(batch):
+    return [Image.fromarray(img.permute(1, 2, 0).numpy()) for img in batch]
+
+
+def from_pil(images):
+    return torch.stack([torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1) for img in images])
+
+
+def check_parity(args):
+    """Compares every op with its PIL version for each magnitude of --magnitudes, with the
+    random sign of the geometric ops pinned to + and then to -. Returns the failing cases."""
+    images = synthetic_images(args.batchsize, args.imsize)
+    pil_images = to_pil(images)
+    failed = []
+    pil_random = RA.random.random
+    try:
+        print('{:<22}{:>6}{:>6}{:>14}{:>16}{:>12}'.format('op', 'm', 'sign', 'mean |diff|', 'pixels off > 1', 'tolerance'))
+        # the PIL ops negate v when random.random() > 0.5
+        for sign, pinned in ((1., 0.0), (-1., 1.0)):
+            RA.random.random = lambda: pinned
+            for m in [int(v) for v in args.magnitudes.split(',')]:
+                for (op, minval, maxval), (tensor_op, _, _, signed) in zip(augment_list(), batch_augment_list()):
+                    if op.__name__ == 'CutoutAbs' or (sign < 0 and not signed):
+                        continue  # CutoutAbs has a random position, unsigned ops have no negative branch
+                    val = (float(m) / 30) * float(maxval - minval) + minval
+                    expected = from_pil([op(img, val) for img in pil_images]).float()
+                    actual = tensor_op(images.float(), torch.full((len(images),), sign * val if signed else val))
+                    diff = (expected - actual).abs()
+                    off = (diff > 1).float().mean().item()
+                    tolerance = PARITY_TOLERANCE.get(op.__name__, PARITY_TOLERANCE['default'])
+                    print('{:<22}{:>6}{:>6}{:>14.3f}{:>15.2f}%{:>11.2f}%{}'.format(
+                        op.__name__, m, '+' if sign > 0 else '-', diff.mean().item(), off * 100, tolerance * 100,
+                        '' if off <= tolerance else '  FAIL'))
+                    if off > tolerance:
+                        failed.append('{} m={} sign={}'.format(op.__name__, m, '+' if sign > 0 else '-'))
+    finally:
+        RA.random.random = pil_random
+    return failed
+
+
+def check_throughput(args):
+    images = synthetic_images(args.batchsize, args.imsize)
+    pil_images = to_pil(images)
+    pil_ra = RandAugment(args.n, args.m)
+    batch_ra = BatchRandAugment(args.n, args.m)
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+    start = time.time()
+    for _ in range(args.iters):
+        from_pil([pil_ra(img) for img in pil_images])
+    pil_rate = args.iters * args.batchsize / (time.time() - start)
+    print('PIL RandAugment (per image): {:8.1f} images/s'.format(pil_rate))
+
+    for device in devices:
+        batch = images.to(device)
+        batch_ra(batch)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.iters):
+            batch_ra(batch)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        rate = args.iters * args.batchsize / (time.time() - start)
+        print('BatchRandAugment on {} ({} threads): {:8.1f} images/s ({:.1f}x)'.format(
+            device, torch.get_num_threads(), rate, rate / pil_rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BatchRandAugment parity and throughput')
+    parser.add_argument('--batchsize', default=64, type=int)
+    parser.add_argument('--imsize', default=224, type=int)
+    parser.add_argument('--n', default=3, type=int, help='number of ops per image')
+    parser.add_argument('--m', default=9, type=int, help='magnitude [0, 30] of the throughput run')
+    parser.add_argument('--magnitudes', default='0,5,9,15,20,30', type=str, help='comma separated magnitudes of the parity check')
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='intra-op threads, 0 keeps the torch default')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    failed = check_parity(args)
+    check_throughput(args)
+    if failed:
+        sys.exit('BatchRandAugment differs from PIL beyond the tolerance: {}'.format(', '.join(failed)))